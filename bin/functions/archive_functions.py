@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Archive Functions
+
+Move samples that no longer need to be in the live database to compressed monthly archive files.
+These are samples that have been uploaded, and position-only records (which are never uploaded),
+older than a retention period. Each archive file holds one json object per line per sample:
+{"meta": {sorad_metadata columns}, "radiometry": [{sorad_radiometry columns}, ...]}, with spectra in text format.
+Archives are found next to the database in an 'archive' folder and are read by download_functions.identify_records.
+"""
+import os
+import gzip
+import json
+import logging
+import datetime
+from functions import db_functions as db_func
+
+log = logging.getLogger('archive')
+
+
+def archive_dir(database_path):
+    """Folder holding the archive files belonging to a (base) database path"""
+    return os.path.join(os.path.dirname(database_path), 'archive')
+
+
+def archive_file(database_path, month):
+    """Archive file for a month (YYYY-MM)"""
+    root = os.path.splitext(os.path.basename(database_path))[0]
+    return os.path.join(archive_dir(database_path), f"{root}_archive_{month}.jsonl.gz")
+
+
+def sample_month(meta):
+    """Month (YYYY-MM) of a sample, used to select its archive file"""
+    sample_time = meta.get('gps_time', meta.get('gps1_time')) or meta.get('pc_time')
+    if sample_time is None:
+        return 'unknown'
+    return str(sample_time)[:7]
+
+
+def archive_shard(db_dict, shard, cutoff, batch_size=500, should_stop=None):
+    """Archive and delete eligible samples recorded before cutoff (datetime) from a single database file, in batches.
+    Returns the number of archived samples"""
+    conn, cur = db_func.connect_db({'file': shard})
+    success_field, _ = db_func.export_fields(conn, cur)
+    meta_columns = db_func.column_names(conn, cur, table="sorad_metadata")
+    data_columns = db_func.column_names(conn, cur, table="sorad_radiometry")
+    cutoff_str = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+
+    sql_ids = f"""SELECT id_ FROM sorad_metadata WHERE (n_rad_obs IS NULL OR {success_field} = 1) AND pc_time < ? ORDER BY id_ LIMIT ?"""
+    n_archived = 0
+    while (should_stop is None) or (not should_stop()):
+        cur.execute(sql_ids, (cutoff_str, batch_size))
+        ids = [row[0] for row in cur.fetchall()]
+        if len(ids) == 0:
+            break
+        placeholders = ",".join("?" * len(ids))
+        cur.execute(f"""SELECT * FROM sorad_metadata WHERE id_ IN ({placeholders}) ORDER BY id_""", ids)
+        samples = {row[0]: {'meta': dict(zip(meta_columns, row)), 'radiometry': []} for row in cur.fetchall()}
+        cur.execute(f"""SELECT * FROM sorad_radiometry WHERE metadata_id IN ({placeholders})""", ids)
+        for row in cur.fetchall():
+            rad = dict(zip(data_columns, row))
+            rad['measurement'] = db_func.spectrum_as_text(rad['measurement'])
+            rad.pop('spectrum_format', None)
+            samples[rad['metadata_id']]['radiometry'].append(rad)
+
+        # group by month, write and sync archives before removing anything from the database
+        months = {}
+        for sample in samples.values():
+            months.setdefault(sample_month(sample['meta']), []).append(json.dumps(sample, default=str))
+        for month, lines in months.items():
+            path = archive_file(db_func.base_path(db_dict), month)
+            with gzip.open(path, 'ab') as af:
+                af.write(("\n".join(lines) + "\n").encode())
+            with open(path, 'rb') as af:
+                os.fsync(af.fileno())
+
+        cur.execute(f"""DELETE FROM sorad_radiometry WHERE metadata_id IN ({placeholders})""", ids)
+        cur.execute(f"""DELETE FROM sorad_metadata WHERE id_ IN ({placeholders})""", ids)
+        conn.commit()
+        n_archived += len(ids)
+        log.debug(f"Archived {n_archived} samples from {shard}")
+
+    if n_archived > 0:
+        # return free pages to the file system, if the database was created to allow this
+        cur.execute("PRAGMA auto_vacuum")
+        if cur.fetchone()[0] == 2:
+            conn.executescript("PRAGMA incremental_vacuum;")  # execute() would only free a single page
+        else:
+            log.debug(f"{shard} does not use incremental vacuum, free space will be reused for new records")
+    conn.close()
+    return n_archived
+
+
+def archive_uploaded(db_dict, retention_days=90, batch_size=500, should_stop=None):
+    """Archive and delete eligible samples older than retention_days from all database files. Returns the number of archived samples"""
+    os.makedirs(archive_dir(db_func.base_path(db_dict)), exist_ok=True)
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    n_archived = 0
+    for shard in db_func.list_shards(db_dict, end_time=cutoff):
+        n_archived += archive_shard(db_dict, shard, cutoff, batch_size, should_stop)
+    if n_archived > 0:
+        log.info(f"Archived {n_archived} samples recorded before {cutoff:%Y-%m-%d %H:%M}")
+    return n_archived
+
+
+def archive_files(database_path, start_time, end_time):
+    """Archive files of the months between start_time and end_time (datetime), if they exist"""
+    files = []
+    month = datetime.datetime(start_time.year, start_time.month, 1)
+    while month <= end_time:
+        path = archive_file(database_path, month.strftime('%Y-%m'))
+        if os.path.exists(path):
+            files.append(path)
+        month = datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return files
+
+
+def read_archive(database_path, start_time, end_time):
+    """Archived samples (as dictionaries, see module description) with a gps time between start_time and end_time (datetime).
+    The archive files are read a line at a time, samples are returned in the order in which they were archived"""
+    start_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
+    end_str = end_time.strftime('%Y-%m-%d %H:%M:%S')
+    seen = set()
+    for path in archive_files(database_path, start_time, end_time):
+        try:
+            with gzip.open(path, 'rt') as af:
+                for line in af:
+                    try:
+                        sample = json.loads(line)
+                    except json.JSONDecodeError:
+                        # incomplete line from an interrupted write
+                        continue
+                    sample_time = sample['meta'].get('gps_time', sample['meta'].get('gps1_time'))
+                    if (sample_time is not None) and (start_str <= sample_time <= end_str):
+                        # an interrupted archive run may have written a sample twice
+                        key = sample['meta'].get('sample_uuid') or sample['meta']['id_']
+                        if key not in seen:
+                            seen.add(key)
+                            yield sample
+        except (EOFError, gzip.BadGzipFile) as err:
+            log.warning(f"Archive {path} could only be read in part: {err}")
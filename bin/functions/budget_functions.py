@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Upload Budget Functions
+
+Keep data export within a data allowance (e.g. on a satellite link), and recognise when a cheap link is available.
+
+Uploads are split in two tiers, in order of priority:
+- realtime: status updates and samples recorded within the last export_realtime_window_sec. A share of the byte budget
+  (export_budget_realtime_share) is reserved for these, so live data keeps flowing when the backlog is large.
+- backlog: older pending samples, newest first, using the rest of the budget. Only samples up to export_backfill_age_sec
+  old are included, unless a cheap link is detected: one of the network interfaces in export_cheap_link_interfaces is up
+  (e.g. wlan0 when in range of a harbour Wi-Fi network) or the platform is inside one of the export_cheap_link_geofences
+  (e.g. a port with a shore connection). Older samples are then backfilled as part of the backlog. Without any cheap link
+  settings, the backlog always includes them.
+While a cheap link is detected, uploads do not count against the budget.
+"""
+import os
+import math
+import logging
+import datetime
+import threading
+
+log = logging.getLogger('export.budget')
+
+BUDGET_PERIODS = ['hour', 'day']
+TIERS = ['realtime', 'backlog']
+EARTH_RADIUS_KM = 6371.0
+
+
+def period_start(period, now=None):
+    """Start of the budget period containing now"""
+    now = datetime.datetime.now() if now is None else now
+    if period == 'hour':
+        return now.replace(minute=0, second=0, microsecond=0)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class UploadBudget(object):
+    """
+    Bytes available for uploads in the current period, with a share reserved for realtime data.
+    : config_dict is the [EXPORT] section of the config file interpreted as a dictionary in initialisation.py
+    """
+    def __init__(self, config_dict):
+        self.budget = config_dict.get('export_budget_bytes', 0)  # 0: unlimited
+        self.period = config_dict.get('export_budget_period', 'day')
+        self.realtime_share = min(max(config_dict.get('export_budget_realtime_share', 0.2), 0.0), 1.0)
+        self.start = period_start(self.period)
+        self.used = {tier: 0 for tier in TIERS}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Upload budget {self.as_dict()}"
+
+    @property
+    def limited(self):
+        return self.budget > 0
+
+    def roll(self):
+        """Start a new period if the current one has ended"""
+        start = period_start(self.period)
+        if start != self.start:
+            log.info(f"New upload budget period, used in previous {self.period}: {self.used}")
+            self.start = start
+            self.used = {tier: 0 for tier in TIERS}
+
+    def remaining(self, tier):
+        """Bytes that uploads of a tier may still use in this period, None if unlimited.
+        Realtime data may use the whole budget, backlog uploads only the part not reserved for realtime data"""
+        if not self.limited:
+            return None
+        with self.lock:
+            self.roll()
+            remaining = self.budget - sum(self.used.values())
+            if tier == 'backlog':
+                remaining = min(remaining, (1 - self.realtime_share) * self.budget - self.used['backlog'])
+        return max(int(remaining), 0)
+
+    def available(self, tier):
+        """True if uploads of a tier may continue"""
+        remaining = self.remaining(tier)
+        return (remaining is None) or (remaining > 0)
+
+    def spend(self, tier, n_bytes):
+        """Count bytes used by uploads of a tier"""
+        with self.lock:
+            self.roll()
+            self.used[tier] += n_bytes
+
+    def as_dict(self):
+        """Budget state, e.g. to publish in redis and restore after a restart"""
+        with self.lock:
+            return {'budget': self.budget, 'period': self.period, 'period_start': self.start,
+                    'realtime_share': self.realtime_share, 'used': dict(self.used)}
+
+    def restore(self, state):
+        """Continue from a state saved with as_dict, if it is for the current period"""
+        if (state is None) or (state.get('period') != self.period):
+            return
+        with self.lock:
+            if state.get('period_start') == period_start(self.period):
+                self.used.update(state.get('used', {}))
+                log.info(f"Upload budget restored, used this {self.period}: {self.used}")
+
+
+def parse_geofences(text):
+    """Geofences from a config string 'lat,lon,radius_km; lat,lon,radius_km' as a list of (lat, lon, radius_km)"""
+    geofences = []
+    for fence in [f.strip() for f in (text or '').split(';') if f.strip()]:
+        lat, lon, radius = [float(v) for v in fence.split(',')]
+        geofences.append((lat, lon, radius))
+    return geofences
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great circle distance in km (haversine)"""
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def interface_up(interface):
+    """True if a network interface exists and is up"""
+    try:
+        with open(os.path.join('/sys/class/net', interface, 'operstate')) as f:
+            return f.read().strip() == 'up'
+    except OSError:
+        return False
+
+
+def cheap_link(config_dict, position=None):
+    """
+    Reason a cheap link is considered available (an interface name or geofence), None if there is none.
+    : position is the latest (lat, lon) of the platform, if known
+    """
+    for interface in config_dict.get('export_cheap_link_interfaces', []):
+        if interface_up(interface):
+            return f"interface {interface} up"
+    if position is not None:
+        lat, lon = position
+        for fence_lat, fence_lon, radius in config_dict.get('export_cheap_link_geofences', []):
+            if distance_km(lat, lon, fence_lat, fence_lon) <= radius:
+                return f"inside geofence {fence_lat},{fence_lon}"
+    return None
+
+
+def cheap_link_configured(config_dict):
+    """True if a cheap link can be detected at all. If not, backfill is not held back"""
+    return (len(config_dict.get('export_cheap_link_interfaces', [])) > 0) or \
+           (len(config_dict.get('export_cheap_link_geofences', [])) > 0)
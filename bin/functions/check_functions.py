@@ -21,6 +21,7 @@ Checks are included to check
 import datetime
 import requests
 import json
+import functions.http_functions as http
 from numpy import nan
 #import motor_controller_functions as motor_func
 import functions.motor_controller_functions as motor_func
@@ -45,7 +46,7 @@ def check_remote_data_store(export_config_dict):
     data =   json.dumps({"where":{"platform_id":platform_id}, "order": "-updatedAt", "limit": 1, "keys": "updatedAt"})
     # data = json.dumps({"where":{"platform_id":platform_id}, "limit": 0, "count": 1})
     try:
-        response = requests.get(parse_app_url, data=data, headers=headers, timeout=5.0)  # timeout of 5 s prevents main program loop from getting stuck too long
+        response = http.get(parse_app_url, 'remote_check', data=data, headers=headers)  # timeout prevents main program loop from getting stuck too long
         if (response.status_code >= 200) and (response.status_code) < 300:
             if len(response.json()['results']) > 0:
                 # e.g. '2021-06-08T14:59:27.101Z'
@@ -66,7 +67,7 @@ def check_remote_data_store(export_config_dict):
 
 def check_internet():
     try:
-        response = requests.get('http://one.one.one.one', verify=True, timeout=0.5)
+        response = http.get('http://one.one.one.one', 'internet_check', verify=True)
         if response.status_code == requests.codes.ok:
             return True
         else:
@@ -11,9 +11,26 @@ import traceback
 import logging
 import sqlite3
 import uuid
+import urllib.parse
+import datetime
+import numpy as np
+from functions import journal_functions as journal
+from functions import spectral_functions as spectral
 
 log = logging.getLogger() #import root logger
 
+# storage formats of the sorad_radiometry.measurement field (spectrum_format column)
+# text: str(list) representation, e.g. "[1, 2, 3]". NULL in older databases.
+# uint16: packed little-endian unsigned 16 bit integers stored as a BLOB.
+SPECTRUM_FORMATS = {'text': 0, 'uint16': 1}
+SPECTRUM_DTYPE = np.dtype('<u2')
+
+# time-partitioned storage: new samples go to one file per period, e.g. sorad_database_2026-10.db,
+# listed in a catalog file next to it (sorad_database_catalog.db). 'none' keeps a single database file.
+SHARD_PERIODS = ['none', 'day', 'week', 'month']
+# shards are chosen by system time but queried by gps time, allow for a difference between the two
+SHARD_MARGIN = datetime.timedelta(days=1)
+
 def connect_db(db_dict):
     """Connect to the sqlite3 database file
 
@@ -35,6 +52,22 @@ def connect_db(db_dict):
         raise Exception(msg)
     return conn, cur
 
+def connect_db_readonly(path):
+    """Open a read-only connection to a database file, for readers that should never compete for the write lock.
+
+    :param path: path to the database file
+    :return: conn, cur
+    """
+    try:
+        conn = sqlite3.connect("file:{0}?mode=ro".format(urllib.parse.quote(path)), uri=True, timeout=5)
+        cur = conn.cursor()
+    except Exception as err:
+        msg = "Error connecting to database file at: {0}".format(path)
+        log.error(msg)
+        log.exception(err)
+        raise Exception(msg)
+    return conn, cur
+
 def reset_export_succes_count_for_version(conn, cur, db_dict, version=None):
     """Use with caution. Reset the export success status of records in the local db so that they will be re-uploaded. To prevent duplicates, these records should already be removed from the remote store"""
     attempts_field= db_dict['export_attempts_field']
@@ -43,6 +76,13 @@ def reset_export_succes_count_for_version(conn, cur, db_dict, version=None):
         log.error("You must supply a specific sorad_version with this function")
     sql = f"""UPDATE sorad_metadata SET {success_field}=0, {attempts_field}=0 WHERE sorad_version = ?"""
     cur.execute(sql, (version,))
+    # new samples are only looked for above the export cursor: move it back below the reset samples, and stop treating them as failed uploads
+    try:
+        cur.execute("""DELETE FROM sorad_export_retry WHERE metadata_id IN (SELECT id_ FROM sorad_metadata WHERE sorad_version = ?)""", (version,))
+        cur.execute("""UPDATE sorad_export_cursor SET last_id = min(last_id, coalesce(
+                         (SELECT min(id_) - 1 FROM sorad_metadata WHERE sorad_version = ?), last_id)) WHERE id_ = 1""", (version,))
+    except sqlite3.OperationalError:
+        pass  # no export state yet, it will be created from the export success field
     conn.commit()
 
 
@@ -77,6 +117,11 @@ def create_tables(db_dict):
             except:
                 log.warning("Could not create path to database location: {0}".format(db_dict['file']))
                 return
+        # new database: allow space freed by archiving to be returned to the file system (must be set before WAL mode and tables)
+        conn = sqlite3.connect(db_dict['file'])
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        conn.close()
 
     # the following should create a new database file if it does not already exist
     conn, cur = connect_db(db_dict)
@@ -102,68 +147,735 @@ def create_tables(db_dict):
             (metadata_id integer NOT NULL,
             sensor_id text, inttime integer,
             measurement text,
+            spectrum_format integer,
             FOREIGN KEY(metadata_id) REFERENCES sorad_metadata(id_))"""
     cur.execute(sql)
+
+    # upgrade older databases: spectra were always stored as text before the format column was added
+    if 'spectrum_format' not in column_names(conn, cur, table="sorad_radiometry"):
+        log.info("Adding spectrum_format column to sorad_radiometry table")
+        cur.execute("""ALTER TABLE sorad_radiometry ADD COLUMN spectrum_format integer""")
+
+    create_indexes(conn, cur)
+    create_export_stats(conn, cur)
+    create_export_state(conn, cur)
+
     conn.commit()
     conn.close()
 
 
-def commit_db(db_dict, verbose, values, trigger_id, spectra_data, software_version=0):
-    """Commit all the required values to the database object, or just gps/meta data if sensor data aren't available"""
+def export_fields(conn, cur):
+    """Names of the export success and attempts columns, which differ between database layouts"""
+    meta_columns = column_names(conn, cur, table="sorad_metadata")
+    if 'sos_inserted' in meta_columns:
+        return 'sos_inserted', 'sos_insertion_attempts'   # database format < June 2021
+    return 'export_success', 'export_attempts'
+
+
+def index_definitions(conn, cur):
+    """Indexes supporting the frequent queries, adapted to the column names used in this database file.
+
+    The partial index on records pending upload only holds records that still need exporting,
+    so the export queries no longer scan the whole table. Its WHERE clause must match the one used
+    in export_functions.identify_new_local_records for sqlite to use it.
+    """
+    meta_columns = column_names(conn, cur, table="sorad_metadata")
+    success_field, attempts_field = export_fields(conn, cur)
+    time_field = 'gps_time' if 'gps_time' in meta_columns else 'gps1_time'
+
+    return {'idx_radiometry_metadata_id': "ON sorad_radiometry(metadata_id)",
+            'idx_metadata_gps_time':      f"ON sorad_metadata({time_field})",
+            'idx_metadata_pending':       f"ON sorad_metadata(id_) WHERE n_rad_obs > 0 AND ({success_field} IS NULL OR {success_field}=0)"}
+
+
+def create_indexes(conn, cur):
+    """Create any missing indexes. On large existing database files this may take a while, but only happens once."""
+    cur.execute("""SELECT name FROM sqlite_master WHERE type = 'index'""")
+    existing = [row[0] for row in cur.fetchall()]
+    for name, definition in index_definitions(conn, cur).items():
+        if name not in existing:
+            log.info(f"Creating database index {name}")
+            cur.execute(f"""CREATE INDEX IF NOT EXISTS {name} {definition}""")
+
+
+def create_export_stats(conn, cur):
+    """Create the sorad_export_stats table and the triggers that keep it up to date.
+
+    The table holds a single row with the number of radiometry samples (n_rad_obs > 0) in the database,
+    and how many of those are pending upload or uploaded. The triggers adjust these counts on every
+    insert, update or delete of a metadata record, so reading them does not require a table scan.
+    """
+    cur.execute("""SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sorad_export_stats'""")
+    if cur.fetchone() is not None:
+        return
+
+    success_field, attempts_field = export_fields(conn, cur)
+    log.info("Creating export statistics table and triggers")
+    cur.execute("""CREATE TABLE sorad_export_stats
+                   (id_ integer PRIMARY KEY CHECK (id_ = 1),
+                   n_total integer NOT NULL, n_pending integer NOT NULL, n_uploaded integer NOT NULL)""")
+    cur.execute("""INSERT INTO sorad_export_stats(id_, n_total, n_pending, n_uploaded) VALUES (1, 0, 0, 0)""")
+
+    # contribution of a single record (OLD or NEW) to each count, as 0 or 1
+    def counts(row):
+        is_sample = f"(coalesce({row}.n_rad_obs, 0) > 0)"
+        is_pending = f"(coalesce({row}.{success_field}, 0) = 0)"
+        return is_sample, f"({is_sample} AND {is_pending})", f"({is_sample} AND NOT {is_pending})"
+
+    new_sample, new_pending, new_uploaded = counts('NEW')
+    old_sample, old_pending, old_uploaded = counts('OLD')
+
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_export_stats_insert AFTER INSERT ON sorad_metadata
+                    BEGIN
+                      UPDATE sorad_export_stats SET n_total = n_total + {new_sample},
+                                                    n_pending = n_pending + {new_pending},
+                                                    n_uploaded = n_uploaded + {new_uploaded} WHERE id_ = 1;
+                    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_export_stats_update AFTER UPDATE OF n_rad_obs, {success_field} ON sorad_metadata
+                    BEGIN
+                      UPDATE sorad_export_stats SET n_total = n_total - {old_sample} + {new_sample},
+                                                    n_pending = n_pending - {old_pending} + {new_pending},
+                                                    n_uploaded = n_uploaded - {old_uploaded} + {new_uploaded} WHERE id_ = 1;
+                    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_export_stats_delete AFTER DELETE ON sorad_metadata
+                    BEGIN
+                      UPDATE sorad_export_stats SET n_total = n_total - {old_sample},
+                                                    n_pending = n_pending - {old_pending},
+                                                    n_uploaded = n_uploaded - {old_uploaded} WHERE id_ = 1;
+                    END""")
+
+    # initialise from existing records (this is the only full scan)
+    recount_export_stats(conn, cur, audit=False)
+
+
+def recount_export_stats(conn, cur, audit=True):
+    """Count samples, pending and uploaded records with a full table scan and reset the export statistics.
+    Returns the counts found. Any difference with the incremental counts is logged, so this can be used for auditing."""
+    success_field, attempts_field = export_fields(conn, cur)
+    cur.execute(f"""SELECT count(*),
+                           coalesce(sum(coalesce({success_field}, 0) = 0), 0),
+                           coalesce(sum(coalesce({success_field}, 0) != 0), 0)
+                    FROM sorad_metadata WHERE n_rad_obs > 0""")
+    n_total, n_pending, n_uploaded = cur.fetchone()
+
+    previous = export_counts(conn, cur)
+    if audit and (previous is not None) and (previous != (n_total, n_pending, n_uploaded)):
+        log.warning(f"Export statistics corrected from {previous} to {(n_total, n_pending, n_uploaded)} (total, pending, uploaded)")
+
+    cur.execute("""UPDATE sorad_export_stats SET n_total = ?, n_pending = ?, n_uploaded = ? WHERE id_ = 1""",
+                (n_total, n_pending, n_uploaded))
+    conn.commit()
+    return n_total, n_pending, n_uploaded
+
+
+def export_counts(conn, cur):
+    """Return the number of samples, samples pending upload and uploaded samples from the export statistics.
+    Returns None if the statistics table is not available."""
     try:
-        conn, cur = connect_db(db_dict)
+        cur.execute("""SELECT n_total, n_pending, n_uploaded FROM sorad_export_stats WHERE id_ = 1""")
+    except sqlite3.OperationalError:
+        return None
+    return cur.fetchone()
 
-        sample_uuid = str(uuid.uuid1())
-
-        if (trigger_id is None) or (spectra_data is None):
-            cur.execute("""INSERT INTO sorad_metadata(sample_uuid, pc_time, gps_time, gps_fix, gps_lat, gps_long, gps_speed,
-                           platform_bearing, sun_azimuth, sun_elevation, rel_view_az, pi_cpu_temp,
-                           tilt_avg, tilt_std,
-                           bearing_accuracy, sorad_version,
-                           batt_v, inside_temp, inside_rel_hum, motor_temp, driver_temp,
-                           n_rad_obs, export_success, export_attempts)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, NULL)""", \
-                           (sample_uuid, trigger_id, values['dt'], values['fix'], values['lat0'], values['lon0'], values['speed'],
-                            values['ship_bearing_mean'], values['solar_az'], values['solar_el'],
-                            values['rel_view_az'], values['pi_temp'],
-                            values['tilt_avg'], values['tilt_std'], values['accHeading'], software_version,
-                            values['batt_voltage'], values['inside_temp'], values['inside_rh'], values['motor_temp'], values['driver_temp']))
-
-            sample_id = cur.lastrowid
-            conn.commit()
-            conn.close()
-            return sample_id
-
-        elif (trigger_id) is not None and (spectra_data is not None):
-            cur.execute("""INSERT INTO sorad_metadata(sample_uuid, pc_time, gps_time, gps_fix, gps_lat, gps_long, gps_speed,
-                           platform_bearing, sun_azimuth, sun_elevation, rel_view_az, pi_cpu_temp,
-                           tilt_avg, tilt_std,
-                           bearing_accuracy, sorad_version,
-                           batt_v, inside_temp, inside_rel_hum, motor_temp, driver_temp,
-                           n_rad_obs, export_success, export_attempts)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)""", \
-                           (sample_uuid, trigger_id, values['dt'], values['fix'], values['lat0'], values['lon0'], values['speed'],
-                            values['ship_bearing_mean'], values['solar_az'], values['solar_el'],
-                            values['rel_view_az'], values['pi_temp'],
-                            values['tilt_avg'], values['tilt_std'],
-                            values['accHeading'], software_version,
-                            values['batt_voltage'], values['inside_temp'], values['inside_rh'], values['motor_temp'], values['driver_temp'], len(spectra_data)))
-
-            sample_id = cur.lastrowid
-
-            for n in range(len(spectra_data)):
-                cur.execute("""INSERT INTO sorad_radiometry(metadata_id,
-                                   sensor_id, inttime, measurement) VALUES(?,?,?,?)""",
-                                   (sample_id, spectra_data[n][0],
-                                    spectra_data[n][1], spectra_data[n][2]))
-
-            conn.commit()
+
+def create_export_state(conn, cur):
+    """Create the tables that keep track of the export of samples, if they don't already exist.
+
+    sorad_export_cursor holds a single row with the export cursor: every sample up to this id_ has either been uploaded or is
+    listed in sorad_export_retry. New samples are only looked for above the cursor.
+    sorad_export_retry holds the samples of which an upload failed, with the number of attempts and the time of the next attempt.
+    Samples that failed too often are marked dead and are no longer retried automatically.
+    On creation, samples of which earlier uploads failed are added to the retry table (due immediately).
+    """
+    cur.execute("""SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sorad_export_cursor'""")
+    if cur.fetchone() is not None:
+        return
+
+    success_field, attempts_field = export_fields(conn, cur)
+    log.info("Creating export state tables")
+    cur.execute("""CREATE TABLE sorad_export_cursor (id_ integer PRIMARY KEY CHECK (id_ = 1), last_id integer NOT NULL)""")
+    cur.execute("""INSERT INTO sorad_export_cursor(id_, last_id) VALUES (1, 0)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS sorad_export_retry
+                   (metadata_id integer PRIMARY KEY, attempts integer NOT NULL, next_attempt datetime NOT NULL, dead integer NOT NULL DEFAULT 0)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_export_retry_due ON sorad_export_retry(dead, next_attempt)""")
+    cur.execute(f"""INSERT OR IGNORE INTO sorad_export_retry(metadata_id, attempts, next_attempt)
+                    SELECT id_, {attempts_field}, ? FROM sorad_metadata
+                    WHERE n_rad_obs > 0 AND ({success_field} IS NULL OR {success_field}=0) AND coalesce({attempts_field}, 0) > 0""",
+                (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+    advance_export_cursor(conn, cur)
+
+
+def advance_export_cursor(conn, cur):
+    """Move the export cursor up to just below the oldest sample that has not been tried yet, or to the latest record"""
+    success_field, attempts_field = export_fields(conn, cur)
+    cur.execute(f"""UPDATE sorad_export_cursor SET last_id = coalesce(
+                      (SELECT min(meta.id_) - 1 FROM sorad_metadata meta
+                       WHERE meta.id_ > sorad_export_cursor.last_id
+                       AND meta.n_rad_obs > 0 AND (meta.{success_field} IS NULL OR meta.{success_field}=0)
+                       AND NOT EXISTS (SELECT 1 FROM sorad_export_retry r WHERE r.metadata_id = meta.id_)),
+                      (SELECT max(id_) FROM sorad_metadata),
+                      last_id) WHERE id_ = 1""")
+
+
+def pending_export_ids(conn, cur, limit, before_id=None, retry=False, since=None):
+    """ids of samples to upload next, newest first.
+    New samples are found above the export cursor. With retry=True, samples of which an upload failed and that are due
+    for another attempt are returned instead. Only samples below before_id and recorded at or after since (datetime)
+    are returned, if given."""
+    success_field, attempts_field = export_fields(conn, cur)
+    before_id = 2**62 if before_id is None else before_id
+    since = '0000-01-01 00:00:00' if since is None else since.strftime('%Y-%m-%d %H:%M:%S')
+    if retry:
+        cur.execute("""SELECT r.metadata_id FROM sorad_export_retry r INNER JOIN sorad_metadata meta ON meta.id_ = r.metadata_id
+                       WHERE r.dead = 0 AND r.next_attempt <= ? AND r.metadata_id < ? AND meta.pc_time >= ?
+                       ORDER BY r.metadata_id DESC LIMIT ?""",
+                    (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), before_id, since, limit))
+    else:
+        cur.execute(f"""SELECT meta.id_ FROM sorad_metadata meta
+                        WHERE meta.id_ > (SELECT last_id FROM sorad_export_cursor WHERE id_ = 1) AND meta.id_ < ?
+                        AND meta.n_rad_obs > 0 AND (meta.{success_field} IS NULL OR meta.{success_field}=0)
+                        AND meta.pc_time >= ?
+                        AND NOT EXISTS (SELECT 1 FROM sorad_export_retry r WHERE r.metadata_id = meta.id_)
+                        ORDER BY meta.id_ DESC LIMIT ?""", (before_id, since, limit))
+    return [row[0] for row in cur.fetchall()]
+
+
+def update_export_state(conn, cur, results, retry_interval=60, retry_interval_max=86400, max_attempts=10):
+    """Record the results of upload attempts [(metadata_id, success, attempts)] in the export state (not committed).
+    Failed samples are retried after retry_interval seconds, doubling on every further failure up to retry_interval_max,
+    until they have failed max_attempts times."""
+    now = datetime.datetime.now()
+    uploaded = [(metadata_id,) for metadata_id, success, attempts in results if success]
+    failed = []
+    for metadata_id, success, attempts in results:
+        if success:
+            continue
+        delay = min(retry_interval * 2 ** max(attempts - 1, 0), retry_interval_max)
+        next_attempt = now + datetime.timedelta(seconds=delay)
+        failed.append((metadata_id, attempts, next_attempt.strftime('%Y-%m-%d %H:%M:%S'), int(attempts >= max_attempts)))
+        if attempts >= max_attempts:
+            log.warning(f"Upload of sample {metadata_id} failed {attempts} times, it will not be retried")
+    if len(uploaded) > 0:
+        cur.executemany("""DELETE FROM sorad_export_retry WHERE metadata_id = ?""", uploaded)
+    if len(failed) > 0:
+        cur.executemany("""INSERT OR REPLACE INTO sorad_export_retry(metadata_id, attempts, next_attempt, dead) VALUES (?, ?, ?, ?)""", failed)
+
+
+def export_retry_counts(conn, cur):
+    """Number of samples waiting for another upload attempt, and of samples that will no longer be retried (dead)"""
+    try:
+        cur.execute("""SELECT coalesce(sum(dead = 0), 0), coalesce(sum(dead != 0), 0) FROM sorad_export_retry""")
+    except sqlite3.OperationalError:
+        return None
+    return cur.fetchone()
+
+
+def export_held_back_count(conn, cur):
+    """Number of samples pending upload that are not due for an attempt: samples that are no longer retried (dead)
+    and failed samples waiting for their next attempt"""
+    try:
+        cur.execute("""SELECT count(*) FROM sorad_export_retry WHERE dead != 0 OR next_attempt > ?""",
+                    (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+    except sqlite3.OperationalError:
+        return 0
+    return cur.fetchone()[0]
+
+
+def requeue_dead_exports(conn, cur):
+    """Give samples that are no longer retried one more upload attempt. Returns the number of samples requeued"""
+    cur.execute("""UPDATE sorad_export_retry SET dead = 0, next_attempt = ? WHERE dead != 0""",
+                (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+    conn.commit()
+    return cur.rowcount
+
+
+def encode_spectrum(spectrum, spectrum_format='text'):
+    """Prepare a spectrum for storage in the measurement field.
+
+    :param spectrum: list or array of pixel counts, or its str(list) representation
+    :param spectrum_format: 'text' or 'uint16' (see SPECTRUM_FORMATS)
+    :return: measurement, format code
+    """
+    if isinstance(spectrum, (bytes, memoryview)):
+        spectrum = decode_spectrum(spectrum)
+
+    if spectrum_format == 'uint16':
+        pixels = spectrum
+        if isinstance(spectrum, str):
+            pixels = spectrum.replace("[","").replace("]","").split(", ")
+            if 'None' in pixels:
+                pixels = None
+        elif spectrum is not None and None in list(spectrum):
+            pixels = None
+
+        if pixels is not None:
+            try:
+                packed = np.asarray(pixels, dtype=np.int64)
+                if (packed.min() >= 0) and (packed.max() <= 65535):
+                    return sqlite3.Binary(packed.astype(SPECTRUM_DTYPE).tobytes()), SPECTRUM_FORMATS['uint16']
+            except (ValueError, TypeError):
+                pass
+        # incomplete or out of range spectra are kept as text so nothing is lost
+        log.debug("Spectrum cannot be packed as uint16, storing as text")
+
+    if isinstance(spectrum, np.ndarray):
+        spectrum = spectrum.tolist()
+    if not isinstance(spectrum, str):
+        spectrum = str(spectrum)
+    return spectrum, SPECTRUM_FORMATS['text']
+
+
+def decode_spectrum(measurement):
+    """Return a stored measurement as a numpy array of pixel counts.
+
+    Packed (uint16) measurements are returned as a read-only view on the BLOB, without copying.
+    Text measurements that contain None values return None.
+    """
+    if isinstance(measurement, (bytes, memoryview)):
+        return np.frombuffer(measurement, dtype=SPECTRUM_DTYPE)
+    spectrum = measurement.replace("[","").replace("]","").split(", ")
+    if 'None' in spectrum:
+        return None
+    return np.array(spectrum, dtype=np.int64)
+
+
+def decode_spectra(measurements, n_pixels=None):
+    """Decode many stored measurements (text or packed uint16) at once into an (n, n_pixels) int64 array.
+
+    Text measurements are parsed in a single numpy call rather than one by one. n_pixels defaults to the most common
+    spectrum length. Returns the array and a boolean array marking the measurements that could be decoded; measurements
+    that contain None values or have a different length are left as zeros.
+    """
+    packed = np.array([isinstance(m, (bytes, memoryview)) for m in measurements], dtype=bool)
+    lengths = np.array([len(m) // SPECTRUM_DTYPE.itemsize if p else (-1 if 'None' in m else m.count(',') + 1)
+                        for m, p in zip(measurements, packed)], dtype=np.int64)
+    if n_pixels is None:
+        candidates = lengths[lengths > 0]
+        n_pixels = int(np.bincount(candidates).argmax()) if len(candidates) > 0 else 0
+    valid = lengths == n_pixels
+    spectra = np.zeros((len(measurements), n_pixels), dtype=np.int64)
+
+    rows = np.flatnonzero(valid & packed)
+    if len(rows) > 0:
+        joined = b"".join(bytes(measurements[i]) for i in rows)
+        spectra[rows] = np.frombuffer(joined, dtype=SPECTRUM_DTYPE).reshape(len(rows), n_pixels)
+    rows = np.flatnonzero(valid & ~packed)
+    if len(rows) > 0:
+        joined = ",".join(measurements[i].strip("[]") for i in rows)
+        try:
+            spectra[rows] = np.fromstring(joined, dtype=np.int64, sep=',').reshape(len(rows), n_pixels)
+        except ValueError:
+            # a measurement that is not a list of integers, decode one by one to find it
+            for i in rows:
+                try:
+                    spectra[i] = decode_spectrum(measurements[i])
+                except (ValueError, TypeError):
+                    valid[i] = False
+    return spectra, valid
+
+
+def spectrum_as_text(measurement):
+    """Return a stored measurement in the (legacy) str(list) representation"""
+    if isinstance(measurement, (bytes, memoryview)):
+        return str(decode_spectrum(measurement).tolist())
+    return measurement
+
+
+def migrate_spectra(db_dict, spectrum_format='uint16', batch_size=1000):
+    """Convert stored spectra to the requested format, in batches to limit lock times.
+
+    Spectra that cannot be represented in the requested format (e.g. incomplete measurements) are left as they are.
+    Returns the number of converted records.
+    """
+    create_tables(db_dict)  # ensure the spectrum_format column exists
+    target = SPECTRUM_FORMATS[spectrum_format]
+    conn, cur = connect_db(db_dict)
+    n_converted = 0
+    last_rowid = 0
+    while True:
+        cur.execute("""SELECT rowid, measurement FROM sorad_radiometry
+                       WHERE rowid > ? AND coalesce(spectrum_format, 0) != ?
+                       ORDER BY rowid LIMIT ?""", (last_rowid, target, batch_size))
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            break
+        updates = []
+        for rowid, measurement in rows:
+            encoded, fmt = encode_spectrum(measurement, spectrum_format)
+            if fmt == target:
+                updates.append((encoded, fmt, rowid))
+        cur.executemany("""UPDATE sorad_radiometry SET measurement = ?, spectrum_format = ? WHERE rowid = ?""", updates)
+        conn.commit()
+        n_converted += len(updates)
+        last_rowid = rows[-1][0]
+        log.info(f"Converted {n_converted} spectra to {spectrum_format} format")
+
+    conn.close()
+    return n_converted
+
+
+def make_record(values, trigger_id, spectra_data, software_version=0):
+    """Collect everything needed to store one sample, so it can be committed now or later (e.g. by the database writer thread)"""
+    return {'sample_uuid': str(uuid.uuid1()),
+            'values': dict(values),
+            'trigger_id': trigger_id,
+            'spectra_data': spectra_data,
+            'software_version': software_version}
+
+
+def store_spectra(db_dict, record):
+    """Append the spectra of a new record (from make_record) to the spectral store, if one is used"""
+    if db_dict.get('spectral_store') is None:
+        return
+    try:
+        spectral.append_record(db_dict['spectral_store'], record)
+    except Exception as err:
+        log.warning(f"Could not add spectra of {record['sample_uuid']} to spectral store: {err}")
+
+
+def insert_record(cur, db_dict, record):
+    """Insert a single record (from make_record) using an open cursor, without committing. Returns the new sample id"""
+    values = record['values']
+    trigger_id = record['trigger_id']
+    spectra_data = record['spectra_data']
+
+    if (trigger_id is None) or (spectra_data is None):
+        # just gps/meta data
+        n_rad_obs = None
+        spectra_data = []
+    else:
+        n_rad_obs = len(spectra_data)
+
+    cur.execute("""INSERT INTO sorad_metadata(sample_uuid, pc_time, gps_time, gps_fix, gps_lat, gps_long, gps_speed,
+                   platform_bearing, sun_azimuth, sun_elevation, rel_view_az, pi_cpu_temp,
+                   tilt_avg, tilt_std,
+                   bearing_accuracy, sorad_version,
+                   batt_v, inside_temp, inside_rel_hum, motor_temp, driver_temp,
+                   n_rad_obs, export_success, export_attempts)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)""", \
+                   (record['sample_uuid'], trigger_id, values['dt'], values['fix'], values['lat0'], values['lon0'], values['speed'],
+                    values['ship_bearing_mean'], values['solar_az'], values['solar_el'],
+                    values['rel_view_az'], values['pi_temp'],
+                    values['tilt_avg'], values['tilt_std'],
+                    values['accHeading'], record['software_version'],
+                    values['batt_voltage'], values['inside_temp'], values['inside_rh'], values['motor_temp'], values['driver_temp'], n_rad_obs))
+
+    sample_id = cur.lastrowid
+
+    for n in range(len(spectra_data)):
+        measurement, spectrum_format = encode_spectrum(spectra_data[n][2], db_dict.get('spectrum_format', 'text'))
+        cur.execute("""INSERT INTO sorad_radiometry(metadata_id,
+                           sensor_id, inttime, measurement, spectrum_format) VALUES(?,?,?,?,?)""",
+                           (sample_id, spectra_data[n][0],
+                            spectra_data[n][1], measurement, spectrum_format))
+    return sample_id
+
+
+def commit_records(db_dict, records, conn=None, cur=None):
+    """Insert a list of records in a single transaction. Exceptions (e.g. database locks) are raised to the caller.
+
+    An open connection can be passed to avoid reconnecting, otherwise a new connection is opened and closed.
+    When sharding, the caller of an open connection is responsible for connecting to current_shard(db_dict).
+    Returns the list of new sample ids.
+    """
+    close_after = conn is None
+    if close_after:
+        current_shard(db_dict)
+        conn, cur = connect_db(db_dict)
+    try:
+        sample_ids = [insert_record(cur, db_dict, record) for record in records]
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        if close_after:
             conn.close()
-            return sample_id
+    return sample_ids
 
-        else:
-            log.warning("Ended up where we should not have in db_functions. No data stored.")
+
+def commit_db(db_dict, verbose, values, trigger_id, spectra_data, software_version=0):
+    """Commit all the required values to the database object, or just gps/meta data if sensor data aren't available.
+    If the database does not accept the record it is kept in the journal, to be replayed later"""
+    record = make_record(values, trigger_id, spectra_data, software_version)
+    store_spectra(db_dict, record)
+    try:
+        return commit_records(db_dict, [record])[0]
 
     except Exception as m:
         log.warning("Exception ignored in db commit: \n{0}".format(m))
         traceback.print_exc(file=sys.stdout)
+        try:
+            journal.append_records(journal.journal_path(base_path(db_dict)), [record])
+            log.warning(f"Record {record['sample_uuid']} kept in journal")
+        except Exception as err:
+            log.error(f"Could not write record {record['sample_uuid']} to journal: {err}")
+
+
+def existing_sample_uuids(db_dict, sample_uuids, conn=None, cur=None):
+    """The sample_uuids of a list that are already in the database (the current shard when sharding)"""
+    close_after = conn is None
+    if close_after:
+        current_shard(db_dict)
+        conn, cur = connect_db(db_dict)
+    try:
+        cur.execute(f"""SELECT sample_uuid FROM sorad_metadata WHERE sample_uuid IN ({','.join('?' * len(sample_uuids))})""", sample_uuids)
+        return set(row[0] for row in cur.fetchall())
+    finally:
+        if close_after:
+            conn.close()
+
+
+def replay_journal(db_dict, conn=None, cur=None, batch_size=100):
+    """Merge records from the journal back into the database. Returns the number of records written.
+
+    Database errors such as locks (sqlite3.OperationalError) are raised, leaving the remaining records in the journal.
+    Records that cannot be written for any other reason are set aside in a .rejected file next to the journal.
+    Progress is recorded after every batch, so that an interrupted replay continues after the records already written.
+    """
+    path = journal.journal_path(base_path(db_dict))
+    resumed = os.path.exists(path + '.replay')
+    replay_path = journal.take_journal(path)
+    if replay_path is None:
+        return 0
+    records = journal.read_records(replay_path)
+    pos = journal.read_progress(replay_path, records) if resumed else 0
+    log.info(f"Replaying {len(records) - pos} record(s) from {replay_path}")
+
+    if resumed and (pos < len(records)):
+        # the replay may have stopped between committing a batch and recording it
+        batch = records[pos:pos + batch_size]
+        existing = existing_sample_uuids(db_dict, [record['sample_uuid'] for record in batch], conn, cur)
+        while (pos < len(records)) and (records[pos]['sample_uuid'] in existing):
+            pos += 1
+        if len(existing) > 0:
+            log.info(f"{len(existing)} record(s) from {replay_path} were already written")
+
+    n_written = 0
+    try:
+        while pos < len(records):
+            batch = records[pos:pos + batch_size]
+            try:
+                commit_records(db_dict, batch, conn, cur)
+                n_written += len(batch)
+                pos += len(batch)
+            except sqlite3.OperationalError:
+                raise
+            except Exception as err:
+                # find the record(s) that cannot be stored
+                log.error(f"Error replaying journal: {err}")
+                for record in batch:
+                    try:
+                        commit_records(db_dict, [record], conn, cur)
+                        n_written += 1
+                    except sqlite3.OperationalError:
+                        raise
+                    except Exception as err:
+                        log.error(f"Record {record['sample_uuid']} could not be stored, moved to {path}.rejected: {err}")
+                        journal.append_records(path + '.rejected', [record])
+                    pos += 1
+            journal.write_progress(replay_path, records, pos)
+    finally:
+        journal.write_records(replay_path, records[pos:])
+        journal.remove_progress(replay_path)
+    return n_written
+
+
+def catalog_path(database_path):
+    """Location of the shard catalog belonging to a (base) database path"""
+    root, ext = os.path.splitext(database_path)
+    return root + '_catalog' + ext
+
+
+def base_path(db_dict):
+    """The configured database path. When sharding, db_dict['file'] points to the current shard instead"""
+    return db_dict.get('database_path', db_dict['file'])
+
+
+def sharding_enabled(db_dict):
+    """Shards are in use if a catalog exists next to the configured database path"""
+    return os.path.exists(catalog_path(base_path(db_dict)))
+
+
+def shard_period_bounds(period, when):
+    """Start and end (exclusive) of the shard period containing datetime when"""
+    if period == 'day':
+        start = datetime.datetime(when.year, when.month, when.day)
+        end = start + datetime.timedelta(days=1)
+    elif period == 'week':
+        start = datetime.datetime(when.year, when.month, when.day) - datetime.timedelta(days=when.weekday())
+        end = start + datetime.timedelta(days=7)
+    elif period == 'month':
+        start = datetime.datetime(when.year, when.month, 1)
+        end = datetime.datetime(when.year + when.month // 12, when.month % 12 + 1, 1)
+    else:
+        raise ValueError("shard_period {0} not recognized. Choose from {1}".format(period, ", ".join(SHARD_PERIODS)))
+    return start, end
+
+
+def shard_path(database_path, period, period_start):
+    """File name of the shard for a period, derived from the configured database path"""
+    labels = {'day': '%Y-%m-%d', 'week': '%G-W%V', 'month': '%Y-%m'}
+    root, ext = os.path.splitext(database_path)
+    return root + '_' + period_start.strftime(labels[period]) + ext
+
+
+def connect_catalog(database_path):
+    """Connect to (and if necessary create) the shard catalog. Shard files are stored relative to the catalog location"""
+    conn, cur = connect_db({'file': catalog_path(database_path)})
+    cur.execute("""CREATE TABLE IF NOT EXISTS sorad_shards
+                   (file text PRIMARY KEY NOT NULL,
+                   period_start datetime, period_end datetime,
+                   first_id integer, created datetime)""")
+    conn.commit()
+    return conn, cur
+
+
+def init_shards(db_dict):
+    """Start using shards for the database in db_dict, which should have been prepared by create_tables.
+
+    An existing database file is registered as the first shard, covering everything up to now.
+    Sets db_dict['database_path'] to the configured path and db_dict['file'] to the current shard.
+    """
+    db_dict['database_path'] = base_path(db_dict)
+    conn, cur = connect_catalog(db_dict['database_path'])
+    cur.execute("SELECT count(*) FROM sorad_shards")
+    if cur.fetchone()[0] == 0:
+        log.info(f"Creating shard catalog at {catalog_path(db_dict['database_path'])}")
+        cur.execute("""INSERT INTO sorad_shards(file, period_start, period_end, first_id, created) VALUES (?, NULL, ?, 1, ?)""",
+                    (os.path.basename(db_dict['database_path']),
+                     datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                     datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+    conn.close()
+    return current_shard(db_dict)
+
+
+def current_shard(db_dict):
+    """Path of the shard that new samples should be written to, creating it at the start of a new period.
+
+    Updates db_dict['file']. Without sharding this is simply db_dict['file'].
+    """
+    period = db_dict.get('shard_period', 'none')
+    if (period == 'none') or ('database_path' not in db_dict):
+        return db_dict['file']
+
+    start, end = shard_period_bounds(period, datetime.datetime.now())
+    path = shard_path(db_dict['database_path'], period, start)
+    if (path == db_dict['file']) and os.path.exists(path):
+        return path
+
+    conn, cur = connect_catalog(db_dict['database_path'])
+    cur.execute("SELECT file FROM sorad_shards WHERE file = ?", (os.path.basename(path),))
+    if (cur.fetchone() is None) or (not os.path.exists(path)):
+        create_shard(conn, cur, db_dict['database_path'], path, start, end)
+    conn.close()
+    db_dict['file'] = path
+    return path
+
+
+def create_shard(conn, cur, database_path, path, period_start, period_end):
+    """Create a new shard file with the same layout as the latest shard and register it in the catalog.
+
+    The id_ sequence continues from the latest shard so that sample ids remain unique across shards.
+    """
+    catalog_dir = os.path.dirname(catalog_path(database_path))
+    cur.execute("SELECT file FROM sorad_shards ORDER BY first_id DESC LIMIT 1")
+    latest = cur.fetchone()
+    schema = []
+    last_id = 0
+    if (latest is not None) and os.path.exists(os.path.join(catalog_dir, latest[0])):
+        prev_conn, prev_cur = connect_db({'file': os.path.join(catalog_dir, latest[0])})
+        prev_cur.execute("""SELECT sql FROM sqlite_master WHERE type = 'table' AND name IN ('sorad_metadata', 'sorad_radiometry') ORDER BY name""")
+        schema = [row[0] for row in prev_cur.fetchall()]
+        prev_cur.execute("SELECT max(id_) FROM sorad_metadata")
+        last_id = prev_cur.fetchone()[0] or 0
+        prev_cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sorad_metadata'")
+        seq = prev_cur.fetchone()
+        if seq is not None:
+            last_id = max(last_id, seq[0])
+        prev_conn.close()
+
+    # an interrupted rotation may have left an unregistered file behind: keep its records and continue after them
+    if not os.path.exists(path):
+        # as in create_tables, auto_vacuum must be set before WAL mode and the first table
+        new_conn = sqlite3.connect(path)
+        new_conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        new_conn.execute('VACUUM')
+        new_conn.close()
+    new_conn, new_cur = connect_db({'file': path})
+    for sql in schema:
+        new_cur.execute(sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+    new_conn.commit()
+    new_conn.close()
+    create_tables({'file': path})
+
+    new_conn, new_cur = connect_db({'file': path})
+    new_cur.execute("SELECT max(id_) FROM sorad_metadata")
+    last_id = max(last_id, new_cur.fetchone()[0] or 0)
+    new_cur.execute("DELETE FROM sqlite_sequence WHERE name = 'sorad_metadata'")
+    new_cur.execute("INSERT INTO sqlite_sequence(name, seq) VALUES ('sorad_metadata', ?)", (last_id,))
+    new_conn.commit()
+    new_conn.close()
+
+    cur.execute("""INSERT OR REPLACE INTO sorad_shards(file, period_start, period_end, first_id, created) VALUES (?, ?, ?, ?, ?)""",
+                (os.path.basename(path),
+                 period_start.strftime('%Y-%m-%d %H:%M:%S'),
+                 period_end.strftime('%Y-%m-%d %H:%M:%S'),
+                 last_id + 1,
+                 datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+    log.info(f"Started new database shard {path}, first sample id {last_id + 1}")
+
+
+def list_shards(db_dict, start_time=None, end_time=None):
+    """Paths of the database files holding samples between start_time and end_time (datetimes, optional), oldest first.
+
+    Without a catalog this is just the configured database file. Shards that have been moved away are skipped.
+    """
+    if not sharding_enabled(db_dict):
+        return [base_path(db_dict)]
+
+    sql = """SELECT file FROM sorad_shards WHERE (period_start IS NULL OR period_start <= ?) AND (period_end IS NULL OR period_end >= ?) ORDER BY first_id ASC"""
+    end_str = '9999-12-31 23:59:59'
+    start_str = '0000-01-01 00:00:00'
+    if end_time is not None:
+        end_str = (end_time + SHARD_MARGIN).strftime('%Y-%m-%d %H:%M:%S')
+    if start_time is not None:
+        start_str = (start_time - SHARD_MARGIN).strftime('%Y-%m-%d %H:%M:%S')
+
+    conn, cur = connect_db_readonly(catalog_path(base_path(db_dict)))
+    cur.execute(sql, (end_str, start_str))
+    files = [row[0] for row in cur.fetchall()]
+    conn.close()
+
+    catalog_dir = os.path.dirname(catalog_path(base_path(db_dict)))
+    shards = []
+    for f in files:
+        path = os.path.join(catalog_dir, f)
+        if os.path.exists(path):
+            shards.append(path)
+        else:
+            log.debug(f"Database shard {path} not found, skipped")
+    return shards
+
+
+def newest_shard(db_dict):
+    """Path of the newest database file, e.g. to read the current column layout. Raises IOError if none is found"""
+    shards = list_shards(db_dict)
+    if len(shards) == 0:
+        raise IOError(f"No database shards found in the catalog {catalog_path(base_path(db_dict))}")
+    return shards[-1]
+
+
+def shard_for_id(db_dict, sample_id):
+    """Path of the database file holding the sample with id_ sample_id"""
+    if not sharding_enabled(db_dict):
+        return base_path(db_dict)
+    conn, cur = connect_db_readonly(catalog_path(base_path(db_dict)))
+    cur.execute("SELECT file FROM sorad_shards WHERE first_id <= ? ORDER BY first_id DESC LIMIT 1", (sample_id,))
+    row = cur.fetchone()
+    conn.close()
+    if row is None:
+        return base_path(db_dict)
+    return os.path.join(os.path.dirname(catalog_path(base_path(db_dict))), row[0])
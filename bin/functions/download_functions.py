@@ -4,148 +4,290 @@
 Data download functions
 
 Support downloads via web interface
-- database dumps for a given timeframe
+- database dumps for a given timeframe, as csv or gzip-compressed csv
 - HDF for a given timeframe
+- hdf and csv datasets per hour or day, appended to as new samples are stored
 """
 
 import os
 import sys
+import gzip
+import json
+import heapq
+import bisect
+import shutil
+import tempfile
 import logging
 import logging.handlers
 import sqlite3
 import datetime
+import multiprocessing
 import functions.db_functions as db_func
+import functions.archive_functions as archive_func
 import h5py
-from numpy import unique, nanmean, argmin, argmax, nan
-from collections import OrderedDict
+from numpy import unique, argmin, argmax, nan, array, bincount
+from collections import OrderedDict, deque
+from rq import get_current_job
 
 log = logging.getLogger('download')
 #log.setLevel('DEBUG')
 
+RECORD_BLOCK_SIZE = 3000  # records read from the database at a time (three per sample) when writing downloads
+HDF_CHUNK_SIZE = 1024     # samples per chunk of hdf datasets
+CSV_BUFFER_SIZE = 2**20   # bytes buffered before writing to a csv file
+CSV_COMPRESSLEVEL = 2     # gzip compression level for .csv.gz files, higher levels are several times slower for a few % smaller files
+CSV_MASKS = ['*.csv', '*.csv.gz']  # downloadable csv files
+HDF_MASKS = ['*.hdf']              # downloadable hdf files
+DATASET_PERIODS = ['none', 'hour', 'day']  # periods covered by the dataset files built as samples come in
+DATASET_FORMATS = ['hdf', 'csv']
+DATASET_CHUNK = datetime.timedelta(days=1)  # part of a long timeframe read and encoded by one worker process
+CHUNKS_IN_FLIGHT = 2                        # chunks queued per worker process
+DATASETS_STATE_FILE = 'datasets_state.json'  # in the storage path, id_ of the last sample added to the datasets per period
+
 
 def hdf_from_web_request(storage_path, database_path,
                          start_time, end_time,
                          platform_id, platform_uuid,
-                         save_if_empty=False):
+                         save_if_empty=False, processes=None):
     """
     Handle an hdf generation request from the web service (via redis queue).
     conf is the config read by configparser containing 'DATABASE' and 'DOWNLOAD' sections
+    processes: number of worker processes reading long timeframes (see encoded_blocks)
     """
     logfilename = os.path.join(storage_path, 'csv_log.txt')
     # make a dummy db_dict just to get db cursor
     db_dict = {'file': database_path}
+    writer = None
 
     try:
         log = init_job_logger(logfilename)
-        conn, cur = db_func.connect_db(db_dict)
+        conn, cur = db_func.connect_db_readonly(db_func.newest_shard(db_dict))  # newest layout
         meta_columns = db_func.column_names(conn, cur, table="sorad_metadata")
         data_columns = db_func.column_names(conn, cur, table="sorad_radiometry")
         conn.close()
 
-        records = identify_records(db_dict, start_time, end_time)
-        if len(records) == 0 and not save_if_empty:
-            log.info(f"No records in timeframe")
-            return
-
-        sets, sensors = parse_records(records, meta_columns, data_columns)
-        if len(sets) == 0 and not save_if_empty:
-            log.info(f"No complete samples in timeframe")
-            return
-
         destination_file = os.path.join(storage_path,
                                         filename_from_dates(platform_id,
                                                             start_time, end_time,
                                                             format='hdf'))
 
-        save_to_hdf(sets, sensors, destination_file, platform_id, platform_uuid)
+        # read, parse and write a block of samples at a time, so memory use does not grow with the time range
+        for block in encoded_blocks(database_path, start_time, end_time, 'hdf', meta_columns, data_columns,
+                                    platform_id, platform_uuid, processes):
+            if writer is None:
+                writer = StreamingHDFWriter(destination_file, platform_id, platform_uuid)
+            writer.write(block)
+
+        if writer is None:
+            if not save_if_empty:
+                log.info(f"No complete samples in timeframe")
+                return
+            writer = StreamingHDFWriter(destination_file, platform_id, platform_uuid)
+        writer.close()
 
         log.info(f"Saved {destination_file}")
 
     except Exception as err:
         log.exception(err)
+        if writer is not None:
+            writer.discard()
 
 
 def save_to_hdf(sets, sensors, destination_file, platform_id, platform_uuid):
     """
     Save records to a hdf format, e.g. for ingestion by HyperCP
     """
-    # create HDF root structure
-    f = h5py.File(destination_file, "w")
-
-    # root attributes
-    # f.attrs["WAVELENGTH_UNITS"] = "nm"
-    f.attrs["LI_UNITS"] = "count"
-    f.attrs["LT_UNITS"] = "count"
-    f.attrs["ES_UNITS"] = "count"
-    #f.attrs["SATPYR_UNITS"] = "count"  # include if needed, but no relation to So-Rad
-    f.attrs["RAW_FILE_NAME"] = ""       # there is no upstream file
-    f.attrs["PROCESSING_LEVEL"] = "0"
-    start_time = [v['gps_time'] for k,v in sets.items()][0]
-    f.attrs["CAST"] = datetime.datetime.strftime(start_time, "%Y%m%d_%H")
-    f.attrs["TIME-STAMP"] = datetime.datetime.strftime(start_time, "%a %b %d %H:%M:%S %Y")
-
-    # metadata group
-    meta = f.create_group("sorad")
-    meta.attrs['PLATFORM_ID'] = platform_id
-    # meta.attrs['CalFileName'] = "n/a"
-    meta.attrs['FrameType'] = 'Not Required'
-
-    # add datasets
-    n_samples = len(sets)
-    meta.create_dataset('DATETAG', data=[v['datetag2'] for k,v in sets.items()], dtype='f')
-    meta.create_dataset('TIMETAG2', data=[v['timetag2'] for k,v in sets.items()], dtype='f')
-    meta.create_dataset('LATITUDE', data=[v['latitude'] for k,v in sets.items()], dtype='f')
-    meta.attrs['LATITUDE_UNITS'] = 'degrees'
-    meta.create_dataset('LONGITUDE', data=[v['longitude'] for k,v in sets.items()], dtype='f')
-    meta.attrs['LONGITUDE_UNITS'] = 'degrees'
-    meta.create_dataset('REL_AZ', data=[v['rel_view_az'] for k,v in sets.items()], dtype='f')
-    meta.attrs['REL_AZ_UNITS'] = 'degrees'
-    meta.create_dataset('TILT', data=[v['tilt_avg'] for k,v in sets.items()], dtype='f')
-    meta.attrs['TILT_UNITS'] = 'degrees'
-    meta.create_dataset('TILT_STD', data=[v['tilt_std'] for k,v in sets.items()], dtype='f')
-    meta.attrs['TILT_STD_UNITS'] = 'degrees'
-    meta.create_dataset('GPS_SPEED', data=[v['gps_speed'] for k,v in sets.items()], dtype='f')
-    meta.attrs['GPS_SPEED_UNITS'] = 'm/s'
-    meta.create_dataset('SAMPLE_UUID', data=[v['sample_uuid'] for k,v in sets.items()], dtype=h5py.string_dtype())
-
-    # Sensor groups
-    # naming convention: ES (ed), LI (LS), LT (lt)
-    LI  = f.create_group(f"SAM_{sensors['ls']}.ini")
-    LI.create_dataset('DATETAG', data=[v['datetag2'] for k,v in sets.items()], dtype='f')
-    LI.create_dataset('TIMETAG2', data=[v['timetag2'] for k,v in sets.items()], dtype='f')
-    LI.attrs['FrameType'] = str(sensors['ls'])
-    LI.attrs['RadianceTerm1'] = 'LI'   # Satlantic naming legacy
-    LI.attrs['RadianceTerm2'] = 'Ls'   # Gordon/Mobley naming legacy
-    LI.create_dataset('L0', data= [v['ls'] for k,v in sets.items()], dtype='i8')
-    LI.attrs['L0_units'] = 'count'
-    LI.create_dataset('INTTIME', data= [v['ls_inttime'] for k,v in sets.items()], dtype='i8')
-    LI.attrs['INTTIME_UNITS'] = 'ms'
-
-    ES  = f.create_group(f"SAM_{sensors['ed']}.ini")
-    ES.create_dataset('DATETAG', data=[v['datetag2'] for k,v in sets.items()], dtype='f')
-    ES.create_dataset('TIMETAG2', data=[v['timetag2'] for k,v in sets.items()], dtype='f')
-    ES.attrs['FrameType'] = str(sensors['ed'])
-    ES.attrs['RadianceTerm1'] = 'ES'   # Satlantic naming legacy
-    ES.attrs['RadianceTerm2'] = 'Ed'   # Gordon/Mobley naming legacy
-    ES.create_dataset('L0', data= [v['ed'] for k,v in sets.items()], dtype='i8')
-    ES.attrs['L0_units'] = 'count'
-    ES.create_dataset('INTTIME', data= [v['ed_inttime'] for k,v in sets.items()], dtype='i8')
-    ES.attrs['INTTIME_UNITS'] = 'ms'
-
-    LT  = f.create_group(f"SAM_{sensors['lt']}.ini")
-    LT.create_dataset('DATETAG', data=[v['datetag2'] for k,v in sets.items()], dtype='f')
-    LT.create_dataset('TIMETAG2', data=[v['timetag2'] for k,v in sets.items()], dtype='f')
-    LT.attrs['FrameType'] = str(sensors['lt'])
-    LT.attrs['RadianceTerm1'] = 'LT'   # Satlantic naming legacy
-    LT.attrs['RadianceTerm2'] = 'Lt'   # Gordon/Mobley naming legacy
-    LT.create_dataset('L0', data= [v['lt'] for k,v in sets.items()], dtype='i8')
-    LT.attrs['L0_units'] = 'count'
-    LT.create_dataset('INTTIME', data= [v['lt_inttime'] for k,v in sets.items()], dtype='i8')
-    LT.attrs['INTTIME_UNITS'] = 'ms'
-
-    # write to file
-    f.attrs["L0_FILENAME"] = os.path.basename(destination_file)
-    f.close()
+    writer = StreamingHDFWriter(destination_file, platform_id, platform_uuid)
+    writer.append(sets)
+    writer.close(sensors)
+
+
+def encode_sets(sets):
+    """
+    Arrays to append to the datasets of a hdf file for measurement sets (OrderedDict as returned by parse_records), see StreamingHDFWriter.write.
+    Samples of which the sensors differ from those of the first sample are skipped.
+    """
+    samples = list(sets.values())
+    if len(samples) == 0:
+        return None
+    sensor_ids = samples[0]['sensor_ids']
+    matching = [v for v in samples if set(v['sensor_ids']) == set(sensor_ids)]
+    if len(matching) < len(samples):
+        log.warning(f"{len(samples) - len(matching)} samples with other sensors than {sensor_ids} skipped.")
+    samples = matching
+
+    meta = {}
+    for name, key in [('DATETAG', 'datetag2'), ('TIMETAG2', 'timetag2'), ('LATITUDE', 'latitude'), ('LONGITUDE', 'longitude'),
+                      ('REL_AZ', 'rel_view_az'), ('TILT', 'tilt_avg'), ('TILT_STD', 'tilt_std'), ('GPS_SPEED', 'gps_speed'),
+                      ('SAMPLE_UUID', 'sample_uuid')]:
+        meta[name] = [v[key] for v in samples]
+
+    sensors = OrderedDict()
+    for sensor_id in sensor_ids:
+        positions = [v['sensor_ids'].index(sensor_id) for v in samples]
+        sensors[sensor_id] = {'L0':        array([v['spectra'][i] for v, i in zip(samples, positions)]),
+                              'INTTIME':   [v['inttimes'][i] for v, i in zip(samples, positions)],
+                              'intensity': sum(v['intensities'][i] for v, i in zip(samples, positions))}
+    return {'start_time': samples[0]['gps_time'], 'n_samples': len(samples), 'meta': meta, 'sensors': sensors}
+
+
+class StreamingHDFWriter(object):
+    """
+    Write measurement sets (see parse_records) to a hdf file in the layout used by HyperCP, a block of samples at a time.
+    Datasets are chunked and resizable, so a file can be written for any time range without holding all samples in memory.
+
+    The file is written under a temporary name and only moved into place by close(), so incomplete files are never
+    offered for download. Which sensor is Lt, Ls or Ed is decided from the intensities of all samples when the file is closed.
+
+    With append=True, samples are appended to a copy of an existing file, which replaces the file when closed, so the
+    file stays complete while it is appended to (see append_to_datasets).
+    """
+    def __init__(self, destination_file, platform_id, platform_uuid, chunk_size=HDF_CHUNK_SIZE, append=False):
+        self.destination_file = destination_file
+        self.partial_file = destination_file + '.part'
+        self.platform_id = platform_id
+        self.platform_uuid = platform_uuid
+        self.chunk_size = chunk_size
+        self.n_samples = 0
+        self.groups = {}     # sensor group by sensor id
+        self.intensity = {}  # summed intensity by sensor id
+        self.appending = append and os.path.exists(destination_file)
+
+        if self.appending:
+            self.resume()
+            return
+
+        # create HDF root structure
+        self.f = h5py.File(self.partial_file, "w")
+
+        # root attributes
+        # self.f.attrs["WAVELENGTH_UNITS"] = "nm"
+        self.f.attrs["LI_UNITS"] = "count"
+        self.f.attrs["LT_UNITS"] = "count"
+        self.f.attrs["ES_UNITS"] = "count"
+        #self.f.attrs["SATPYR_UNITS"] = "count"  # include if needed, but no relation to So-Rad
+        self.f.attrs["RAW_FILE_NAME"] = ""       # there is no upstream file
+        self.f.attrs["PROCESSING_LEVEL"] = "0"
+
+        # metadata group
+        self.meta = self.f.create_group("sorad")
+        self.meta.attrs['PLATFORM_ID'] = platform_id
+        # self.meta.attrs['CalFileName'] = "n/a"
+        self.meta.attrs['FrameType'] = 'Not Required'
+        for name, dtype in [('DATETAG', 'f'), ('TIMETAG2', 'f'), ('LATITUDE', 'f'), ('LONGITUDE', 'f'), ('REL_AZ', 'f'),
+                            ('TILT', 'f'), ('TILT_STD', 'f'), ('GPS_SPEED', 'f'), ('SAMPLE_UUID', h5py.string_dtype())]:
+            self.create_dataset(self.meta, name, dtype)
+        self.meta.attrs['LATITUDE_UNITS'] = 'degrees'
+        self.meta.attrs['LONGITUDE_UNITS'] = 'degrees'
+        self.meta.attrs['REL_AZ_UNITS'] = 'degrees'
+        self.meta.attrs['TILT_UNITS'] = 'degrees'
+        self.meta.attrs['TILT_STD_UNITS'] = 'degrees'
+        self.meta.attrs['GPS_SPEED_UNITS'] = 'm/s'
+
+    def resume(self):
+        """Open a copy of an existing file to append to, and continue from the samples and sensor intensities in it"""
+        shutil.copyfile(self.destination_file, self.partial_file)
+        self.f = h5py.File(self.partial_file, "a")
+        self.meta = self.f["sorad"]
+        self.n_samples = self.meta['SAMPLE_UUID'].shape[0]
+        for name, group in self.f.items():
+            if name.startswith('SAM_'):
+                sensor_id = group.attrs['FrameType']
+                self.groups[sensor_id] = group
+                if 'INTENSITY_SUM' in group.attrs:
+                    self.intensity[sensor_id] = float(group.attrs['INTENSITY_SUM'])
+                else:
+                    # written before the sum was kept in the file
+                    self.intensity[sensor_id] = float((group['L0'][:].mean(axis=1) / group['INTTIME'][:]).sum())
+
+    def create_dataset(self, group, name, dtype, n_pixels=None):
+        """Empty dataset that grows along the first dimension"""
+        shape = (0,) if n_pixels is None else (0, n_pixels)
+        return group.create_dataset(name, shape=shape, maxshape=(None,) + shape[1:], dtype=dtype,
+                                    chunks=(self.chunk_size,) + shape[1:])
+
+    @staticmethod
+    def extend(dataset, values):
+        """Append values to a dataset"""
+        n = dataset.shape[0]
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
+
+    def sensor_group(self, sensor_id, n_pixels):
+        """Group for a sensor, created on first use"""
+        if sensor_id not in self.groups:
+            group = self.f.create_group(f"SAM_{sensor_id}.ini")
+            group.attrs['FrameType'] = str(sensor_id)
+            for name, dtype in [('DATETAG', 'f'), ('TIMETAG2', 'f'), ('INTTIME', 'i8')]:
+                self.create_dataset(group, name, dtype)
+            self.create_dataset(group, 'L0', 'i8', n_pixels)
+            group.attrs['L0_units'] = 'count'
+            group.attrs['INTTIME_UNITS'] = 'ms'
+            self.groups[sensor_id] = group
+            self.intensity[sensor_id] = 0.0
+        return self.groups[sensor_id]
+
+    def append(self, sets):
+        """Append measurement sets (OrderedDict as returned by parse_records) to the file"""
+        self.write(encode_sets(sets))
+
+    def write(self, block):
+        """Append a block of samples encoded with encode_sets to the file"""
+        if (block is None) or (block['n_samples'] == 0):
+            return
+        if self.n_samples == 0:
+            self.f.attrs["CAST"] = datetime.datetime.strftime(block['start_time'], "%Y%m%d_%H")
+            self.f.attrs["TIME-STAMP"] = datetime.datetime.strftime(block['start_time'], "%a %b %d %H:%M:%S %Y")
+
+        # samples of which the sensors do not match the sensors already in the file cannot be added
+        if (len(self.groups) > 0) and (set(block['sensors'].keys()) != set(self.groups.keys())):
+            log.warning(f"{block['n_samples']} samples with other sensors than {list(self.groups.keys())} skipped.")
+            return
+
+        for name, values in block['meta'].items():
+            self.extend(self.meta[name], values)
+
+        # Sensor groups
+        for sensor_id, values in block['sensors'].items():
+            group = self.sensor_group(sensor_id, values['L0'].shape[1])
+            self.extend(group['DATETAG'], block['meta']['DATETAG'])
+            self.extend(group['TIMETAG2'], block['meta']['TIMETAG2'])
+            self.extend(group['L0'], values['L0'])
+            self.extend(group['INTTIME'], values['INTTIME'])
+            self.intensity[sensor_id] += values['intensity']
+        self.n_samples += block['n_samples']
+
+    def close(self, sensors=None):
+        """
+        Finish the file and move it into place. Returns the sensors as identified for the file (see parse_records)
+        sensors: if given, use this identification of Lt, Ls, Ed rather than the intensities of the samples in the file
+        """
+        if (sensors is None) and (len(self.intensity) == 3):
+            # Lt, Ls, Ed in increasing order of intensity
+            ordered = sorted(self.intensity, key=self.intensity.get)
+            sensors = {'lt': ordered[0], 'ls': ordered[1], 'ed': ordered[2]}
+        # naming convention: ES (ed), LI (LS), LT (lt)
+        for key, term1, term2 in [('ls', 'LI', 'Ls'), ('ed', 'ES', 'Ed'), ('lt', 'LT', 'Lt')]:
+            if (sensors is not None) and (sensors.get(key) in self.groups):
+                self.groups[sensors[key]].attrs['RadianceTerm1'] = term1   # Satlantic naming legacy
+                self.groups[sensors[key]].attrs['RadianceTerm2'] = term2   # Gordon/Mobley naming legacy
+
+        # summed intensity of each sensor, to identify the sensors again when samples are appended
+        for sensor_id, group in self.groups.items():
+            group.attrs['INTENSITY_SUM'] = self.intensity[sensor_id]
+
+        # write to file
+        self.f.attrs["L0_FILENAME"] = os.path.basename(self.destination_file)
+        self.f.close()
+        os.replace(self.partial_file, self.destination_file)
+        return sensors
+
+    def discard(self):
+        """Close and remove an incomplete file. A file that was appended to is left as it was"""
+        if self.f.id.valid:
+            self.f.close()
+        if os.path.exists(self.partial_file):
+            os.remove(self.partial_file)
 
 
 def parse_records(records, meta_columns, data_columns):
@@ -155,109 +297,77 @@ def parse_records(records, meta_columns, data_columns):
     records: list of records returned from database
     meta_columns: columns in the sorad_metadata table
     data_columns: column names of the sorad_radiometry table
+
+    Records are grouped by sample in a single pass and all spectra are decoded at once into a
+    (n_samples, 3, n_pixels) array, so the time taken grows linearly with the number of records.
     """
     # identify and harmonize all data types,
     # from the order in which they appear in database columns
     db_columns = meta_columns + data_columns
-
-    uuid_column = db_columns.index('sample_uuid')
-    sample_uuids = [rec[uuid_column] for rec in records]   # list(str)
-    # build dictionary of measurement sets to split out sensor records
-    # and identify Lt, Ed, Ls signals
-    # dict key is the uuid
-    # a little extra work is needed to ensure we maintain the sort order (np.unique does not)
-    unique_sample_uuids = []
-    for sample_uuid in sample_uuids:
-        if sample_uuid not in unique_sample_uuids:
-            unique_sample_uuids.append(sample_uuid)
-
-    sets = OrderedDict.fromkeys(unique_sample_uuids)
-
-    corrupted = []
-
-    for uuid in unique_sample_uuids:
-        if uuid in corrupted:
-            # another record of this sample has been identified as corrupted
+    uuid_ix =        db_columns.index('sample_uuid')
+    sensor_id_ix =   db_columns.index('sensor_id')
+    inttime_ix =     db_columns.index('inttime')
+    spectrum_ix =    db_columns.index('measurement')
+    gps_time_ix =    db_columns.index('gps_time')
+    meta_ix = {key: db_columns.index(column) for key, column in [('latitude', 'gps_lat'), ('longitude', 'gps_long'), ('gps_speed', 'gps_speed'),
+                                                                 ('tilt_avg', 'tilt_avg'), ('tilt_std', 'tilt_std'), ('rel_view_az', 'rel_view_az')]}
+
+    # group record indices by sample uuid, in order of first appearance
+    groups = OrderedDict()
+    for j, rec in enumerate(records):
+        groups.setdefault(rec[uuid_ix], []).append(j)
+
+    # skip incomplete samples
+    complete = OrderedDict()
+    for uuid, indices in groups.items():
+        if len(indices) != 3:
+            log.warning(f"Only {len(indices)} records found with uuid={uuid}, skipping this sample.")
             continue
-
-        # first identify all records with this uuid
-        uuid_set_indices = [j for j, x in enumerate(sample_uuids) if x == uuid]
-        # first record in sample - to grab metadata from
-        r = records[uuid_set_indices[0]]
-
-        # skip incomplete samples
-        if len(uuid_set_indices) != 3:
-            log.warning(f"Only {len(uuid_set_indices)} records found with uuid={uuid}, skipping this sample.")
-            corrupted.append(uuid)
+        complete[uuid] = indices
+
+    sets = OrderedDict()
+    if len(complete) == 0:
+        return sets, {}
+
+    # decode all spectra at once, skip samples with incomplete measurements
+    indices = array([ix for ix in complete.values()], dtype=int)  # (n_samples, 3)
+    spectra, valid = db_func.decode_spectra([records[j][spectrum_ix] for j in indices.ravel()])
+    spectra = spectra.reshape(indices.shape + (spectra.shape[-1],))
+    valid = valid.reshape(indices.shape).all(axis=1)
+    sensor_ids = array([[records[j][sensor_id_ix] for j in ix] for ix in indices], dtype=object)
+    inttimes = array([[records[j][inttime_ix] for j in ix] for ix in indices], dtype=float)
+    # average uncalibrated intensity normalised by integration time to determine signal strength
+    intensities = spectra.mean(axis=2) / inttimes
+
+    rows = []  # rows in the arrays of the samples kept
+    for k, uuid in enumerate(complete.keys()):
+        if not valid[k]:
+            log.warning(f"None values found in at least one uuid={uuid} spectrum, skipping this sample.")
             continue
-
-        # prepare to structure records for this sample
-        sensor_id_ix = db_columns.index('sensor_id')
-        inttime_ix =   db_columns.index('inttime')
-        spectrum_index = db_columns.index('measurement')
-        sensor_ids =   []
-        inttimes =     []
-        spectra =      []
-        intensities =  []
-
-        for j in uuid_set_indices:
-            if uuid in corrupted:
-                continue
-
-            sensor_ids.append(records[j][sensor_id_ix])
-            inttime = records[j][inttime_ix]
-            inttimes.append(inttime)
-
-            spectrum = records[j][spectrum_index] # comma+space-separated string
-            spectrum = spectrum.replace("[","").replace("]","").split(", ")
-            if 'None' in spectrum:
-                # skip incomplete measurements
-                log.warning(f"None values found in at least one uuid={uuid} spectrum, skipping this sample.")
-                corrupted.append(uuid)
-                continue
-            else:
-                spectrum = [int(s) for s in spectrum]
-                spectra.append(spectrum)
-                # get average uncalibrated intensity normalised by integration time to determine signal strength
-                intensities.append(nanmean(spectrum) / float(inttime))
-
         # add measurement set with metadata
-        record_time = datetime.datetime.strptime(r[db_columns.index('gps_time')], '%Y-%m-%d %H:%M:%S.%f')
-
-        if uuid in corrupted:
-            del sets[uuid]
-            continue
-
+        r = records[indices[k, 0]]  # first record in sample - to grab metadata from
+        record_time = datetime.datetime.fromisoformat(r[gps_time_ix])
         sets[uuid] = {'sample_uuid': uuid,
                       'gps_time':    record_time,
                       'datetag2':    float(datetime.datetime.strftime(record_time, '%Y%j')),
                       'timetag2':    float(datetime.datetime.strftime(record_time, "%H%M%S.%f")[:-3]),
-                      'latitude':    r[db_columns.index('gps_lat')],
-                      'longitude':   r[db_columns.index('gps_long')],
-                      'gps_speed':   r[db_columns.index('gps_speed')],
-                      'tilt_avg':    r[db_columns.index('tilt_avg')],
-                      'tilt_std':    r[db_columns.index('tilt_std')],
-                      'rel_view_az': r[db_columns.index('rel_view_az')],
-                      'intensities': intensities,
-                      'sensor_ids':  sensor_ids,
-                      'inttimes':    inttimes,
-                      'spectra':     spectra,
-                      'indices':     uuid_set_indices
+                      'intensities': intensities[k].tolist(),
+                      'sensor_ids':  sensor_ids[k].tolist(),
+                      'inttimes':    [records[j][inttime_ix] for j in indices[k]],
+                      'spectra':     spectra[k],
+                      'indices':     indices[k].tolist()
                      }
-        for key in ['tilt_avg', 'tilt_std', 'rel_view_az']:
-            if sets[uuid][key] is None:
-                sets[uuid][key] = nan
+        rows.append(k)
+        for key, ix in meta_ix.items():
+            sets[uuid][key] = nan if (r[ix] is None) and (key in ['tilt_avg', 'tilt_std', 'rel_view_az']) else r[ix]
 
-    # determine which sensor is Lt, Ls, Ed (increasing order of intensity)
-    sensors_flat =     [x for k,v in sets.items() for x in v['sensor_ids']]
-    intensities_flat = [x for k,v in sets.items() for x in v['intensities']]
-    unique_sensors = unique(sensors_flat)
+    if len(sets) == 0:
+        return sets, {}
 
-    sensor_map = {}
-    for s in unique_sensors:
-        sensor_map[s] = 0
-    for s, i in zip(sensors_flat, intensities_flat):
-        sensor_map[s] += i
+    # determine which sensor is Lt, Ls, Ed (increasing order of intensity)
+    unique_sensors, sensor_index = unique(sensor_ids[rows].astype(str), return_inverse=True)
+    sensor_sum = bincount(sensor_index.ravel(), weights=intensities[rows].ravel(), minlength=len(unique_sensors))
+    sensor_map = dict(zip(unique_sensors, sensor_sum))
 
     sensors = {}
     sensors['lt'] = min(sensor_map, key=sensor_map.get)
@@ -265,54 +375,328 @@ def parse_records(records, meta_columns, data_columns):
     sensors['ls'] = list(set(unique_sensors) - set([sensors['lt'], sensors['ed']]))[0]
 
     # assign radiance signals to sets
-    for uuid in sets.keys():
-        ls_ix = sets[uuid]['sensor_ids'].index(sensors['ls'])
-        lt_ix = sets[uuid]['sensor_ids'].index(sensors['lt'])
-        ed_ix = sets[uuid]['sensor_ids'].index(sensors['ed'])
-        sets[uuid]['ls'] = sets[uuid]['spectra'][ls_ix]
-        sets[uuid]['lt'] = sets[uuid]['spectra'][lt_ix]
-        sets[uuid]['ed'] = sets[uuid]['spectra'][ed_ix]
-        sets[uuid]['ls_inttime'] = sets[uuid]['inttimes'][ls_ix]
-        sets[uuid]['lt_inttime'] = sets[uuid]['inttimes'][lt_ix]
-        sets[uuid]['ed_inttime'] = sets[uuid]['inttimes'][ed_ix]
+    for uuid in list(sets.keys()):
+        s = sets[uuid]
+        ids = s['sensor_ids']
+        if not all(sensors[key] in ids for key in ['ls', 'lt', 'ed']):
+            log.warning(f"Sensors {ids} of uuid={uuid} do not match {list(sensors.values())}, skipping this sample.")
+            del sets[uuid]
+            continue
+        for key in ['ls', 'lt', 'ed']:
+            ix = ids.index(sensors[key])
+            s[key] = s['spectra'][ix]
+            s[f'{key}_inttime'] = s['inttimes'][ix]
     return sets, sensors
 
 
 def csv_from_web_request(storage_path, database_path,
                          start_time, end_time,
                          platform_id, platform_uuid,
-                         save_if_empty=False):
+                         save_if_empty=False, compress=False, processes=None):
     """
     Handle a csv generation request from the web service (via redis queue).
     conf is the config read by configparser containing 'DATABASE' and 'DOWNLOAD' sections
+    compress: write a gzip-compressed file (.csv.gz)
+    processes: number of worker processes reading long timeframes (see encoded_blocks)
     """
     logfilename = os.path.join(storage_path, 'csv_log.txt')
     # make a dummy db_dict just to get db cursor
     db_dict = {'file': database_path}
+    writer = None
 
     try:
         log = init_job_logger(logfilename)
-        conn, cur = db_func.connect_db(db_dict)
+        conn, cur = db_func.connect_db_readonly(db_func.newest_shard(db_dict))  # newest layout
         meta_columns = db_func.column_names(conn, cur, table="sorad_metadata")
         data_columns = db_func.column_names(conn, cur, table="sorad_radiometry")
         conn.close()
 
-        records = identify_records(db_dict, start_time, end_time)
-        if len(records) == 0 and not save_if_empty:
-            log.info(f"No records in timeframe")
-            return
-
         outfile = os.path.join(storage_path,
                                filename_from_dates(platform_id,
                                                    start_time, end_time,
-                                                   format='csv'))
+                                                   format='csv.gz' if compress else 'csv'))
+
+        # read and write a block of records at a time, so memory use does not grow with the time range
+        for data, n_records in encoded_blocks(database_path, start_time, end_time, 'csv.gz' if compress else 'csv',
+                                              meta_columns, data_columns, platform_id, platform_uuid, processes):
+            if writer is None:
+                writer = StreamingCSVWriter(outfile, meta_columns, data_columns, platform_id, platform_uuid)
+            writer.write(data, n_records)
 
-        save_to_csv(records, outfile, meta_columns, data_columns, platform_id, platform_uuid)
+        if writer is None:
+            if not save_if_empty:
+                log.info(f"No records in timeframe")
+                return
+            writer = StreamingCSVWriter(outfile, meta_columns, data_columns, platform_id, platform_uuid)
+        writer.close()
 
-        log.info(f"Saved {outfile}")
+        log.info(f"Saved {outfile} ({writer.n_records} records)")
 
     except Exception as err:
-        print(err)
+        log.exception(err)
+        if writer is not None:
+            writer.discard()
+
+
+def encoded_blocks(database_path, start_time, end_time, format, meta_columns, data_columns,
+                   platform_id, platform_uuid, processes=None):
+    """
+    Blocks of samples in a timeframe encoded for a hdf or csv file (see iter_encoded), in order of gps time.
+
+    Long timeframes are split in chunks of DATASET_CHUNK which are read and encoded by a pool of worker processes
+    (by default one less than there are cores, leaving a core for the writer and the main application), while the
+    caller writes the blocks of finished chunks to a single file. Chunks are queued a few at a time, so memory use does
+    not grow with the time range.
+    Archived samples are sorted into the chunks first, in a single pass over the archive files (see spool_archive).
+    Progress is reported to the rq job running this (see report_progress).
+    """
+    chunks = time_chunks(start_time, end_time)
+    processes = min(processes or max((os.cpu_count() or 1) - 1, 1), len(chunks))
+    report_progress(0, len(chunks))
+    spool_dir = None
+    spools = [None] * len(chunks)
+    if len(archive_func.archive_files(database_path, start_time, end_time)) > 0:
+        spool_dir = tempfile.TemporaryDirectory(prefix='download_', dir=archive_func.archive_dir(database_path))
+        spools = spool_archive(database_path, chunks, spool_dir.name)
+    args = [(database_path, chunk_start, chunk_end, exclusive_end, format, meta_columns, data_columns, platform_id, platform_uuid, spool)
+            for (chunk_start, chunk_end, exclusive_end), spool in zip(chunks, spools)]
+
+    try:
+        if processes <= 1:
+            for n, chunk_args in enumerate(args):
+                yield from iter_encoded(*chunk_args)
+                report_progress(n + 1, len(chunks))
+            return
+
+        log.info(f"Encoding {len(chunks)} chunks of {start_time} - {end_time} in {processes} processes")
+        with multiprocessing.Pool(processes) as pool:
+            pending = deque()
+            queued = 0
+            for n in range(len(chunks)):
+                while (queued < len(chunks)) and (len(pending) < CHUNKS_IN_FLIGHT * processes):
+                    pending.append(pool.apply_async(encode_chunk, (args[queued],)))
+                    queued += 1
+                yield from pending.popleft().get()
+                report_progress(n + 1, len(chunks))
+    finally:
+        if spool_dir is not None:
+            spool_dir.cleanup()
+
+
+def time_chunks(start_time, end_time, chunk=None):
+    """Timeframe split in consecutive (start, end, exclusive_end) chunks. Only the last chunk includes samples at its end time"""
+    chunk = chunk or DATASET_CHUNK
+    chunks = []
+    chunk_start = start_time
+    while chunk_start + chunk < end_time:
+        chunks.append((chunk_start, chunk_start + chunk, True))
+        chunk_start += chunk
+    chunks.append((chunk_start, end_time, False))
+    return chunks
+
+
+def spool_archive(database_path, chunks, directory):
+    """
+    Archived samples of consecutive chunks of a timeframe (see time_chunks), read in a single pass over the archive files
+    and written to a file per chunk in directory, one json object per line.
+    Returns the file of each chunk, None for chunks without archived samples.
+    """
+    starts = [chunk_start.strftime('%Y-%m-%d %H:%M:%S') for chunk_start, _, _ in chunks]
+    spools = [None] * len(chunks)
+    current, sf = None, None
+    try:
+        for sample in archive_func.read_archive(database_path, chunks[0][0], chunks[-1][1]):
+            i = bisect.bisect_right(starts, sample['meta'].get('gps_time', sample['meta'].get('gps1_time'))) - 1
+            if i != current:
+                if sf is not None:
+                    sf.close()
+                spools[i] = os.path.join(directory, f"chunk_{i}.jsonl")
+                sf = open(spools[i], 'a')
+                current = i
+            sf.write(json.dumps(sample) + '\n')
+    finally:
+        if sf is not None:
+            sf.close()
+    return spools
+
+
+def read_spool(path):
+    """Archived samples written by spool_archive, none if path is None"""
+    if path is None:
+        return
+    with open(path, 'r') as sf:
+        for line in sf:
+            yield json.loads(line)
+
+
+def iter_encoded(database_path, start_time, end_time, exclusive_end, format, meta_columns, data_columns, platform_id, platform_uuid,
+                 archive_spool=None):
+    """
+    Blocks of samples in a timeframe, read from the database (see iter_records) and encoded for a file in the given format:
+    for hdf as returned by encode_sets, for csv and csv.gz as (bytes, number of records) from encode_csv_records.
+    Archived samples are only read from archive_spool (see spool_archive), if given.
+    """
+    db_dict = {'file': database_path}
+    spectrum_index = (meta_columns + data_columns).index('measurement')
+    prefix = ",".join([platform_id, platform_uuid]) + ","
+    for records in iter_records(db_dict, start_time, end_time, exclusive_end=exclusive_end, archived=read_spool(archive_spool)):
+        if format == 'hdf':
+            sets, sensors = parse_records(records, meta_columns, data_columns)
+            if len(sets) > 0:
+                yield encode_sets(sets)
+        else:
+            yield encode_csv_records(records, spectrum_index, prefix, compress=format.endswith('.gz')), len(records)
+
+
+def encode_chunk(args):
+    """All encoded blocks of a chunk of a timeframe (see iter_encoded), in a worker process"""
+    return list(iter_encoded(*args))
+
+
+def report_progress(done, total):
+    """Save the progress of the rq job running this (if any) in its meta data, as shown by dataset_functions.queue_info"""
+    job = get_current_job()
+    if job is not None:
+        job.meta['progress'] = round(100.0 * done / max(total, 1), 1)
+        job.save_meta()
+
+
+def append_to_datasets(storage_path, database_path, platform_id, platform_uuid, after_id,
+                       period='day', formats=DATASET_FORMATS, compress=False, state_file=None):
+    """
+    Append complete samples stored after the sample with id_ after_id to the dataset files (hdf and/or csv) of the
+    period (hour or day) in which they were recorded. Files are created as needed and are appended to through
+    copies that replace them at the end of the call, so the file of the current period can be downloaded at any time
+    while it grows.
+    state_file: where to save the id_ of the last sample appended to every format, also when a later block cannot be
+    parsed, so the next call continues after it instead of appending the same samples again. If writing a block fails,
+    the files are left as they were before the call.
+    Returns the id_ of the last sample appended (after_id if there were none).
+    """
+    db_dict = {'file': database_path}
+    conn, cur = db_func.connect_db_readonly(db_func.newest_shard(db_dict))  # newest layout
+    meta_columns = db_func.column_names(conn, cur, table="sorad_metadata")
+    data_columns = db_func.column_names(conn, cur, table="sorad_radiometry")
+    conn.close()
+    id_ix = meta_columns.index('id_')
+    time_ix = meta_columns.index('gps_time')
+
+    writers = {}  # (format, period start) -> writer
+    bounds = {}   # period bounds by hour of gps time
+    last_id = after_id
+    n_records = 0
+    writing = False  # while appending a block to the files
+
+    def writer(fmt, start, end):
+        if (fmt, start) not in writers:
+            filename = os.path.join(storage_path, filename_from_dates(platform_id, start, end - datetime.timedelta(seconds=1),
+                                                                      format=fmt))
+            if fmt == 'hdf':
+                writers[(fmt, start)] = StreamingHDFWriter(filename, platform_id, platform_uuid, append=True)
+            else:
+                writers[(fmt, start)] = StreamingCSVWriter(filename, meta_columns, data_columns, platform_id, platform_uuid, append=True)
+        return writers[(fmt, start)]
+
+    try:
+        for records in iter_new_records(db_dict, after_id):
+            # split the block by period of gps time
+            periods = OrderedDict()
+            for record in records:
+                hour = record[time_ix][:13]
+                if hour not in bounds:
+                    bounds[hour] = dataset_period_bounds(period, datetime.datetime.fromisoformat(record[time_ix]))
+                periods.setdefault(bounds[hour], []).append(record)
+
+            # parse the whole block before writing any of it, so a block that cannot be parsed is left out of every format
+            appends = []
+            for (start, end), period_records in periods.items():
+                if 'hdf' in formats:
+                    sets, sensors = parse_records(period_records, meta_columns, data_columns)
+                    if len(sets) > 0:
+                        appends.append((writer('hdf', start, end), sets))
+                if 'csv' in formats:
+                    appends.append((writer('csv.gz' if compress else 'csv', start, end), period_records))
+            writing = True
+            for w, data in appends:
+                w.append(data)
+            writing = False
+            last_id = records[-1][id_ix]
+            n_records += len(records)
+    except Exception:
+        if writing:
+            # part of a block is in the copies being appended to, so leave every file as it was before this call
+            for w in writers.values():
+                w.discard()
+            writers.clear()
+            last_id = after_id
+        raise
+    finally:
+        for w in writers.values():
+            w.close()
+        if state_file is not None and last_id != after_id:
+            save_datasets_state(state_file, last_id)
+
+    if n_records > 0:
+        log.info(f"{n_records} records appended to {len(writers)} dataset files, up to sample {last_id}")
+    return last_id
+
+
+def save_datasets_state(state_file, last_id):
+    """Save the id_ of the last sample appended to the datasets (see update_datasets)"""
+    with open(state_file + '.tmp', 'w') as sf:
+        json.dump({'last_id': last_id, 'updated': datetime.datetime.now().isoformat()}, sf)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def update_datasets(storage_path, database_path, platform_id, platform_uuid, period='day', formats=DATASET_FORMATS, compress=False):
+    """
+    Handle a dataset update request from the datasets manager (via redis queue): append samples stored since the last
+    update to the datasets of their period (see append_to_datasets), and save the id_ of the last sample appended in the
+    state file in storage_path. Without a state file, datasets start from the current period.
+    """
+    logfilename = os.path.join(storage_path, 'csv_log.txt')
+    state_file = os.path.join(storage_path, DATASETS_STATE_FILE)
+
+    try:
+        log = init_job_logger(logfilename)
+        try:
+            with open(state_file) as sf:
+                after_id = json.load(sf)['last_id']
+        except (OSError, ValueError, KeyError):
+            period_start, _ = dataset_period_bounds(period, datetime.datetime.now())
+            log.info(f"No dataset state found at {state_file}, starting datasets from {period_start.isoformat()}")
+            after_id = last_id_before(database_path, period_start)
+
+        append_to_datasets(storage_path, database_path, platform_id, platform_uuid, after_id,
+                           period=period, formats=formats, compress=compress, state_file=state_file)
+
+    except Exception as err:
+        log.exception(err)
+
+
+def dataset_period_bounds(period, when):
+    """Start and end (exclusive) of the dataset period (hour or day) containing datetime when"""
+    if period == 'hour':
+        start = when.replace(minute=0, second=0, microsecond=0)
+        return start, start + datetime.timedelta(hours=1)
+    elif period == 'day':
+        start = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        return start, start + datetime.timedelta(days=1)
+    raise ValueError("dataset_period {0} not recognized. Choose from {1}".format(period, ", ".join(DATASET_PERIODS)))
+
+
+def last_id_before(database_path, end_time):
+    """id_ of the last sample recorded before end_time (0 if there is none), e.g. to start appending to datasets from then"""
+    db_dict = {'file': database_path}
+    end_str = datetime.datetime.strftime(end_time, '%Y-%m-%d %H:%M:%S')
+    for shard in reversed(db_func.list_shards(db_dict, end_time=end_time)):
+        conn, cur = db_func.connect_db_readonly(shard)
+        cur.execute("SELECT MAX(id_) FROM sorad_metadata WHERE gps_time < ?", (end_str,))
+        row = cur.fetchone()
+        conn.close()
+        if row[0] is not None:
+            return row[0]
+    return 0
 
 
 def filename_from_dates(platform_id, start_time, end_time, format='csv'):
@@ -327,33 +711,96 @@ def save_to_csv(records, destination_file, meta_columns, data_columns, platform_
     """
     Save records to a csv file
     """
-    # adapt header to database columns
-    header = ",".join([platform_id, platform_uuid] + meta_columns + data_columns)
+    writer = StreamingCSVWriter(destination_file, meta_columns, data_columns, platform_id, platform_uuid)
+    writer.append(records)
+    writer.close()
 
-    with open(destination_file, 'w') as op:
-        op.write(header + '\n')
-        for r in records:
-             dataline = ",".join([platform_id, platform_uuid] + \
-                                 [str(v).replace("[","").replace("]","") for v in r])
-             op.write(dataline + '\n')
+
+class StreamingCSVWriter(object):
+    """
+    Write database records to a csv file, a block of records at a time, through a large write buffer.
+    Files named *.gz are gzip-compressed, each block as a separate gzip member (a gzip file may hold several members,
+    which are read as one stream), so blocks can be compressed in other processes than the one writing the file.
+
+    Each line holds the platform id and uuid followed by the metadata and radiometry columns, with the spectrum written
+    out as comma-separated pixel counts. As with hdf files, the file is only moved into place by close().
+
+    With append=True, records are appended to a copy of an existing file, as with hdf files.
+    """
+    def __init__(self, destination_file, meta_columns, data_columns, platform_id, platform_uuid, append=False):
+        self.destination_file = destination_file
+        self.partial_file = destination_file + '.part'
+        self.prefix = ",".join([platform_id, platform_uuid]) + ","
+        self.spectrum_index = (meta_columns + data_columns).index('measurement')
+        self.compress = destination_file.endswith('.gz')
+        self.n_records = 0
+        self.appending = append and os.path.exists(destination_file)
+        if self.appending:
+            shutil.copyfile(destination_file, self.partial_file)
+
+        self.f = open(self.partial_file, 'ab' if self.appending else 'wb', buffering=CSV_BUFFER_SIZE)
+        if not self.appending:
+            # adapt header to database columns
+            header = ",".join([platform_id, platform_uuid] + meta_columns + data_columns) + '\n'
+            self.f.write(gzip.compress(header.encode(), CSV_COMPRESSLEVEL) if self.compress else header.encode())
+
+    def append(self, records):
+        """Append database records (as returned by iter_records) to the file"""
+        self.write(encode_csv_records(records, self.spectrum_index, self.prefix, self.compress), len(records))
+
+    def write(self, data, n_records):
+        """Append n_records database records encoded with encode_csv_records to the file"""
+        self.f.write(data)
+        self.n_records += n_records
+
+    def close(self):
+        """Finish the file and move it into place"""
+        self.f.close()
+        os.replace(self.partial_file, self.destination_file)
+
+    def discard(self):
+        """Close and remove an incomplete file. A file that was appended to is left as it was"""
+        self.f.close()
+        if os.path.exists(self.partial_file):
+            os.remove(self.partial_file)
+
+
+def encode_csv_records(records, spectrum_index, prefix, compress=False):
+    """Lines of a csv file (see StreamingCSVWriter) for database records, as bytes. compress: as a gzip member"""
+    lines = []
+    for r in records:
+        r = list(r)
+        r[spectrum_index] = db_func.spectrum_as_text(r[spectrum_index])
+        lines.append(prefix + ",".join(map(str, r)).replace("[", "").replace("]", "") + '\n')
+    data = "".join(lines).encode()
+    return gzip.compress(data, CSV_COMPRESSLEVEL) if compress else data
 
 
 def identify_records(db_dict, start_time=None, end_time=None):
     """
-    Collect information on database records within a given timeframe
+    Collect information on database records within a given timeframe, from any database shards covering it
     """
-    conn, cur = db_func.connect_db(db_dict)
-    conn.set_trace_callback(log.info)
+    returned = [record for records in iter_records(db_dict, start_time, end_time) for record in records]
+    log.info(f"{len(returned)} complete records returned from database.")
+    return returned
 
+
+def iter_records(db_dict, start_time=None, end_time=None, block_size=RECORD_BLOCK_SIZE, exclusive_end=False, archived=None):
+    """
+    Database records within a given timeframe, from any database shards covering it and from the archive, in order of gps time.
+    Records are read with fetchmany and returned in blocks of about block_size records. The records of a sample are never split between blocks.
+    exclusive_end: leave out samples recorded at end_time, e.g. when the timeframe is followed by another one starting at end_time
+    archived: archived samples in the timeframe (e.g. from read_spool), instead of reading them from the archive files
+    """
     # query records in timeframe
     # SELECT gps_time FROM sorad_metadata WHERE gps_time BETWEEN '2025-09-30 08:00:00' and '2025-09-30 12:00:00'
-    sql = """SELECT meta.*, rad.*
+    sql = f"""SELECT meta.*, rad.*
               FROM sorad_metadata meta
                LEFT JOIN sorad_radiometry rad
                 ON rad.metadata_id = meta.id_
              WHERE meta.n_rad_obs = 3
-              AND meta.gps_time BETWEEN ? and ?
-             ORDER BY meta.gps_time ASC
+              AND meta.gps_time >= ? AND meta.gps_time {'<' if exclusive_end else '<='} ?
+             ORDER BY meta.gps_time ASC, meta.id_ ASC
            """
     try:
         assert isinstance(start_time, datetime.datetime)
@@ -364,12 +811,95 @@ def identify_records(db_dict, start_time=None, end_time=None):
     start_str = datetime.datetime.strftime(start_time, '%Y-%m-%d %H:%M:%S')
     end_str = datetime.datetime.strftime(end_time, '%Y-%m-%d %H:%M:%S')
 
-    cur.execute(sql, (start_str, end_str))
-    returned = cur.fetchall()
+    conn, cur = db_func.connect_db_readonly(db_func.newest_shard(db_dict))
+    meta_columns = db_func.column_names(conn, cur, table="sorad_metadata")
+    data_columns = db_func.column_names(conn, cur, table="sorad_radiometry")
     conn.close()
-    log.info(f"{len(returned)} complete records returned from database.")
+    time_ix = meta_columns.index('gps_time')
+    uuid_ix = meta_columns.index('sample_uuid') if 'sample_uuid' in meta_columns else meta_columns.index('id_')
+
+    def shard_records(shard):
+        conn, cur = db_func.connect_db_readonly(shard)
+        conn.set_trace_callback(log.info)
+        try:
+            cur.execute(sql, (start_str, end_str))
+            while True:
+                rows = cur.fetchmany(block_size)
+                if len(rows) == 0:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    sources = [shard_records(shard) for shard in db_func.list_shards(db_dict, start_time, end_time)]
+
+    # samples moved out of the live database
+    if archived is None:
+        archived = archive_func.read_archive(db_func.base_path(db_dict), start_time, end_time)
+    archived_records = []
+    n_archived = 0
+    for sample in archived:
+        if (sample['meta'].get('n_rad_obs') != 3) or (exclusive_end and (sample['meta'].get('gps_time', '') >= end_str)):
+            continue
+        meta = tuple(sample['meta'].get(c) for c in meta_columns)
+        archived_records += [meta + tuple(rad.get(c) for c in data_columns) for rad in sample['radiometry']]
+        n_archived += 1
+    if n_archived > 0:
+        archived_records.sort(key=lambda r: r[time_ix])
+        sources.append(iter(archived_records))
+        log.info(f"{n_archived} samples read from archive.")
 
-    return returned
+    yield from sample_blocks(heapq.merge(*sources, key=lambda r: r[time_ix]), uuid_ix, block_size)
+
+
+def iter_new_records(db_dict, after_id=0, block_size=RECORD_BLOCK_SIZE):
+    """
+    Database records of complete samples stored after the sample with id_ after_id, in order of id_ (the order in which samples were stored).
+    Records are returned in blocks as in iter_records.
+    """
+    sql = """SELECT meta.*, rad.*
+              FROM sorad_metadata meta
+               LEFT JOIN sorad_radiometry rad
+                ON rad.metadata_id = meta.id_
+             WHERE meta.n_rad_obs = 3
+              AND meta.id_ > ?
+             ORDER BY meta.id_ ASC
+           """
+    # sample ids increase over consecutive shards, so only the shard holding the next sample and any later shards are read
+    shards = db_func.list_shards(db_dict)
+    first = db_func.shard_for_id(db_dict, after_id + 1)
+    if first in shards:
+        shards = shards[shards.index(first):]
+
+    def shard_records(shard):
+        conn, cur = db_func.connect_db_readonly(shard)
+        try:
+            cur.execute(sql, (after_id,))
+            while True:
+                rows = cur.fetchmany(block_size)
+                if len(rows) == 0:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    conn, cur = db_func.connect_db_readonly(db_func.newest_shard(db_dict))
+    id_ix = db_func.column_names(conn, cur, table="sorad_metadata").index('id_')
+    conn.close()
+    records = (record for shard in shards for record in shard_records(shard))
+    yield from sample_blocks(records, id_ix, block_size)
+
+
+def sample_blocks(records, uuid_ix, block_size=RECORD_BLOCK_SIZE):
+    """Group records in blocks of about block_size records, without splitting the records of a sample (same value at uuid_ix)"""
+    block = []
+    for record in records:
+        if (len(block) >= block_size) and (record[uuid_ix] != block[-1][uuid_ix]):
+            yield block
+            block = []
+        block.append(record)
+    if len(block) > 0:
+        yield block
 
 
 def init_job_logger(logfilepath):
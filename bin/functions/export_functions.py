@@ -11,13 +11,16 @@ If called from command line without the force_manual attribute (specifying how m
   this script will run in test-mode, showing whether any records remain to be uploaded and checking connectivity to local and remote data stores.
 
 Note: it is possible for this process to create a database lock, so it should be timed not to interfere with creation of new records.
-If the main app is locked out of the databse it will ignore and recover but the new record will be lost.
+New records are written by the database writer thread (thread_managers/database_manager.py) which retries until the lock clears.
+If the writer thread is disabled and the main app is locked out of the database, the new record will be lost.
 Similarly, this process will only try a few times to update the database to mark a record as uploaded.
 
 When run as part of the main_app loop, it is advisable to include a limit on the number of records to process: your ship might be approaching shore, and have a poor data connection at first.
 While uploads are still slow and possibly time out, it would be nice to continue taking measurements. There will be plenty of time to upload all the buffered data on subsequent cycles, or once the ship is in port.
 
 The recommended (and currently implemented) way to run this code is on small data batches whenever the main program loop needs to wait anyway.
+Unless export_batch_size is set to 0, the records of several samples are sent in a single request to the Parse /batch endpoint, which
+saves a round trip per record on high-latency connections. The server reports success or failure for each record in the batch.
 
 The config-local.ini file will provide any keys required to access the remote store. These should be kept out of system logs.
 """
@@ -30,17 +33,32 @@ import sqlite3
 import argparse
 import json
 import uuid
+import gzip
+import base64
+import queue
+import threading
+import concurrent.futures
 import requests
+import urllib.parse
 from . import db_functions as db_func
+from . import http_functions as http
 from numpy import unique
 import time
 import datetime
 #from requests_toolbelt.utils import dump
 
-TIMEOUT=5  # timeout for getting a response on data upload. 
-TIMEOUT_SHORT = 1 # timeout for getting response on connectivity tests, status queries
 
 log = logging.getLogger('export')
+
+# encodings of uploaded records (export_encoding in the config file):
+#  json: plain json, spectra as text (the str(list) representation)
+#  json_gzip: as json, with the request body compressed (Content-Encoding: gzip)
+#  packed_gzip: as json_gzip, with spectra as base64-encoded little-endian uint16, marked by measurement_encoding
+EXPORT_ENCODINGS = ['json', 'json_gzip', 'packed_gzip']
+MEASUREMENT_ENCODINGS = {'text': 'text', 'uint16': 'uint16le_base64'}
+
+# defaults for the retry of failed uploads, see db_functions.update_export_state
+RETRY_DEFAULTS = {'export_retry_interval_sec': 60, 'export_retry_interval_max_sec': 86400, 'export_max_attempts': 10}
 #log.setLevel('DEBUG')
 
 def run_export(export_config_dict, db, limit=1, test_run=True, version=None, update_local=True, fail_limit=10):
@@ -63,14 +81,10 @@ def run_export(export_config_dict, db, limit=1, test_run=True, version=None, upd
         return export_result, response_code, successes
 
     if db['add_sample_uuid']:
-        log.debug("Adding sample_uuid")
-        # match records to add a single sample_uuid to records with identical metadata_id
-        i = db['header'].index('metadata_id')
-        meta_ids = unique([record[i] for record in records])
-        sample_uuids = dict(zip(meta_ids, [str(uuid.uuid1()) for m in meta_ids]))
-        db['header'].append('sample_uuid')
-        for j, record in enumerate(records):
-            records[j] = record + (sample_uuids[record[i]],)
+        add_sample_uuids(db, records)
+
+    if export_config_dict.get('export_batch_size', 0) > 0:
+        return run_batch_export(export_config_dict, db, records, test_run, update_local, fail_limit)
 
     for i, record in enumerate(records):
         record_json = add_metadata(export_config_dict, record, db)  # add metadata and return json
@@ -91,11 +105,11 @@ def run_export(export_config_dict, db, limit=1, test_run=True, version=None, upd
             log.debug(f"{i}/{len(records)} Record {json.loads(record_json)['id_']} uploaded succesfully")
             successes += 1
             if update_local:
-                update_local_db(db, json.loads(record_json)['id_'], export_result, record_json, test_run)
+                update_local_db(db, json.loads(record_json)['id_'], export_result, record_json, test_run, retry_settings(export_config_dict))
 
         else:
             log.debug("Data upload failed, try again later")
-            update_local_db(db, json.loads(record_json)['id_'], export_result, record_json)
+            update_local_db(db, json.loads(record_json)['id_'], export_result, record_json, retry=retry_settings(export_config_dict))
             failures += 1
             if failures >= fail_limit:
                 return export_result, response_code, successes
@@ -104,41 +118,356 @@ def run_export(export_config_dict, db, limit=1, test_run=True, version=None, upd
     return export_result, response_code, successes
 
 
-def update_local_db(db, metadata_id, export_result, record_json, test_run=False):
+def run_batch_export(export_config_dict, db, records, test_run=True, update_local=True, fail_limit=10):
     """
-    update the local db once a record export attempt has been completed. Try to access the local database several times to circumvent temporary locks.
+    Upload records in batch requests of up to export_batch_size samples each (all records of a sample go in the same request).
+    The export status of each sample is updated from the results for its records: a sample is uploaded if all its records were.
+    """
+    batch_size = export_config_dict['export_batch_size']
+    samples = group_samples(export_config_dict, db, records)
+    sample_ids = list(samples.keys())
+
+    successes = 0
+    failures = 0
+    export_result = None
+    response_code = None
+    for i in range(0, len(sample_ids), batch_size):
+        batch = {metadata_id: samples[metadata_id] for metadata_id in sample_ids[i:i+batch_size]}
+        log.debug(f"Batch of {len(batch)} samples containing {sum(len(r) for r in batch.values())} records: {list(batch.keys())}")
+        if test_run:
+            continue
+
+        sample_results, n_uploaded, n_failed, response_code = upload_samples(export_config_dict, batch)
+        log.debug(f"Remote server response was: {response_code}")
+        successes += n_uploaded
+        failures += n_failed
+        export_result = n_failed == 0
+
+        update_local_db_batch(db, [(metadata_id, result, samples[metadata_id][0]) for metadata_id, result in sample_results.items()
+                                   if update_local or not result], retry=retry_settings(export_config_dict))
+
+        if not export_result:
+            log.debug(f"Upload of {n_failed}/{n_uploaded + n_failed} records in batch failed, try again later")
+            if failures >= fail_limit:
+                break
+
+    return export_result, response_code, successes
+
+
+class UploadPool(object):
+    """Threads uploading batches of samples for run_export_pipeline.
+    Keep one pool for as long as uploads continue: each thread keeps its HTTP sessions (http_functions.get_session),
+    and so its connections to the server, between export cycles. close() closes the sessions and stops the threads."""
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.n_threads = 0
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export-upload',
+                                                              initializer=self.count_thread)
+
+    def count_thread(self):
+        with self.lock:
+            self.n_threads += 1
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def close(self):
+        with self.lock:
+            n_threads = self.n_threads
+        if n_threads > 0:
+            # one task per thread: each task holds its thread until all threads have closed their sessions
+            barrier = threading.Barrier(n_threads)
+
+            def close_sessions():
+                http.close_sessions()
+                try:
+                    barrier.wait(timeout=10)
+                except threading.BrokenBarrierError:
+                    log.warning("HTTP sessions of some upload threads were not closed")
+
+            for _ in range(n_threads):
+                self.executor.submit(close_sessions)
+        self.executor.shutdown(wait=True)
+
+
+def run_export_pipeline(export_config_dict, db, limit=None, concurrency=1, fail_limit=10, should_stop=None, on_commit=None, link=None, since=None, pool=None):
+    """
+    Upload pending samples with three stages running concurrently:
+    - a reader thread prefetches pending samples from the database and groups them into upload batches: new samples (above
+      the export cursor) newest first, then samples of which an earlier upload failed and that are due for another attempt
+    - up to `concurrency` batches are uploaded at the same time, by a pool of threads
+    - a committer thread writes the result of each upload back to the database, so database writes stay in a single thread
+
+    Ordering: samples are read newest first, but batches in flight at the same time may complete (and reach the remote server)
+    in any order. New samples are read once per call, and failed samples are only retried once they are due (after a backoff),
+    so a failing sample does not hold up the others.
+    Delivery is at least once: a sample is only marked as uploaded after the server has confirmed it. If the program stops
+    between the confirmation and the database update, or the server stored a batch but the response was lost, the sample will
+    be uploaded again on a later cycle.
+
+    :limit int: maximum number of samples to upload, None to continue until no pending samples remain
+    :fail_limit int: stop reading new samples once this many records have failed to upload
+    :should_stop function: called regularly, stop reading new samples when it returns True
+    :on_commit function: called with the number of records uploaded and failed after each batch is written back
+    :link AdaptiveLink: if given, batch size, concurrency and timeouts follow the measured link quality (see link_functions.py)
+    :since datetime: if given, only samples recorded at or after this time are uploaded
+    :pool UploadPool: upload threads to use, with at least the maximum concurrency. Without a pool, one is created for this call
+    returns export result (True if all uploads succeeded, None if there was nothing to upload) and number of records uploaded
+    """
+    batch_size = max(export_config_dict.get('export_batch_size', 0), 1)
+    concurrency = max(concurrency, 1)
+    max_concurrency = concurrency if link is None else link.concurrency_max
+    read_queue = queue.Queue(maxsize=max_concurrency)  # batches of samples prefetched, waiting for an upload slot
+    commit_queue = queue.Queue()                       # upload results waiting to be written to the database
+    slots = threading.Condition()                      # uploads in flight
+    in_flight = [0]
+    stop = threading.Event()
+    totals = {'uploaded': 0, 'failed': 0}
+
+    def current_batch_size():
+        if (link is None) or (export_config_dict.get('export_batch_size', 0) == 0):
+            return batch_size
+        return link.batch_size
+
+    def current_concurrency():
+        return concurrency if link is None else link.concurrency
+
+    def reader():
+        try:
+            read_batches()
+        except Exception as err:
+            log.exception(err)
+        finally:
+            read_queue.put(None)
+
+    def read_batches():
+        n_read = 0
+        for retry in [False, True]:  # new samples first, then failed samples due for another attempt
+            before_id = None  # continue below the samples already read, pending samples are not read twice
+            while not stop.is_set():
+                chunk = current_batch_size() * current_concurrency()
+                if limit is not None:
+                    chunk = min(chunk, limit - n_read)
+                if chunk <= 0:
+                    return
+                records = identify_export_records(db, limit=chunk, before_id=before_id, retry=retry, since=since)
+                if len(records) == 0:
+                    break
+                if db['add_sample_uuid']:
+                    add_sample_uuids(db, records)
+                samples = group_samples(export_config_dict, db, records)
+                sample_ids = sorted(samples.keys(), reverse=True)
+                before_id = sample_ids[-1]
+                n_read += len(sample_ids)
+                i = 0
+                while i < len(sample_ids):
+                    size = current_batch_size()
+                    batch = {metadata_id: samples[metadata_id] for metadata_id in sample_ids[i:i+size]}
+                    i += size
+                    while not stop.is_set():
+                        try:
+                            read_queue.put(batch, timeout=0.5)
+                            break
+                        except queue.Full:
+                            if (should_stop is not None) and should_stop():
+                                stop.set()
+
+    def upload(batch):
+        try:
+            sample_results, n_uploaded, n_failed, response_code = upload_samples(export_config_dict, batch, link)
+            log.debug(f"{n_uploaded} records uploaded, {n_failed} failed. Remote server response was: {response_code}")
+        except Exception as err:
+            log.warning(f"Unhandled exception while uploading data batch: {err}")
+            sample_results = {metadata_id: False for metadata_id in batch}
+            n_uploaded, n_failed = 0, sum(len(r) for r in batch.values())
+        commit_queue.put((batch, sample_results, n_uploaded, n_failed))
+        with slots:
+            in_flight[0] -= 1
+            slots.notify()
+
+    def committer():
+        connections = {}  # kept open for the whole run, sqlite connections can only be used by the thread that opened them
+        try:
+            commit_results(connections)
+        finally:
+            for conn, cur in connections.values():
+                conn.close()
+
+    def commit_results(connections):
+        while True:
+            item = commit_queue.get()
+            if item is None:
+                break
+            batch, sample_results, n_uploaded, n_failed = item
+            try:
+                update_local_db_batch(db, [(metadata_id, result, batch[metadata_id][0]) for metadata_id, result in sample_results.items()],
+                                      retry=retry_settings(export_config_dict), connections=connections)
+            except Exception as err:
+                log.warning(f"Export status of records {list(sample_results.keys())} not updated: {err}")
+            totals['uploaded'] += n_uploaded
+            totals['failed'] += n_failed
+            if totals['failed'] >= fail_limit:
+                stop.set()
+            if on_commit is not None:
+                on_commit(n_uploaded, n_failed)
+
+    reader_thread = threading.Thread(target=reader, name='export-reader')
+    committer_thread = threading.Thread(target=committer, name='export-committer')
+    reader_thread.start()
+    committer_thread.start()
+    own_pool = pool is None
+    if own_pool:
+        pool = UploadPool(max_concurrency)
+    uploads = []
+    try:
+        while True:
+            batch = read_queue.get()
+            if batch is None:
+                break
+            if (should_stop is not None) and should_stop():
+                stop.set()
+            if stop.is_set():
+                continue  # let the reader finish
+            with slots:
+                slots.wait_for(lambda: in_flight[0] < current_concurrency())
+                in_flight[0] += 1
+            uploads.append(pool.submit(upload, batch))
+        concurrent.futures.wait(uploads)
+    finally:
+        if own_pool:
+            pool.close()
+    reader_thread.join()
+    commit_queue.put(None)
+    committer_thread.join()
+
+    if totals['uploaded'] + totals['failed'] == 0:
+        return None, 0
+    return totals['failed'] == 0, totals['uploaded']
+
+
+def retry_settings(export_config_dict):
+    """Retry settings for update_local_db from the export configuration"""
+    settings = {key: export_config_dict.get(key, default) for key, default in RETRY_DEFAULTS.items()}
+    return {'retry_interval': settings['export_retry_interval_sec'],
+            'retry_interval_max': settings['export_retry_interval_max_sec'],
+            'max_attempts': settings['export_max_attempts']}
+
+
+def add_sample_uuids(db, records):
+    """match records to add a single sample_uuid to records with identical metadata_id (databases without sample_uuid)"""
+    log.debug("Adding sample_uuid")
+    i = db['header'].index('metadata_id')
+    meta_ids = unique([record[i] for record in records])
+    sample_uuids = dict(zip(meta_ids, [str(uuid.uuid1()) for m in meta_ids]))
+    if 'sample_uuid' not in db['header']:
+        db['header'].append('sample_uuid')
+    for j, record in enumerate(records):
+        records[j] = record + (sample_uuids[record[i]],)
+
+
+def group_samples(export_config_dict, db, records):
+    """Add metadata to records and group them by sample. Returns a dictionary of metadata id_: json records, in the order retrieved"""
+    samples = {}
+    for record in records:
+        record_json = add_metadata(export_config_dict, record, db)  # add metadata and return json
+        samples.setdefault(json.loads(record_json)['id_'], []).append(record_json)
+    return samples
+
+
+def upload_samples(export_config_dict, samples, link=None):
+    """
+    Upload the records of one or more samples ({metadata id_: json records}), in a single batch request if export_batch_size is set.
+    Returns the result per sample (True if all its records were uploaded), the number of records uploaded and failed, and the last response code
+    If a link (link_functions.AdaptiveLink) is given, its timeout is used and the duration and outcome of each request are reported to it.
+    """
+    records = [(metadata_id, record_json) for metadata_id, record_jsons in samples.items() for record_json in record_jsons]
+    if export_config_dict.get('export_batch_size', 0) > 0:
+        requests_made = [[record_json for _, record_json in records]]
+    else:
+        requests_made = [[record_json] for _, record_json in records]
+    results = []
+    for json_records in requests_made:
+        n_bytes = sum(len(record_json) for record_json in json_records)
+        timeout = None if link is None else link.timeout(n_bytes)
+        t0 = time.perf_counter()
+        if export_config_dict.get('export_batch_size', 0) > 0:
+            request_results, response_code, response = export_batch_to_parse_server(export_config_dict, json_records, timeout)
+        else:
+            result, response_code, response = export_to_parse_server(export_config_dict, json_records[0], timeout)
+            request_results = [result]
+        if link is not None:
+            # the link failed if there was no response or a server error, rejected records do not count
+            link.record(time.perf_counter() - t0, n_bytes, (response_code is not None) and (response_code < 500))
+        results += request_results
+    sample_results = {metadata_id: True for metadata_id in samples}
+    for (metadata_id, _), result in zip(records, results):
+        sample_results[metadata_id] = sample_results[metadata_id] and result
+    return sample_results, sum(results), len(results) - sum(results), response_code
+
+
+def update_local_db(db, metadata_id, export_result, record_json, test_run=False, retry=None):
+    """
+    update the local db once a record export attempt has been completed. See update_local_db_batch.
+    """
+    update_local_db_batch(db, [(metadata_id, export_result, record_json)], test_run, retry)
+
+
+def update_local_db_batch(db, results, test_run=False, retry=None, connections=None):
+    """
+    update the local db with the results of export attempts [(metadata_id, export_result, record_json)], in a single transaction per database file.
+    The export state is updated as well: failed samples are scheduled for another attempt according to the retry settings (see retry_settings).
+    If the database is locked, the transaction is retried a few times with increasing waits.
+
+    :connections dict: open database connections by file, for reuse between calls from the same thread. Connections are opened as needed
+                       and left open for the caller to close. Without it, connections are opened and closed here.
     """
     log = logging.getLogger('export.updatelocaldb')
-    rec = json.loads(record_json)
-    conn, cur = db_func.connect_db(db)
-    record_dict = json.loads(record_json)
     attempts_field= db['export_attempts_field']
     success_field = db['export_success_field']
-    attempts = rec[attempts_field]
-    if attempts is None:
-        attempts = 1
-    else:
-        attempts = int(attempts) + 1
-    log.debug(f"update record {metadata_id} with attempts {rec[attempts_field]} -> {attempts} and succes={export_result}")
-    sql_update = f"""UPDATE sorad_metadata SET {success_field} = ?, {attempts_field} = {attempts} WHERE id_ = ?"""
+    sql_update = f"""UPDATE sorad_metadata SET {success_field} = ?, {attempts_field} = ? WHERE id_ = ?"""
 
-    db_update_attempt = 0
-    done = False
-    while (not done) and (db_update_attempt < 5):
-        try:
-            if test_run:
-                cur.execute(sql_update, (export_result, metadata_id))
-                conn.rollback()
-            else:
-                cur.execute(sql_update, (export_result, metadata_id))
-                conn.commit()
-                done = True
-                log.debug(f"Updated local db record {metadata_id}")
-        except Exception as msg:
-            log.warning(msg)
-            time.sleep(0.2) * db_update_attempt**2
-            db_update_attempt += 1
-    conn.close()
+    by_shard = {}
+    for metadata_id, export_result, record_json in results:
+        attempts = json.loads(record_json)[attempts_field]
+        if attempts is None:
+            attempts = 1
+        else:
+            attempts = int(attempts) + 1
+        log.debug(f"update record {metadata_id} with attempts -> {attempts} and succes={export_result}")
+        by_shard.setdefault(db_func.shard_for_id(db, metadata_id), []).append((metadata_id, export_result, attempts))
+
+    close_connections = connections is None
+    if connections is None:
+        connections = {}
+    for shard, shard_results in by_shard.items():
+        for db_update_attempt in range(5):
+            try:
+                if shard not in connections:
+                    connections[shard] = db_func.connect_db({'file': shard})
+                conn, cur = connections[shard]
+                db_func.create_export_state(conn, cur)  # shards created by older software versions
+                cur.executemany(sql_update, [(export_result, attempts, metadata_id) for metadata_id, export_result, attempts in shard_results])
+                db_func.update_export_state(conn, cur, shard_results, **(retry or {}))
+                db_func.advance_export_cursor(conn, cur)
+                if test_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                    log.debug(f"Updated {len(shard_results)} local db record(s) in {os.path.basename(shard)}")
+                break
+            except sqlite3.OperationalError as msg:
+                # typically a lock held by another process, try again a little later
+                log.warning(f"{msg}, attempt {db_update_attempt + 1}")
+                if shard in connections:
+                    connections[shard][0].rollback()
+                time.sleep(0.2 * 2**db_update_attempt)
+        else:
+            log.warning(f"Export status of {len(shard_results)} record(s) in {os.path.basename(shard)} not updated")
+
+    if close_connections:
+        for conn, cur in connections.values():
+            conn.close()
     return
 
 
@@ -146,6 +475,21 @@ def add_metadata(export_config_dict, record, db):
     """make complete data record"""
     record_as_dict = dict(zip(db['header'], record))
 
+    # the remote store receives spectra in text format regardless of local storage format, unless packed spectra are requested
+    if 'measurement' in record_as_dict:
+        if export_config_dict.get('export_encoding', 'json') == 'packed_gzip':
+            measurement, spectrum_format = db_func.encode_spectrum(record_as_dict['measurement'], 'uint16')
+            if spectrum_format == db_func.SPECTRUM_FORMATS['uint16']:
+                record_as_dict['measurement'] = base64.b64encode(bytes(measurement)).decode('ascii')
+                record_as_dict['measurement_encoding'] = MEASUREMENT_ENCODINGS['uint16']
+            else:
+                # incomplete spectra cannot be packed
+                record_as_dict['measurement'] = db_func.spectrum_as_text(measurement)
+                record_as_dict['measurement_encoding'] = MEASUREMENT_ENCODINGS['text']
+        else:
+            record_as_dict['measurement'] = db_func.spectrum_as_text(record_as_dict['measurement'])
+    record_as_dict.pop('spectrum_format', None)
+
     # metadata from export section of config (operator-defined)
     record_as_dict['content']           = "observation"
     record_as_dict['platform_id']       = export_config_dict['platform_id']
@@ -187,8 +531,16 @@ def add_metadata(export_config_dict, record, db):
     return json_record
 
 
-def export_to_parse_server(export_config_dict, json_record):
-    """attempt to upload a record to a remote Parse server"""
+def request_body(export_config_dict, json_text, headers):
+    """Request body for a json text, gzip-compressed if the export encoding asks for it (headers are updated accordingly)"""
+    if export_config_dict.get('export_encoding', 'json') == 'json':
+        return json_text
+    headers['Content-Encoding'] = 'gzip'
+    return gzip.compress(json_text.encode('utf-8'), compresslevel=6)
+
+
+def export_to_parse_server(export_config_dict, json_record, timeout=None):
+    """attempt to upload a record to a remote Parse server. timeout in seconds overrides the default for uploads"""
     parse_app_url = export_config_dict['parse_url']  # something like https://1.2.3.4:port/parse/classes/sorad
     parse_app_id = export_config_dict['parse_app_id']  # ask the parse server admin for this key
     parse_clientkey = export_config_dict['parse_clientkey']
@@ -197,7 +549,8 @@ def export_to_parse_server(export_config_dict, json_record):
                'X-Parse-Client-Key': parse_clientkey}
 
     try:
-        response = requests.post(parse_app_url, data=json_record, headers=headers, timeout=TIMEOUT)  # timeout of 1.5 seconds prevents main program loop from getting stuck too long
+        response = http.post(parse_app_url, 'upload', data=request_body(export_config_dict, json_record, headers), headers=headers,
+                             **({} if timeout is None else {'timeout': timeout}))  # timeout prevents main program loop from getting stuck too long
         if (response.status_code >= 200) and (response.status_code < 300):
             return True, response.status_code, response
         else:
@@ -212,6 +565,55 @@ def export_to_parse_server(export_config_dict, json_record):
         return False, None, None
 
 
+def parse_batch_url(parse_url):
+    """Batch endpoint and object path on a Parse server, from the class url (https://1.2.3.4:port/parse/classes/sorad)
+    returns ('https://1.2.3.4:port/parse/batch', '/parse/classes/sorad')"""
+    url = urllib.parse.urlsplit(parse_url)
+    mount_path = url.path.split('/classes/')[0]
+    return urllib.parse.urlunsplit((url.scheme, url.netloc, mount_path + '/batch', '', '')), url.path
+
+
+def export_batch_to_parse_server(export_config_dict, json_records, timeout=None):
+    """attempt to upload several records to a remote Parse server in a single batch request. timeout in seconds overrides the default.
+    Returns the result per record (in order), the response status code and the response"""
+    batch_url, object_path = parse_batch_url(export_config_dict['parse_url'])
+    parse_app_id = export_config_dict['parse_app_id']  # ask the parse server admin for this key
+    parse_clientkey = export_config_dict['parse_clientkey']
+    headers = {'content-type': 'application/json',
+               'X-Parse-Application-Id': parse_app_id,
+               'X-Parse-Client-Key': parse_clientkey}
+    # records are already json, no need to parse and serialise them again
+    path = json.dumps(object_path)
+    batch_json = '{"requests": [' + ', '.join(['{"method": "POST", "path": ' + path + ', "body": ' + json_record + '}'
+                                              for json_record in json_records]) + ']}'
+    failed = [False] * len(json_records)
+
+    try:
+        response = http.post(batch_url, 'batch_upload', data=request_body(export_config_dict, batch_json, headers), headers=headers,
+                             **({} if timeout is None else {'timeout': timeout}))
+    except requests.exceptions.ReadTimeout:
+        log.warning("Timeout while uploading data batch to remote server")
+        return failed, None, None
+    except Exception as err:
+        log.warning("Unhandled exception while uploading data batch to remote server")
+        return failed, None, None
+
+    if (response.status_code < 200) or (response.status_code > 299):
+        return failed, response.status_code, response
+    try:
+        # one result per request, in the same order: {"success": {"objectId": ..}} or {"error": {"code": .., "error": ..}}
+        results = response.json()
+        if len(results) != len(json_records):
+            raise ValueError(f"{len(results)} results for {len(json_records)} records")
+    except ValueError as err:
+        log.warning(f"Unexpected response to data batch upload: {err}")
+        return failed, response.status_code, response
+    for result in results:
+        if 'error' in result:
+            log.debug(f"Record upload failed: {result['error']}")
+    return ['success' in result for result in results], response.status_code, response
+
+
 def update_on_parse_server(export_config_dict, json_record, objectId):
     """attempt to upload a record to a remote Parse server"""
     parse_app_url = export_config_dict['parse_url'] + f"/{objectId}"   # something like https://1.2.3.4:port/parse/classes/sorad/dfjwf3df
@@ -222,7 +624,7 @@ def update_on_parse_server(export_config_dict, json_record, objectId):
                'X-Parse-Client-Key': parse_clientkey}
 
     try:
-        response = requests.put(parse_app_url, data=json_record, headers=headers, timeout=TIMEOUT)
+        response = http.put(parse_app_url, 'status_update', data=json_record, headers=headers)
         if (response.status_code >= 200) and (response.status_code < 300):
             return True, response.status_code
         else:
@@ -235,8 +637,13 @@ def update_on_parse_server(export_config_dict, json_record, objectId):
         return False, None
 
 
-def update_status_parse_server(export_config_dict, db):
-    "Update latest status update on Parse server. A status update has the 'content' field set to 'status' and only contains a metadata record"
+def update_status_parse_server(export_config_dict, db, object_id=None):
+    """
+    Update latest status update on Parse server. A status update has the 'content' field set to 'status' and only contains a metadata record
+    If the objectId of the status record is known (from an earlier call), it is updated directly. Otherwise, or if that record no longer
+    exists, the latest status record of the platform is looked up first, or created if there is none.
+    Returns export result, response code and the objectId of the status record (None if not known)
+    """
 
     parse_app_url = export_config_dict['parse_url']  # something like https://1.2.3.4:port/parse/classes/sorad
     parse_app_id = export_config_dict['parse_app_id']  # ask the parse server admin for this key and store it in local-config.ini
@@ -246,30 +653,21 @@ def update_status_parse_server(export_config_dict, db):
                'X-Parse-Application-Id': parse_app_id,
                'X-Parse-Client-Key': parse_clientkey}
 
-    data =   json.dumps({"where":{"platform_id":platform_id, "content": "status"}, "order": "-updatedAt", "limit": 1, "keys": "updatedAt,gps_time,pc_time"})
-    try:
-        response = requests.get(parse_app_url, data=data, headers=headers, timeout=TIMEOUT_SHORT)
-        if (response.status_code < 200) or (response.status_code) > 299:
-            # the request failed this time
-            return False, None
-    except requests.exceptions.ReadTimeout:
-        log.warning("Timeout while getting status record from remote server")
-        return False, None
-    except:
-        log.warning("Unhandled exception while getting status record from remote server")
-        return False, None
-
     # collect data from local db
     sql_meta = """SELECT * FROM sorad_metadata meta ORDER BY meta.id_ DESC LIMIT 1"""
-    conn, cur = db_func.connect_db(db)
-    cur.execute(sql_meta)
-    meta_local = cur.fetchall()  # list containing only the latest local db record, if any
-    conn.close()
+    meta_local = []
+    for shard in reversed(db_func.list_shards(db)):  # a new shard may not have any records yet
+        conn, cur = db_func.connect_db({'file': shard})
+        cur.execute(sql_meta)
+        meta_local = cur.fetchall()  # list containing only the latest local db record, if any
+        conn.close()
+        if len(meta_local) > 0:
+            break
     if len(meta_local) > 0:
         meta_local = meta_local[0] # latest local db record
     else:
         # no data in local database
-        return False, None
+        return False, None, object_id
 
     meta_as_dict = dict(zip(db['header_meta'], meta_local))
     meta_as_dict['content']           = "status"
@@ -303,6 +701,25 @@ def update_status_parse_server(export_config_dict, db):
 
     meta_json = json.dumps(meta_as_dict)
 
+    if object_id is not None:
+        export_result, resultcode = update_on_parse_server(export_config_dict, meta_json, object_id)
+        if resultcode != 404:
+            return export_result, resultcode, object_id
+        log.debug(f"Status record {object_id} not found on remote server, looking up the latest one")
+
+    data =   json.dumps({"where":{"platform_id":platform_id, "content": "status"}, "order": "-updatedAt", "limit": 1, "keys": "updatedAt,gps_time,pc_time"})
+    try:
+        response = http.get(parse_app_url, 'status_query', data=data, headers=headers)
+        if (response.status_code < 200) or (response.status_code) > 299:
+            # the request failed this time
+            return False, None, None
+    except requests.exceptions.ReadTimeout:
+        log.warning("Timeout while getting status record from remote server")
+        return False, None, None
+    except:
+        log.warning("Unhandled exception while getting status record from remote server")
+        return False, None, None
+
     # inspect the remote server response
     response = response.json()
     if len(response['results']) == 0:
@@ -310,32 +727,97 @@ def update_status_parse_server(export_config_dict, db):
         export_result, resultcode, response = export_to_parse_server(export_config_dict, meta_json)
         if not export_result:
             log.debug("Status record creation failed, try again later")
+            object_id = None
         else:
             log.debug("New status record created at remote store")
+            object_id = response.json().get('objectId')
 
     else:
         # get time of last update and corresponding objectID and update with latest system info
         response = response['results'][0]
         last_update = datetime.datetime.strptime(response['updatedAt'], '%Y-%m-%dT%H:%M:%S.%fZ')
-        objectId = response['objectId']
-        log.debug(f"Last update record on remote server ID {objectId} at {last_update} (server time)")
-        export_result, resultcode = update_on_parse_server(export_config_dict, meta_json, objectId)
+        object_id = response['objectId']
+        log.debug(f"Last update record on remote server ID {object_id} at {last_update} (server time)")
+        export_result, resultcode = update_on_parse_server(export_config_dict, meta_json, object_id)
+
+    return export_result, resultcode, object_id
+
+
+def identify_export_records(db, limit=10, before_id=None, retry=False, since=None):
+    """Records (metadata + radiometry) of up to limit samples to upload next, from the export state of each shard (newest first).
+    These are new samples above the export cursor or, with retry=True, samples of which an upload failed and that are due for another attempt.
+    See db_functions.create_export_state. Only samples below before_id and recorded at or after since (datetime) are included, if given."""
+    log = logging.getLogger('export.scanlocal')
+    records = []
+    n_samples = 0
+    for shard in reversed(db_func.list_shards(db, start_time=since)):
+        if n_samples >= limit:
+            break
+        conn, cur = db_func.connect_db({'file': shard})
+        db_func.create_export_state(conn, cur)  # shards created by older software versions
+        conn.commit()
+        meta_ids = db_func.pending_export_ids(conn, cur, limit - n_samples, before_id, retry, since)
+        if len(meta_ids) > 0:
+            log.debug(f"retrieving {len(meta_ids)} {'failed' if retry else 'new'} sample(s) from {os.path.basename(shard)}")
+            cur.execute(f"""SELECT * FROM sorad_radiometry rad INNER JOIN sorad_metadata meta ON meta.id_ = rad.metadata_id
+                            WHERE rad.metadata_id IN ({','.join('?' * len(meta_ids))})""", meta_ids)
+            records += cur.fetchall()
+            n_samples += len(meta_ids)
+        conn.close()
+    return records
+
+
+def identify_new_local_records(db, limit=10, version=None, before_id=None):
+    """report on total and new (not uploaded) records, latest record. Shards are scanned newest first, until the limit is reached
+    :before_id int: only retrieve records of samples older than this id_ (to continue where a previous call left off)"""
+    log = logging.getLogger('export.scanlocal')
+
+    n_total = 0
+    n_not_inserted = 0
+    n_samples = 0  # samples retrieved so far, each consisting of several radiometry records
+    all_not_inserted = None if limit == 0 else []
+    for shard in reversed(db_func.list_shards(db)):
+        shard_limit = None if limit is None else max(limit - n_samples, 0)
+        n_shard_total, n_shard_not_inserted, shard_not_inserted = identify_new_shard_records(db, shard, shard_limit, version, before_id)
+        n_total += n_shard_total
+        n_not_inserted += n_shard_not_inserted
+        if shard_not_inserted is not None:
+            all_not_inserted += shard_not_inserted
+            n_samples += len(set([r[0] for r in shard_not_inserted]))  # metadata_id
+
+    return n_total, n_not_inserted, all_not_inserted
+
 
-    return export_result, resultcode
+def count_uploadable_records(db):
+    """Number of samples pending upload that are due for an attempt: pending samples, less those that are no longer
+    retried or are waiting for their next attempt (see db_functions.export_held_back_count)"""
+    n_uploadable = 0
+    for shard in db_func.list_shards(db):
+        _, n_not_inserted, _ = identify_new_shard_records(db, shard, limit=0)
+        conn, cur = db_func.connect_db({'file': shard})
+        n_uploadable += max(n_not_inserted - db_func.export_held_back_count(conn, cur), 0)
+        conn.close()
+    return n_uploadable
 
 
-def identify_new_local_records(db, limit=10, version=None):
-    """report on total and new (not uploaded) records, latest record"""
+def identify_new_shard_records(db, shard, limit=10, version=None, before_id=None):
+    """report on total and new (not uploaded) records, latest record, in a single database file"""
     log = logging.getLogger('export.scanlocal')
 
     n_total = 0
     n_uploaded = 0
-    conn, cur = db_func.connect_db(db)
+    conn, cur = db_func.connect_db({'file': shard})
+
+    # number of radiometry samples in database, and of those pending upload, maintained by triggers
+    counts = db_func.export_counts(conn, cur)
 
     # query number of radiometry samples in database
-    sql_n_total = """SELECT count(*) FROM sorad_metadata WHERE n_rad_obs > 0"""
-    cur.execute(sql_n_total)
-    n_total = cur.fetchone()[0]
+    if counts is not None:
+        n_total = counts[0]
+    else:
+        sql_n_total = """SELECT count(*) FROM sorad_metadata WHERE n_rad_obs > 0"""
+        cur.execute(sql_n_total)
+        n_total = cur.fetchone()[0]
 
     # query number of radiometry samples in database with specific software version
     if version is not None:
@@ -359,22 +841,30 @@ def identify_new_local_records(db, limit=10, version=None):
         sql_n_not_inserted = """SELECT count(*) FROM sorad_metadata WHERE n_rad_obs > 0 AND ({success} IS NULL OR {success}=0)""".\
                              format(success=db['export_success_field'], version=version)
 
-    cur.execute(sql_n_not_inserted)
-    n_not_inserted = cur.fetchone()[0]
+    if (version is None) and (counts is not None):
+        n_not_inserted = counts[1]
+    else:
+        cur.execute(sql_n_not_inserted)
+        n_not_inserted = cur.fetchone()[0]
     if limit is None:
         limit = n_not_inserted
     if limit == 0:
        # skip retrieving any records, just return db stats
+       conn.close()
        return n_total, n_not_inserted, None
+    if n_not_inserted == 0:
+       conn.close()
+       return n_total, n_not_inserted, []
 
     # query records not yet uploaded, youngest records first up to any specified limit. Includes metadata + radiometry
     #  can we try records with a high number of export tries, last? To prevent getting stuck on a possibly corrupt record?
+    before = "" if before_id is None else f"AND meta.id_ < {int(before_id)}"
     if version is not None:
-        sql_meta = """SELECT meta.id_ FROM sorad_metadata meta WHERE meta.n_rad_obs > 0 AND ({success} IS NULL OR {success}=0) AND sorad_version = {version} ORDER BY meta.id_ DESC LIMIT ?""".\
-                   format(success=db['export_success_field'], version=version)
+        sql_meta = """SELECT meta.id_ FROM sorad_metadata meta WHERE meta.n_rad_obs > 0 AND ({success} IS NULL OR {success}=0) AND sorad_version = {version} {before} ORDER BY meta.id_ DESC LIMIT ?""".\
+                   format(success=db['export_success_field'], version=version, before=before)
     else:
-        sql_meta = """SELECT meta.id_ FROM sorad_metadata meta WHERE meta.n_rad_obs > 0 AND ({success} IS NULL OR {success}=0) ORDER BY meta.id_ DESC LIMIT ?""".\
-                   format(success=db['export_success_field'])
+        sql_meta = """SELECT meta.id_ FROM sorad_metadata meta WHERE meta.n_rad_obs > 0 AND ({success} IS NULL OR {success}=0) {before} ORDER BY meta.id_ DESC LIMIT ?""".\
+                   format(success=db['export_success_field'], before=before)
 
     cur.execute(sql_meta, (limit,))
     meta_ids = cur.fetchall()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP Functions
+
+Shared HTTP client for data export, status updates and connectivity checks.
+
+Each thread gets its own long-lived requests.Session, so connections to the remote server are kept alive and reused
+between requests instead of paying a new TCP and TLS handshake on every upload. Retries with backoff are handled
+by urllib3: failed connections are retried for all requests (the request never reached the server), read errors and
+server errors only for requests that are safe to repeat (GET, PUT), so uploads are not duplicated.
+
+Traffic is counted by type of request, so that uploads can be kept within a data allowance (see budget_functions.py).
+"""
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger('http')
+
+POOL_CONNECTIONS = 4  # number of hosts to keep connections to
+POOL_MAXSIZE = 4      # connections kept alive per host
+
+# timeout in seconds and retry policy by type of request
+ENDPOINTS = {'upload':         {'timeout': 5.0,  'retries': 'default'},  # single record upload
+             'batch_upload':   {'timeout': 30.0, 'retries': 'default'},  # upload of a batch of samples
+             'status_query':   {'timeout': 1.0,  'retries': 'default'},  # query for the latest status record
+             'status_update':  {'timeout': 5.0,  'retries': 'default'},  # update of the status record
+             'remote_check':   {'timeout': 5.0,  'retries': 'default'},  # connectivity to remote data store
+             'internet_check': {'timeout': 0.5,  'retries': 'none'}}     # quick internet connectivity test
+
+local = threading.local()  # sessions of the current thread, by retry policy
+traffic_counts = {}        # bytes sent and received by type of request, in all threads
+traffic_lock = threading.Lock()
+
+
+def retry_policy(name):
+    """urllib3 Retry configuration by name"""
+    if name == 'none':
+        return Retry(total=0, read=False)
+    settings = dict(total=3, connect=3, read=1, status=2, backoff_factor=0.5,
+                    status_forcelist=(429, 502, 503, 504), raise_on_status=False, respect_retry_after_header=False)
+    try:
+        return Retry(allowed_methods=frozenset(['GET', 'PUT', 'HEAD']), **settings)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(['GET', 'PUT', 'HEAD']), **settings)
+
+
+def get_session(retries='default'):
+    """Session of the current thread, created on first use"""
+    if not hasattr(local, 'sessions'):
+        local.sessions = {}
+    if retries not in local.sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry_policy(retries))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        local.sessions[retries] = session
+        log.debug(f"New HTTP session ({retries} retry policy) in thread {threading.current_thread().name}")
+    return local.sessions[retries]
+
+
+def close_sessions():
+    """Close the sessions (and pooled connections) of the current thread"""
+    for session in getattr(local, 'sessions', {}).values():
+        session.close()
+    local.sessions = {}
+
+
+def count_traffic(endpoint, n_sent, n_received):
+    with traffic_lock:
+        counts = traffic_counts.setdefault(endpoint, {'sent': 0, 'received': 0, 'requests': 0})
+        counts['sent'] += n_sent
+        counts['received'] += n_received
+        counts['requests'] += 1
+
+
+def traffic(endpoint=None):
+    """Total bytes sent and received so far (request line, headers and bodies), for one type of request or all of them"""
+    with traffic_lock:
+        return sum(counts['sent'] + counts['received'] for name, counts in traffic_counts.items() if endpoint in [None, name])
+
+
+def request_count(endpoint=None):
+    """Number of requests made so far, of one type or all of them"""
+    with traffic_lock:
+        return sum(counts['requests'] for name, counts in traffic_counts.items() if endpoint in [None, name])
+
+
+def message_size(start_line, headers, body):
+    """Approximate size in bytes of an HTTP message"""
+    size = len(start_line) + 2 + sum(len(key) + len(value) + 4 for key, value in headers.items()) + 2
+    if body is not None:
+        size += len(body)
+    return size
+
+
+def request(method, url, endpoint, **kwargs):
+    """Send a request using the timeout and retry policy of the endpoint type. Raises requests exceptions like requests.request"""
+    settings = ENDPOINTS[endpoint]
+    kwargs.setdefault('timeout', settings['timeout'])
+    try:
+        response = get_session(settings['retries']).request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        # the request may have been sent without a response, count it as sent
+        count_traffic(endpoint, message_size(f"{method} {url} HTTP/1.1", kwargs.get('headers') or {}, kwargs.get('data')), 0)
+        raise
+    sent = message_size(f"{method} {response.request.path_url} HTTP/1.1", response.request.headers, response.request.body)
+    received = message_size(f"HTTP/1.1 {response.status_code} {response.reason or ''}", response.headers, response.content)
+    count_traffic(endpoint, sent, received)
+    return response
+
+
+def get(url, endpoint, **kwargs):
+    return request('GET', url, endpoint, **kwargs)
+
+
+def post(url, endpoint, **kwargs):
+    return request('POST', url, endpoint, **kwargs)
+
+
+def put(url, endpoint, **kwargs):
+    return request('PUT', url, endpoint, **kwargs)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Journal Functions
+
+Append-only journal for records that could not be written to the database (e.g. while it is locked).
+Each entry is a complete record (metadata and spectra, as made by db_functions.make_record), stored as
+a frame of [length, crc32, pickled record]. A frame that was only partly written (e.g. power loss) is
+detected by its length or checksum and ignored, together with anything after it.
+Records are merged back into the database by db_functions.replay_journal.
+"""
+import os
+import struct
+import pickle
+import zlib
+import logging
+import threading
+
+log = logging.getLogger('journal')
+
+FRAME_HEADER = struct.Struct('<II')  # payload length, crc32 of payload
+journal_lock = threading.Lock()  # journals are appended to by the database writer and the main loop
+
+
+def journal_path(database_path):
+    """Location of the journal belonging to a (base) database path"""
+    root, ext = os.path.splitext(database_path)
+    return root + '.journal'
+
+
+def encode_frames(records):
+    """Records as journal frames"""
+    frames = []
+    for record in records:
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        frames.append(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)))
+        frames.append(payload)
+    return b''.join(frames)
+
+
+def append_records(path, records):
+    """Append records to the journal at path. The whole batch is flushed to disk with a single fsync"""
+    data = encode_frames(records)
+    with journal_lock:
+        with open(path, 'ab') as jf:
+            jf.write(data)
+            jf.flush()
+            os.fsync(jf.fileno())
+    log.debug(f"{len(records)} record(s) appended to {path}")
+
+
+def read_records(path):
+    """Return all complete records in the journal at path"""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, 'rb') as jf:
+        data = jf.read()
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(data):
+        length, crc = FRAME_HEADER.unpack_from(data, offset)
+        payload = data[offset + FRAME_HEADER.size: offset + FRAME_HEADER.size + length]
+        if (len(payload) < length) or (zlib.crc32(payload) != crc):
+            break
+        records.append(pickle.loads(payload))
+        offset += FRAME_HEADER.size + length
+    if offset < len(data):
+        log.warning(f"Ignored {len(data) - offset} bytes of incomplete or corrupt data at the end of {path}")
+    return records
+
+
+def take_journal(path):
+    """Move the journal aside for replay, so that new records can be appended while it is replayed.
+    Returns the path of the file to replay, or None if there is nothing to replay"""
+    replay_path = path + '.replay'
+    with journal_lock:
+        if os.path.exists(replay_path):
+            # an earlier replay did not complete, finish that first
+            return replay_path
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        os.replace(path, replay_path)
+    return replay_path
+
+
+def read_progress(replay_path, records):
+    """Number of records of a journal being replayed that were already written to the database, from its progress file.
+    The progress file names the last record written, it is ignored if it does not match the records"""
+    try:
+        with open(replay_path + '.progress', 'r') as pf:
+            n_done, last_uuid = pf.read().split()
+        n_done = int(n_done)
+    except (OSError, ValueError):
+        return 0
+    if (0 < n_done <= len(records)) and (records[n_done - 1]['sample_uuid'] == last_uuid):
+        return n_done
+    return 0
+
+
+def write_progress(replay_path, records, n_done):
+    """Record that the first n_done records of a journal being replayed were written to the database"""
+    with open(replay_path + '.progress.tmp', 'w') as pf:
+        pf.write(f"{n_done} {records[n_done - 1]['sample_uuid']}")
+        pf.flush()
+        os.fsync(pf.fileno())
+    os.replace(replay_path + '.progress.tmp', replay_path + '.progress')
+
+
+def remove_progress(replay_path):
+    if os.path.exists(replay_path + '.progress'):
+        os.remove(replay_path + '.progress')
+
+
+def write_records(path, records):
+    """Atomically replace the journal at path with the given records, or remove it if there are none"""
+    if len(records) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    # the temporary file is truncated: anything an interrupted earlier call left in it must not end up in the journal
+    with open(path + '.tmp', 'wb') as jf:
+        jf.write(encode_frames(records))
+        jf.flush()
+        os.fsync(jf.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def pending_records(path):
+    """True if there are records in the journal at path waiting to be replayed"""
+    return (os.path.exists(path) and os.path.getsize(path) > 0) or os.path.exists(path + '.replay')
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Link Functions
+
+Measure the quality of the connection to the remote server from the uploads themselves, and adapt the size of upload batches,
+the number of uploads in flight and the upload timeout to it, within configured bounds.
+
+Batch size and concurrency follow an additive increase / multiplicative decrease scheme: they are halved on a failed request
+(no response, timeout or server error) and grow by one after successful requests, so a poor link is backed off from quickly
+while a good link is used more fully over time. The timeout is derived from the measured throughput and latency.
+"""
+import time
+import logging
+import threading
+
+log = logging.getLogger('export.link')
+
+SMOOTHING = 0.2              # weight of a new measurement in the moving averages
+CONCURRENCY_GROWTH_AFTER = 5  # successful requests in a row before another upload is allowed in flight
+TIMEOUT_FACTOR = 3.0         # timeout as a multiple of the expected duration of a request
+
+
+class AdaptiveLink(object):
+    """
+    Link quality estimate and upload settings adapted to it.
+    : config_dict is the [EXPORT] section of the config file interpreted as a dictionary in initialisation.py
+    """
+    def __init__(self, config_dict):
+        self.batch_size_min = max(config_dict.get('export_batch_size_min', 1), 1)
+        self.batch_size_max = max(config_dict.get('export_batch_size_max', 50), self.batch_size_min)
+        self.concurrency_min = 1
+        self.concurrency_max = max(config_dict.get('export_concurrency_max', 4), 1)
+        self.timeout_min = config_dict.get('export_timeout_min_sec', 5.0)
+        self.timeout_max = config_dict.get('export_timeout_max_sec', 120.0)
+
+        # start from the configured values
+        self.batch_size = min(max(config_dict.get('export_batch_size', 10), self.batch_size_min), self.batch_size_max)
+        self.concurrency = min(max(config_dict.get('export_concurrency', 1), self.concurrency_min), self.concurrency_max)
+
+        self.latency = None       # moving average of the duration of small requests, s
+        self.throughput = None    # moving average of bytes sent per second
+        self.failure_rate = 0.0   # moving average of failed requests (0-1)
+        self.successes_in_row = 0
+        self.n_requests = 0
+        self.updated = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Link batch size {self.batch_size} concurrency {self.concurrency} {self.as_dict()}"
+
+    def timeout(self, n_bytes):
+        """Timeout in seconds for a request sending n_bytes, None if there are no measurements yet"""
+        with self.lock:
+            if self.throughput is None:
+                return None
+            expected = (self.latency or 0) + n_bytes / self.throughput
+        return min(max(TIMEOUT_FACTOR * expected, self.timeout_min), self.timeout_max)
+
+    def record(self, duration, n_bytes, success):
+        """Update the link estimate with the result of a request, and adapt upload settings"""
+        with self.lock:
+            self.n_requests += 1
+            self.updated = time.time()
+            self.failure_rate = (1 - SMOOTHING) * self.failure_rate + SMOOTHING * (0.0 if success else 1.0)
+            if not success:
+                # back off quickly
+                self.successes_in_row = 0
+                self.batch_size = max(self.batch_size // 2, self.batch_size_min)
+                self.concurrency = max(self.concurrency // 2, self.concurrency_min)
+                log.debug(f"Request failed, batch size {self.batch_size}, concurrency {self.concurrency}")
+                return
+
+            throughput = n_bytes / max(duration, 1e-3)
+            self.throughput = throughput if self.throughput is None else (1 - SMOOTHING) * self.throughput + SMOOTHING * throughput
+            if (self.latency is None) or (duration < self.latency):
+                self.latency = duration  # a short request mostly measures latency
+            else:
+                self.latency = (1 - SMOOTHING) * self.latency + SMOOTHING * min(duration, 2 * self.latency)
+
+            # grow slowly
+            self.successes_in_row += 1
+            self.batch_size = min(self.batch_size + 1, self.batch_size_max)
+            if self.successes_in_row % CONCURRENCY_GROWTH_AFTER == 0:
+                self.concurrency = min(self.concurrency + 1, self.concurrency_max)
+
+    def as_dict(self):
+        """Link quality and current upload settings, e.g. to publish in redis"""
+        with self.lock:
+            return {'latency_s': self.latency,
+                    'throughput_bps': self.throughput,
+                    'failure_rate': self.failure_rate,
+                    'batch_size': self.batch_size,
+                    'concurrency': self.concurrency,
+                    'requests': self.n_requests,
+                    'updated': self.updated}
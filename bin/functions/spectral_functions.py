@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spectral store Functions
+
+Optional secondary store of spectra, next to the database: one append-only file per sensor of fixed-size records
+(time, sample_uuid, integration time, 255 uint16 pixels). Files can be opened as a numpy.memmap, so a time range
+of spectra is a zero-copy slice found with a binary search on time.
+
+Time is the system time at sampling (pc_time, in microseconds since 1970), in the order in which samples were taken.
+Time may step back when the system clock is set back, or when older spectra are added later (tests/build_spectral_store.py).
+The records at which this happens are listed in a .steps file next to the sensor file, so that each part in between can
+still be searched with a binary search.
+Spectra are linked to the database through the sample_uuid.
+"""
+import os
+import uuid
+import glob
+import logging
+import datetime
+import numpy as np
+
+log = logging.getLogger('spectral')
+
+N_PIXELS = 255
+RECORD_DTYPE = np.dtype([('time', '<i8'),           # microseconds since 1970-01-01
+                         ('sample_uuid', 'V16'),
+                         ('inttime', '<u4'),
+                         ('pixels', '<u2', (N_PIXELS,))])
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def store_dir(database_path):
+    """Folder holding the spectral store belonging to a (base) database path"""
+    return os.path.join(os.path.dirname(database_path), 'spectra')
+
+
+def sensor_file(directory, sensor_id):
+    """File holding the spectra of a sensor"""
+    safe_id = "".join(c if (c.isalnum() or c in '-_') else '_' for c in str(sensor_id))
+    return os.path.join(directory, f"{safe_id}.spec")
+
+
+def steps_file(path):
+    """File listing the records of a sensor file at which time steps back"""
+    return os.path.splitext(path)[0] + '.steps'
+
+
+def to_microseconds(time):
+    """datetime to microseconds since 1970"""
+    return (time - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def to_datetime(microseconds):
+    """Microseconds since 1970 (array) to numpy datetime64"""
+    return np.asarray(microseconds).astype('datetime64[us]')
+
+
+def append_spectra(directory, sensor_id, entries):
+    """Append spectra (array of RECORD_DTYPE) to the file of a sensor.
+    A record left incomplete by an interrupted write is removed first, as it would shift all records after it.
+    Records at which time steps back are added to the steps file"""
+    path = sensor_file(directory, sensor_id)
+    with open(path, 'a+b') as sf:
+        size = sf.seek(0, os.SEEK_END)
+        partial = size % RECORD_DTYPE.itemsize
+        if partial > 0:
+            log.warning(f"Incomplete record ({partial} bytes) removed from the end of {path}")
+            size -= partial
+            sf.truncate(size)
+        n_records = size // RECORD_DTYPE.itemsize
+        if n_records > 0:
+            sf.seek(size - RECORD_DTYPE.itemsize)
+            last_time = np.frombuffer(sf.read(8), dtype='<i8')[0]
+        else:
+            last_time = entries['time'][0]
+        steps = n_records + np.flatnonzero(np.diff(np.concatenate(([last_time], entries['time']))) < 0)
+        if len(steps) > 0:
+            # listed before the records are written: a step beyond the end of the file is ignored when reading
+            log.info(f"Time steps back at {len(steps)} record(s) in {path}")
+            with open(steps_file(path), 'ab') as stf:
+                stf.write(steps.astype('<i8').tobytes())
+        sf.write(entries.tobytes())
+
+
+def append_record(directory, record):
+    """Append the spectra of a record (from db_functions.make_record) to the store. Returns the number of spectra stored"""
+    if (record['trigger_id'] is None) or (record['spectra_data'] is None):
+        return 0
+    time = to_microseconds(record['trigger_id'])
+    sample_uuid = uuid.UUID(record['sample_uuid']).bytes
+    n_stored = 0
+    for sensor_id, inttime, spectrum in record['spectra_data']:
+        try:
+            pixels = np.asarray(spectrum, dtype=float)
+            if (pixels.shape != (N_PIXELS,)) or (not np.all(np.isfinite(pixels))):
+                raise ValueError(f"{len(pixels)} pixels")
+            entry = np.zeros(1, dtype=RECORD_DTYPE)
+            entry['time'] = time
+            entry['sample_uuid'] = np.void(sample_uuid)
+            entry['inttime'] = int(inttime)
+            entry['pixels'] = np.clip(pixels, 0, 65535)
+        except (ValueError, TypeError) as err:
+            log.debug(f"Spectrum from {sensor_id} not stored in spectral store: {err}")
+            continue
+        append_spectra(directory, sensor_id, entry)
+        n_stored += 1
+    return n_stored
+
+
+def sensors(directory):
+    """Sensor ids with spectra in the store"""
+    return sorted(os.path.splitext(os.path.basename(f))[0] for f in glob.glob(os.path.join(directory, '*.spec')))
+
+
+def open_sensor(directory, sensor_id):
+    """Memory-map the spectra of a sensor (read-only). Returns None if there are none.
+    A record that is still being written is left out"""
+    path = sensor_file(directory, sensor_id)
+    if not os.path.exists(path):
+        return None
+    n_records = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    if n_records == 0:
+        return None
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(n_records,))
+
+
+def time_steps(spectra):
+    """Records of memory-mapped spectra (from open_sensor) at which time steps back, from the steps file"""
+    path = getattr(spectra, 'filename', None)
+    if (path is None) or (not os.path.exists(steps_file(path))):
+        return np.zeros(0, dtype=int)
+    steps = np.fromfile(steps_file(path), dtype='<i8', count=os.path.getsize(steps_file(path)) // 8)
+    return np.unique(steps[(steps > 0) & (steps < len(spectra))])
+
+
+def time_slice(spectra, start_time, end_time):
+    """Spectra between start_time and end_time (datetime, inclusive), in the order in which they were stored.
+    Time only increases between the steps listed in the steps file, each part is searched with a binary search. The result
+    is a zero-copy slice of the memory-mapped spectra if all spectra in the range are in one part, a copy otherwise"""
+    bounds = [0] + list(time_steps(spectra)) + [len(spectra)]
+    slices = []
+    for first, end in zip(bounds[:-1], bounds[1:]):
+        times = spectra['time'][first:end]
+        i0 = first + np.searchsorted(times, to_microseconds(start_time), side='left')
+        i1 = first + np.searchsorted(times, to_microseconds(end_time), side='right')
+        if i1 > i0:
+            slices.append(spectra[i0:i1])
+    if len(slices) == 0:
+        return spectra[0:0]
+    if len(slices) == 1:
+        return slices[0]
+    return np.concatenate(slices)
+
+
+def read_range(directory, start_time, end_time, sensor_ids=None):
+    """Spectra of each sensor between start_time and end_time, as a dictionary of sensor_id: structured array slice"""
+    if sensor_ids is None:
+        sensor_ids = sensors(directory)
+    result = {}
+    for sensor_id in sensor_ids:
+        spectra = open_sensor(directory, sensor_id)
+        if spectra is not None:
+            result[sensor_id] = time_slice(spectra, start_time, end_time)
+    return result
+
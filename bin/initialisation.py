@@ -26,7 +26,12 @@ from thread_managers import gpio_manager
 from thread_managers import camera_manager
 from thread_managers import export_manager
 from thread_managers import datasets_manager
+from thread_managers import database_manager
 from functions import db_functions
+from functions import spectral_functions
+from functions import export_functions
+from functions import budget_functions
+from functions import download_functions
 log = logging.getLogger('init')   # report to root logger
 
 
@@ -49,8 +54,29 @@ def db_init(db_config):
 
     # Create tables (only if necessary)
     db['file'] = db_config.get('database_path')
+    db['spectrum_format'] = db_config.get('spectrum_format', 'text').lower()
+    if db['spectrum_format'] not in db_functions.SPECTRUM_FORMATS:
+        msg = "spectrum_format {0} not recognized. Choose from {1}".format(db['spectrum_format'], ", ".join(db_functions.SPECTRUM_FORMATS.keys()))
+        log.critical(msg)
+        raise ValueError(msg)
+    # optional store of spectra for fast access, see functions/spectral_functions.py
+    db['spectral_store'] = None
+    if db_config.getboolean('use_spectral_store', fallback=False):
+        db['spectral_store'] = spectral_functions.store_dir(db['file'])
+        os.makedirs(db['spectral_store'], exist_ok=True)
+
+    db['shard_period'] = db_config.get('shard_period', 'none').lower()
+    if db['shard_period'] not in db_functions.SHARD_PERIODS:
+        msg = "shard_period {0} not recognized. Choose from {1}".format(db['shard_period'], ", ".join(db_functions.SHARD_PERIODS))
+        log.critical(msg)
+        raise ValueError(msg)
     try:
         db_functions.create_tables(db)  # won't harm existing tables
+        if db['shard_period'] != 'none':
+            db_functions.init_shards(db)  # db['file'] now points to the current shard
+            log.info(f"Writing to database shard {db['file']}")
+        elif db_functions.sharding_enabled(db):
+            log.warning(f"Shard catalog found at {db_functions.catalog_path(db['file'])} but shard_period = none. Samples will be written to {db['file']} and may not be found by downloads.")
 
         conn, cur = db_functions.connect_db(db)
         header_meta = db_functions.column_names(conn, cur, table="sorad_metadata")
@@ -87,6 +113,17 @@ def db_init(db_config):
     # if the sample_uuid is not stored on data collection, set switch to add it on upload
     db['add_sample_uuid'] = 'sample_uuid' not in db['header']
 
+    # new records are committed by a writer thread, if configured
+    db['writer'] = None
+    db['replayer'] = None
+    if db_config.getboolean('use_writer_thread', fallback=False):
+        db['writer_batch_size'] = db_config.getint('writer_batch_size', fallback=20)
+        db['writer_max_wait_sec'] = db_config.getfloat('writer_max_wait_sec', fallback=1.0)
+        db['writer'] = database_manager.DatabaseWriter(db)
+    else:
+        # records the main loop could not commit are kept in the journal and replayed in the background
+        db['replayer'] = database_manager.JournalReplayer(db)
+
     return db
 
 
@@ -105,10 +142,24 @@ def datasets_init(conf):
     datasets['storage_path'] =     download_config.get('storage_path')
     datasets['max_storage_gb'] =   float(download_config.get('max_storage_gb'))
     datasets['storage_protocol'] = download_config.get('storage_protocol')
+    datasets['compress_csv'] =     download_config.getboolean('compress_csv', fallback=False)
+    datasets['dataset_period'] =   download_config.get('dataset_period', 'day').lower()
+    datasets['dataset_formats'] =  [f.strip().lower() for f in download_config.get('dataset_formats', 'hdf, csv').split(',') if f.strip()]
+    datasets['dataset_interval_mins'] = download_config.getint('dataset_interval_mins', fallback=15)
     datasets['database_path'] =    db_config.get('database_path')
     datasets['platform_id'] =      export_config.get('platform_id')
     datasets['platform_uuid'] =    export_config.get('platform_uuid')
 
+    if datasets['dataset_period'] not in download_functions.DATASET_PERIODS:
+        msg = "dataset_period {0} not recognized. Choose from {1}".format(datasets['dataset_period'], ", ".join(download_functions.DATASET_PERIODS))
+        log.critical(msg)
+        raise ValueError(msg)
+    unknown_formats = set(datasets['dataset_formats']) - set(download_functions.DATASET_FORMATS)
+    if len(unknown_formats) > 0:
+        msg = "dataset_formats {0} not recognized. Choose from {1}".format(", ".join(unknown_formats), ", ".join(download_functions.DATASET_FORMATS))
+        log.critical(msg)
+        raise ValueError(msg)
+
     if not datasets['used']:
         log.info(f"No periodic dataset dumps configured")
         return datasets
@@ -503,6 +554,34 @@ def export_init(conf, db_dict):
     export['export_protocol'] = export_config.get('export_protocol')
     export['data_upload_interval_sec'] = export_config.getint('data_upload_interval_sec')
     export['status_update_interval_sec'] = export_config.getint('status_update_interval_sec')
+    export['export_batch_size'] = export_config.getint('export_batch_size', fallback=0)
+    export['export_concurrency'] = max(export_config.getint('export_concurrency', fallback=1), 1)
+    export['export_retry_interval_sec'] = export_config.getint('export_retry_interval_sec', fallback=export_functions.RETRY_DEFAULTS['export_retry_interval_sec'])
+    export['export_retry_interval_max_sec'] = export_config.getint('export_retry_interval_max_sec', fallback=export_functions.RETRY_DEFAULTS['export_retry_interval_max_sec'])
+    export['export_max_attempts'] = export_config.getint('export_max_attempts', fallback=export_functions.RETRY_DEFAULTS['export_max_attempts'])
+    export['adaptive_export'] = export_config.getboolean('adaptive_export', fallback=False)
+    export['export_batch_size_min'] = export_config.getint('export_batch_size_min', fallback=1)
+    export['export_batch_size_max'] = export_config.getint('export_batch_size_max', fallback=50)
+    export['export_concurrency_max'] = export_config.getint('export_concurrency_max', fallback=4)
+    export['export_timeout_min_sec'] = export_config.getfloat('export_timeout_min_sec', fallback=5.0)
+    export['export_timeout_max_sec'] = export_config.getfloat('export_timeout_max_sec', fallback=120.0)
+    export['export_encoding'] = export_config.get('export_encoding', 'json').lower()
+    if export['export_encoding'] not in export_functions.EXPORT_ENCODINGS:
+        msg = "export_encoding {0} not recognized. Choose from {1}".format(export['export_encoding'], ", ".join(export_functions.EXPORT_ENCODINGS))
+        log.critical(msg)
+        raise ValueError(msg)
+
+    export['export_budget_bytes'] = export_config.getint('export_budget_bytes', fallback=0)
+    export['export_budget_period'] = export_config.get('export_budget_period', 'day').lower()
+    if export['export_budget_period'] not in budget_functions.BUDGET_PERIODS:
+        msg = "export_budget_period {0} not recognized. Choose from {1}".format(export['export_budget_period'], ", ".join(budget_functions.BUDGET_PERIODS))
+        log.critical(msg)
+        raise ValueError(msg)
+    export['export_budget_realtime_share'] = export_config.getfloat('export_budget_realtime_share', fallback=0.2)
+    export['export_realtime_window_sec'] = export_config.getint('export_realtime_window_sec', fallback=3600)
+    export['export_backfill_age_sec'] = export_config.getint('export_backfill_age_sec', fallback=7*86400)
+    export['export_cheap_link_interfaces'] = [i.strip() for i in export_config.get('export_cheap_link_interfaces', '').split(',') if i.strip()]
+    export['export_cheap_link_geofences'] = budget_functions.parse_geofences(export_config.get('export_cheap_link_geofences', ''))
 
     export['parse_url'] = export_config.get('parse_url')  # something like https:1.2.3.4:port/parse/classes/sorad
     export['parse_app_id'] = export_config.get('parse_app_id')  # ask the parse server admin for this key and store it in local-config.ini
@@ -115,6 +115,10 @@ def init_all(conf):
 
     log = logging.getLogger('init')
     db = initialisation.db_init(conf['DATABASE'])
+    if db['used'] and db['writer'] is not None:
+        db['writer'].start()  # also replays any records left in the journal
+    elif db['used']:
+        db['replayer'].start()  # also replays any records left in the journal
 
     rf.store(redis_client, 'system_status', 'starting', expires=30)
 
@@ -156,7 +160,7 @@ def init_all(conf):
 
     # start individual monitoring threads
 
-    maintenance = {'manager': timed_actions.MaintenanceManager(conf['MISC'])}
+    maintenance = {'manager': timed_actions.MaintenanceManager(conf['MISC'], db)}
     maintenance['manager'].start()
 
     if battery['used']:
@@ -301,6 +305,15 @@ def stop_all(db, radiometry_manager, gps, battery, bat_manager, rad, tpr, rht, c
         log.info("Stopping camera manager thread")
         cam['manager'].stop()
 
+    if (db is not None) and (db.get('replayer') is not None) and db['replayer'].started:
+        log.info("Stopping journal replayer thread")
+        db['replayer'].stop()
+
+    # Stop the database writer last, once all queued records are written
+    if (db is not None) and (db.get('writer') is not None):
+        log.info("Stopping database writer thread")
+        db['writer'].stop()
+
     # Wait for any lingering threads.
     log.info(f"Waiting on {threading.active_count()} active threads..")
     for t in threading.enumerate()[1:]:
@@ -367,6 +380,14 @@ def update_system_values(gps, values, tpr=None, rht=None, motor=None, redis=Fals
     return values
 
 
+def store_record(db_dict, verbose, values, trigger_id, spectra_data):
+    """Hand a new record to the database writer thread, or commit it directly if no writer is used.
+    Returns the database id, or the sample_uuid of a queued record"""
+    if db_dict.get('writer') is not None:
+        return db_dict['writer'].put(values, trigger_id, spectra_data, software_version=__version__)
+    return db_func.commit_db(db_dict, verbose, values, trigger_id, spectra_data=spectra_data, software_version=__version__)
+
+
 def format_log_message(counter, ready, values):
     """Format log messages"""
     checks = {True: "1", False: "0"}    # values to show for True/False (e.g. 1/0 or T/F)
@@ -662,11 +683,11 @@ def run_one_cycle(counter, conf, db_dict, rad, sample, gps, radiometry_manager,
         rf.store(redis_client, 'sampling_status', 'ready', expires=30)
 
         for n in range(len(sids)):
-            spec_data.append([str(sids[n]),str(itimes[n]),str(specs[n])])
+            spec_data.append([str(sids[n]),str(itimes[n]),specs[n]])  # spectrum is encoded for storage in commit_db
 
         # If local database is used, commit the data
         if db_dict['used']:
-            db_id = db_func.commit_db(db_dict, verbose, values, trigger_id['all_sensors'], spectra_data=spec_data, software_version=__version__)
+            db_id = store_record(db_dict, verbose, values, trigger_id['all_sensors'], spec_data)
             log.info("{2} | New record (all sensors): {0} [{1}]".format(trigger_id['all_sensors'], db_id, counter))
 
         try:
@@ -687,11 +708,11 @@ def run_one_cycle(counter, conf, db_dict, rad, sample, gps, radiometry_manager,
         trig_id, specs, sids, itimes, pre_incs, post_incs, temp_incs = radiometry_manager.sample_ed(trigger_id['ed_sensor'])
         rf.store(redis_client, 'sampling_status', 'ready', expires=30)
         for n in range(len(sids)):
-            spec_data.append([str(sids[n]),str(itimes[n]),str(specs[n])])
+            spec_data.append([str(sids[n]),str(itimes[n]),specs[n]])  # spectrum is encoded for storage in commit_db
 
         # If db is used, commit the data to it
         if db_dict['used']:
-            db_id = db_func.commit_db(db_dict, verbose, values, trigger_id['all_sensors'], spectra_data=spec_data, software_version=__version__)
+            db_id = store_record(db_dict, verbose, values, trigger_id['all_sensors'], spec_data)
             log.info("{2} | New record (Ed sensor): {0} [{1}]".format(trigger_id['ed_sensor'], db_id, counter))
 
     # Alternatively check to see if just the gps location / metadata should be written
@@ -705,7 +726,7 @@ def run_one_cycle(counter, conf, db_dict, rad, sample, gps, radiometry_manager,
             trigger_id['gps_location'] = datetime.datetime.now()
 
             if db_dict['used']:
-                db_id = db_func.commit_db(db_dict, verbose, values, trigger_id['gps_location'], spectra_data=None, software_version=__version__)
+                db_id = store_record(db_dict, verbose, values, trigger_id['gps_location'], None)
                 log.info("{2} | New record (gps location): {0} [{1}]".format(trigger_id['gps_location'], db_id, counter))
 
     message = format_log_message(counter, ready, values)
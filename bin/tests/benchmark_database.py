@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the database functions on an existing (e.g. synthetic) database, to catch regressions before they reach a Pi
+
+Reports throughput and latency of:
+- commit_db (new samples are removed again afterwards)
+- identify_new_local_records, as used by the export manager
+- identify_records + parse_records for windows of an hour, a day and a week, as used for downloads
+- save_to_hdf for a day of data
+- reading a month of spectra from the spectral store, if there is one next to the database
+
+Create a database with synthetic_database.py first, or work on a copy of a real database.
+Example: python3 benchmark_database.py -s /tmp/sorad_synthetic.db -o /tmp/benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+import inspect
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
+import functions.db_functions as db_func
+import functions.export_functions as exp
+import functions.download_functions as df
+import functions.spectral_functions as spectral
+from synthetic_database import day_of_samples
+
+
+def parse_args():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--source', required=True, type=str,
+                        help="path to the database file to benchmark")
+    parser.add_argument('-n', '--repeats', required=False, type=int, default=5,
+                        help="number of repeats of each read benchmark")
+    parser.add_argument('--commits', required=False, type=int, default=200,
+                        help="number of samples written in the commit benchmark")
+    parser.add_argument('-f', '--format', required=False, type=str, default='text',
+                        choices=list(db_func.SPECTRUM_FORMATS.keys()),
+                        help="storage format for spectra written in the commit benchmark")
+    parser.add_argument('-o', '--output', required=False, type=str, default=None,
+                        help="save results to this json file, e.g. to compare software versions")
+    parser.add_argument('-d', '--debug', required=False, action='store_true',
+                        help="set log level to debug")
+
+    args = parser.parse_args()
+    if not os.path.exists(args.source):
+        raise IOError("Database file not found at {0}".format(args.source))
+    return args
+
+
+def make_db_dict(path, spectrum_format='text'):
+    """Database dictionary as prepared by initialisation.db_init, without reading a config file"""
+    db = {'file': path, 'used': True, 'spectrum_format': spectrum_format}
+    conn, cur = db_func.connect_db(db)
+    db['export_success_field'], db['export_attempts_field'] = db_func.export_fields(conn, cur)
+    db['header_meta'] = db_func.column_names(conn, cur, table="sorad_metadata")
+    db['header'] = db_func.column_names(conn, cur, table="sorad_radiometry") + db['header_meta']
+    conn.close()
+    return db
+
+
+def summarise(name, latencies, n_items=None, unit='records'):
+    """Latency statistics in ms, and throughput if the number of items handled per call is known"""
+    latencies = np.array(latencies)
+    result = {'name': name, 'calls': len(latencies),
+              'mean_ms': 1000 * latencies.mean(),
+              'p50_ms': 1000 * np.percentile(latencies, 50),
+              'p95_ms': 1000 * np.percentile(latencies, 95),
+              'max_ms': 1000 * latencies.max()}
+    if n_items is not None:
+        result[unit] = n_items
+        result[f'{unit}_per_s'] = n_items / latencies.mean() if latencies.mean() > 0 else None
+    log.info(f"{name:45s} p50 {result['p50_ms']:9.1f} ms  p95 {result['p95_ms']:9.1f} ms  max {result['max_ms']:9.1f} ms" +
+             (f"  {result[unit+'_per_s']:10.0f} {unit}/s" if (n_items is not None) and result[unit+'_per_s'] else ""))
+    return result
+
+
+def timed(func, *args, **kwargs):
+    """Call func, return (duration in seconds, result)"""
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - t0, result
+
+
+def benchmark_commit(db, n_commits):
+    """Time commit_db for a day's worth of synthetic samples, then remove them again"""
+    if 'sample_uuid' not in db['header_meta']:
+        log.info("commit_db: skipped, legacy database layout")
+        return []
+    rng = np.random.default_rng(0)
+    samples = []
+    day = datetime.datetime(2000, 6, 21)
+    while len(samples) < n_commits:
+        samples += [s for s in day_of_samples(rng, day, 30.0, {'lat': 50.3, 'lon': -4.2, 'bearing': 0}, day) if len(s[1]) > 0]
+        day += datetime.timedelta(days=1)
+
+    conn, cur = db_func.connect_db(db)
+    cur.execute("SELECT max(id_) FROM sorad_metadata")
+    last_id = cur.fetchone()[0] or 0
+    conn.close()
+
+    latencies = []
+    for meta, spec in samples[:n_commits]:
+        values = {'dt': meta['gps_time'], 'fix': meta['gps_fix'], 'lat0': meta['gps_lat'], 'lon0': meta['gps_long'],
+                  'speed': meta['gps_speed'], 'ship_bearing_mean': meta['platform_bearing'],
+                  'solar_az': meta['sun_azimuth'], 'solar_el': meta['sun_elevation'], 'rel_view_az': meta['rel_view_az'],
+                  'pi_temp': meta['pi_cpu_temp'], 'tilt_avg': meta['tilt_avg'], 'tilt_std': meta['tilt_std'],
+                  'accHeading': meta['bearing_accuracy'], 'batt_voltage': meta['batt_v'], 'inside_temp': meta['inside_temp'],
+                  'inside_rh': meta['inside_rel_hum'], 'motor_temp': meta['motor_temp'], 'driver_temp': meta['driver_temp']}
+        spectra_data = [[sensor_id, str(inttime), spectrum.tolist()] for sensor_id, inttime, spectrum in spec]
+        duration, _ = timed(db_func.commit_db, db, False, values, meta['pc_time'], spectra_data)
+        latencies.append(duration)
+
+    # remove benchmark samples
+    conn, cur = db_func.connect_db(db)
+    cur.execute("DELETE FROM sorad_radiometry WHERE metadata_id > ?", (last_id,))
+    cur.execute("DELETE FROM sorad_metadata WHERE id_ > ?", (last_id,))
+    conn.commit()
+    conn.close()
+    return [summarise('commit_db', latencies, 1, unit='samples')]
+
+
+def benchmark_export_scan(db, repeats):
+    """Time identify_new_local_records as called by the export manager"""
+    results = []
+    for limit in [0, 10]:
+        latencies = []
+        for _ in range(repeats):
+            duration, (n_total, n_pending, records) = timed(exp.identify_new_local_records, db, limit=limit)
+            latencies.append(duration)
+        results.append(summarise(f'identify_new_local_records(limit={limit})', latencies))
+    log.info(f"{n_total} samples in database, {n_pending} pending upload")
+    return results
+
+
+def benchmark_download(db, repeats, tmpdir):
+    """Time identify_records + parse_records for several windows ending at the latest sample, and save_to_hdf for a day"""
+    conn, cur = db_func.connect_db(db)
+    meta_columns = db_func.column_names(conn, cur, table="sorad_metadata")
+    data_columns = db_func.column_names(conn, cur, table="sorad_radiometry")
+    if 'gps_time' not in meta_columns:
+        log.info("identify_records: skipped, legacy database layout")
+        conn.close()
+        return []
+    cur.execute("SELECT max(gps_time) FROM sorad_metadata WHERE n_rad_obs = 3")
+    last = cur.fetchone()[0]
+    conn.close()
+    if last is None:
+        log.info("identify_records: skipped, no complete samples in database")
+        return []
+    end_time = datetime.datetime.strptime(last[:19], '%Y-%m-%d %H:%M:%S') + datetime.timedelta(seconds=1)
+
+    results = []
+    for label, window in [('hour', datetime.timedelta(hours=1)), ('day', datetime.timedelta(days=1)), ('week', datetime.timedelta(days=7))]:
+        query_latencies, parse_latencies = [], []
+        for _ in range(repeats):
+            duration, records = timed(df.identify_records, db, end_time - window, end_time)
+            query_latencies.append(duration)
+            duration, (sets, sensors) = timed(df.parse_records, records, meta_columns, data_columns)
+            parse_latencies.append(duration)
+        results.append(summarise(f'identify_records ({label})', query_latencies, len(records)))
+        results.append(summarise(f'parse_records ({label})', parse_latencies, len(records)))
+        if label == 'day':
+            day_sets, day_sensors = sets, sensors
+
+    latencies = []
+    for n in range(repeats):
+        destination_file = os.path.join(tmpdir, f'benchmark_{n}.h5')
+        duration, _ = timed(df.save_to_hdf, day_sets, day_sensors, destination_file, 'benchmark', 'benchmark')
+        latencies.append(duration)
+    results.append(summarise('save_to_hdf (day)', latencies, len(day_sets), unit='samples'))
+    log.info(f"HDF file size for a day: {os.path.getsize(destination_file) / 1024**2:.1f} Mb")
+    return results
+
+
+def benchmark_spectral_store(db, repeats):
+    """Time reading the last month of spectra of all sensors from the spectral store into arrays"""
+    directory = spectral.store_dir(db['file'])
+    sensor_ids = spectral.sensors(directory) if os.path.isdir(directory) else []
+    if len(sensor_ids) == 0:
+        log.info("spectral store: skipped, no spectral store found")
+        return []
+    end_time = max([spectral.to_datetime(spectral.open_sensor(directory, s)['time'][-1]) for s in sensor_ids]).astype(datetime.datetime)
+    latencies = []
+    for _ in range(repeats):
+        duration, spectra = timed(spectral.read_range, directory, end_time - datetime.timedelta(days=30), end_time)
+        latencies.append(duration)
+    n_spectra = sum(len(s) for s in spectra.values())
+    return [summarise('spectral store read_range (month)', latencies, n_spectra, unit='spectra')]
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # start logging to stdout
+    log = logging.getLogger()
+    handler = logging.StreamHandler(sys.stdout)
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+        handler.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+        handler.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s| %(levelname)s | %(name)s | %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+    # the functions under test log every query and record, keep the output readable
+    for name in ['download', 'export.scanlocal', 'worker']:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    db = make_db_dict(args.source, args.format)
+    log.info(f"Benchmarking {args.source} ({os.path.getsize(args.source) / 1024**2:.1f} Mb)")
+
+    results = {'source': args.source, 'size_mb': os.path.getsize(args.source) / 1024**2,
+               'time': datetime.datetime.now().isoformat(), 'benchmarks': []}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results['benchmarks'] += benchmark_commit(db, args.commits)
+        results['benchmarks'] += benchmark_export_scan(db, args.repeats)
+        results['benchmarks'] += benchmark_download(db, args.repeats, tmpdir)
+        results['benchmarks'] += benchmark_spectral_store(db, args.repeats)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as jf:
+            json.dump(results, jf, indent=2)
+        log.info(f"Results saved to {args.output}")
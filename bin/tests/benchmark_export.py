@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark data export against the local Parse stand-in server (parse_standin_server.py) over a simulated link
+
+Drains a backlog of pending samples with run_export_pipeline, as the export manager does, and reports:
+- records (one per spectrum) uploaded per second
+- bytes sent to the server (request bodies and headers, as received by the stand-in server)
+- CPU time per record in this process (reading, encoding, uploading and writing back results)
+
+The backlog is a synthetic database (see synthetic_database.py) created in a temporary directory, or a copy of an
+existing database (-s). The source database is never changed. The stand-in server runs in a separate process so its
+CPU use is not counted.
+
+Example: python3 benchmark_export.py -n 2000 --latency 0.3 --bandwidth 64000 --batch_size 20 --concurrency 4 --encoding json_gzip
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import socket
+import logging
+import argparse
+import datetime
+import tempfile
+import subprocess
+import inspect
+import requests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
+import functions.export_functions as exp
+import functions.http_functions as http
+from functions.link_functions import AdaptiveLink
+from synthetic_database import generate
+from benchmark_database import make_db_dict
+
+
+def parse_args():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--samples', required=False, type=int, default=1000,
+                        help="number of samples to upload")
+    parser.add_argument('-s', '--source', required=False, type=str, default=None,
+                        help="copy of this database is used as the backlog, instead of a synthetic database")
+    parser.add_argument('--batch_size', required=False, type=int, default=10,
+                        help="samples per upload request (0 to upload one record per request)")
+    parser.add_argument('--concurrency', required=False, type=int, default=2,
+                        help="uploads in flight")
+    parser.add_argument('--encoding', required=False, type=str, default='json', choices=exp.EXPORT_ENCODINGS,
+                        help="request body encoding")
+    parser.add_argument('--adaptive', required=False, action='store_true',
+                        help="adapt batch size, concurrency and timeout to the link (see link_functions.py)")
+    parser.add_argument('--latency', required=False, type=float, default=0.0,
+                        help="simulated latency in seconds per request")
+    parser.add_argument('--bandwidth', required=False, type=float, default=None,
+                        help="simulated bandwidth in bytes per second")
+    parser.add_argument('--error_rate', required=False, type=float, default=0.0,
+                        help="fraction of requests failing with a server error")
+    parser.add_argument('--record_error_rate', required=False, type=float, default=0.0,
+                        help="fraction of records in batch requests rejected by the server")
+    parser.add_argument('--timeout_rate', required=False, type=float, default=0.0,
+                        help="fraction of requests that get no response")
+    parser.add_argument('--port', required=False, type=int, default=None,
+                        help="port for the stand-in server, a free port by default")
+    parser.add_argument('-o', '--output', required=False, type=str, default=None,
+                        help="save results to this json file, e.g. to compare settings or software versions")
+    parser.add_argument('-d', '--debug', required=False, action='store_true',
+                        help="set log level to debug")
+
+    args = parser.parse_args()
+    if (args.source is not None) and (not os.path.exists(args.source)):
+        raise IOError("Database file not found at {0}".format(args.source))
+    return args
+
+
+def free_port():
+    """A local port that is not in use"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port):
+    """Start the stand-in server in a separate process, returns the process once the server responds"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parse_standin_server.py'),
+               '--port', str(port), '--latency', str(args.latency), '--error_rate', str(args.error_rate),
+               '--record_error_rate', str(args.record_error_rate), '--timeout_rate', str(args.timeout_rate),
+               '--hang', '60', '--seed', '1']
+    if args.bandwidth is not None:
+        command += ['--bandwidth', str(args.bandwidth)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/parse/health", timeout=1)
+            return server
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"Stand-in server did not start on port {port}")
+
+
+def server_stats(port):
+    return requests.get(f"http://127.0.0.1:{port}/parse/_stats", timeout=5).json()
+
+
+def prepare_backlog(args, tmpdir):
+    """Path of a database in tmpdir with at least the requested number of samples pending upload, if possible"""
+    path = os.path.join(tmpdir, 'sorad_backlog.db')
+    if args.source is not None:
+        for f in glob.glob(args.source + '*'):  # include -wal and -shm files
+            shutil.copy(f, path + f[len(args.source):])
+        return path
+    # a day holds about a thousand complete samples at the default interval
+    days = args.samples / 1000.0 + 1
+    start = datetime.datetime(2022, 6, 1)
+    log.info(f"Generating synthetic database with {days:.1f} days of pending samples")
+    generate(path, start, days / 365.25, pending_days=days)
+    return path
+
+
+def export_config(args, port):
+    """Export config dictionary as prepared by initialisation.export_init, without reading a config file"""
+    config = {'export_batch_size': args.batch_size, 'export_concurrency': args.concurrency,
+              'export_encoding': args.encoding, 'adaptive_export': args.adaptive,
+              'parse_url': f"http://127.0.0.1:{port}/parse/classes/sorad",
+              'parse_app_id': 'benchmark', 'parse_clientkey': 'benchmark', 'platform_id': 'benchmark',
+              'owner_contact': 'benchmark', 'operator_contact': 'benchmark', 'license': 'benchmark',
+              'license_reference': 'benchmark', 'platform_uuid': 'benchmark'}
+    config.update({key: 0 for key in exp.RETRY_DEFAULTS})  # failed samples are due for another attempt right away
+    config['export_max_attempts'] = exp.RETRY_DEFAULTS['export_max_attempts']
+    return config
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # start logging to stdout
+    log = logging.getLogger()
+    handler = logging.StreamHandler(sys.stdout)
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+        handler.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+        handler.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s| %(levelname)s | %(name)s | %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+    # the functions under test log every record, keep the output readable
+    if not args.debug:
+        for name in ['export', 'http', 'db', 'urllib3']:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    port = args.port or free_port()
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    try:
+        path = prepare_backlog(args, tmpdir)
+        db = make_db_dict(path)
+        db['add_sample_uuid'] = 'sample_uuid' not in db['header']
+        config = export_config(args, port)
+        link = AdaptiveLink(config) if args.adaptive else None
+        n_total, n_pending, _ = exp.identify_new_local_records(db, limit=0)
+        log.info(f"{n_pending} of {n_total} samples pending upload, uploading up to {args.samples}")
+
+        server = start_server(args, port)
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        result, n_records = exp.run_export_pipeline(config, db, limit=args.samples, concurrency=args.concurrency,
+                                                     fail_limit=3 * args.samples, link=link)
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+        http.close_sessions()
+        stats = server_stats(port)
+
+        results = {'time': datetime.datetime.now().isoformat(), 'settings': vars(args),
+                   'records': n_records, 'duration_s': wall,
+                   'records_per_s': n_records / wall if wall > 0 else None,
+                   'requests': stats['requests'],
+                   'bytes_sent': stats['bytes_received'],
+                   'bytes_per_record': stats['bytes_received'] / n_records if n_records else None,
+                   'cpu_ms_per_record': 1000 * cpu / n_records if n_records else None,
+                   'server': stats}
+        if link is not None:
+            results['link'] = link.as_dict()
+        log.info(f"{n_records} records uploaded in {wall:.1f} s: {results['records_per_s'] or 0:.1f} records/s, "
+                 f"{stats['requests']} requests")
+        log.info(f"{stats['bytes_received'] / 1024:.0f} kb sent, {results['bytes_per_record'] or 0:.0f} bytes/record, "
+                 f"CPU {results['cpu_ms_per_record'] or 0:.2f} ms/record")
+        if stats['errors'] or stats['timeouts'] or stats['rejected']:
+            log.info(f"Server errors: {stats['errors']}, timeouts: {stats['timeouts']}, rejected records: {stats['rejected']}")
+        if link is not None:
+            log.info(f"{link}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmpdir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as jf:
+            json.dump(results, jf, indent=2)
+        log.info(f"Results saved to {args.output}")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Add spectra from the database to the spectral store (see functions/spectral_functions.py)
+
+New samples are added to the store as they are recorded when use_spectral_store is enabled. Use this to add samples
+recorded before that. The store should not yet contain any of the samples being added, so either run this before
+enabling the store or start from an empty store (-r). Best run while the So-Rad service is stopped.
+
+Example: python3 build_spectral_store.py -r
+"""
+
+import os
+import sys
+import glob
+import uuid
+import logging
+import argparse
+import datetime
+import inspect
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
+import functions.db_functions as db_func
+import functions.spectral_functions as spectral
+import functions.config_functions as cf_func
+
+
+def parse_args():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_file', required=False,
+                        help="config file providing program settings",
+                        default=u"../config.ini")
+    parser.add_argument('-l', '--local_config_file', required=False,
+                        help="system-specific config overrides providing program settings",
+                        default=u"../config-local.ini")
+    parser.add_argument('-s', '--source', required=False, type=str, default=None,
+                        help="path to a specific database file rather than the one in current use")
+    parser.add_argument('-r', '--rebuild', required=False, action='store_true',
+                        help="remove any spectra already in the store first")
+    parser.add_argument('-d', '--debug', required=False, action='store_true',
+                        help="set log level to debug")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.config_file):
+        raise IOError("Config file not found at {0}".format(args.config_file))
+    if not os.path.exists(args.local_config_file):
+        raise IOError("Local config override file not found at {0}".format(args.local_config_file))
+    if (args.source is not None) and (not os.path.exists(args.source)):
+        raise IOError("Database file not found at {0}".format(args.source))
+
+    return args
+
+
+def import_database(path, directory, batch_size=5000):
+    """Add the spectra of all samples in a database file to the store. Returns the number of spectra added"""
+    conn, cur = db_func.connect_db_readonly(path)
+    uuid_field = 'meta.sample_uuid' if 'sample_uuid' in db_func.column_names(conn, cur, table="sorad_metadata") else 'NULL'
+    cur.execute(f"""SELECT meta.pc_time, {uuid_field}, rad.sensor_id, rad.inttime, rad.measurement
+                    FROM sorad_radiometry rad INNER JOIN sorad_metadata meta ON meta.id_ = rad.metadata_id
+                    ORDER BY meta.id_""")
+    n_added = 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        by_sensor = {}
+        for pc_time, sample_uuid, sensor_id, inttime, measurement in rows:
+            pixels = db_func.decode_spectrum(measurement)
+            if (pixels is None) or (len(pixels) != spectral.N_PIXELS) or (pc_time is None):
+                continue
+            entry = (spectral.to_microseconds(datetime.datetime.fromisoformat(str(pc_time))),
+                     np.void(uuid.UUID(sample_uuid).bytes if sample_uuid else bytes(16)),
+                     int(inttime), pixels)
+            by_sensor.setdefault(sensor_id, []).append(entry)
+        for sensor_id, entries in by_sensor.items():
+            spectral.append_spectra(directory, sensor_id, np.array(entries, dtype=spectral.RECORD_DTYPE))
+            n_added += len(entries)
+        log.info(f"{n_added} spectra added")
+    conn.close()
+    return n_added
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    conf = cf_func.read_config(args.config_file)
+    # start logging to stdout
+    log = logging.getLogger()
+    handler = logging.StreamHandler(sys.stdout)
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+        handler.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+        handler.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s| %(levelname)s | %(name)s | %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+    # update config with local overrides
+    conf = cf_func.update_config(conf, args.local_config_file)
+
+    if args.source is not None:
+        conf['DATABASE']['database_path'] = args.source
+        log.info(f"Using database file at {args.source}")
+
+    db = {'file': conf['DATABASE'].get('database_path')}
+    directory = spectral.store_dir(db['file'])
+    os.makedirs(directory, exist_ok=True)
+    if args.rebuild:
+        for f in glob.glob(os.path.join(directory, '*.spec')) + glob.glob(os.path.join(directory, '*.steps')):
+            log.info(f"Removing {f}")
+            os.remove(f)
+
+    n_added = 0
+    for shard in db_func.list_shards(db):
+        log.info(f"Adding spectra from {shard}")
+        n_added += import_database(shard, directory)
+    log.info(f"{n_added} spectra added to {directory}: {', '.join(spectral.sensors(directory))}")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Convert spectra stored in an existing database to another storage format
+
+Packed uint16 storage is roughly 3-4x smaller than the text format and much faster to read back.
+Records are converted in small batches so the main app can keep writing to the database, but it is
+best to run this while the So-Rad service is stopped. Back up the database file first.
+
+Example: python3 migrate_spectra.py -s /home/pi/sorad-data/sorad_database.db --format uint16
+"""
+
+import os
+import sys
+import logging
+import argparse
+import inspect
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
+import functions.db_functions as db_func
+import functions.config_functions as cf_func
+
+
+def parse_args():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_file', required=False,
+                        help="config file providing program settings",
+                        default=u"../config.ini")
+    parser.add_argument('-l', '--local_config_file', required=False,
+                        help="system-specific config overrides providing program settings",
+                        default=u"../config-local.ini")
+    parser.add_argument('-s', '--source', required=False, type=str, default=None,
+                        help="path to a specific database file rather than the one in current use")
+    parser.add_argument('-f', '--format', required=False, type=str, default='uint16',
+                        choices=list(db_func.SPECTRUM_FORMATS.keys()),
+                        help="target storage format for spectra")
+    parser.add_argument('-b', '--batch_size', required=False, type=int, default=1000,
+                        help="number of spectra converted per transaction")
+    parser.add_argument('-d', '--debug', required=False, action='store_true',
+                        help="set log level to debug")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.config_file):
+        raise IOError("Config file not found at {0}".format(args.config_file))
+    if not os.path.exists(args.local_config_file):
+        raise IOError("Local config override file not found at {0}".format(args.local_config_file))
+    if (args.source is not None) and (not os.path.exists(args.source)):
+        raise IOError("Database file not found at {0}".format(args.source))
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    conf = cf_func.read_config(args.config_file)
+    # start logging to stdout
+    log = logging.getLogger()
+    handler = logging.StreamHandler(sys.stdout)
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+        handler.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+        handler.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s| %(levelname)s | %(name)s | %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+    # update config with local overrides
+    conf = cf_func.update_config(conf, args.local_config_file)
+
+    if args.source is not None:
+        conf['DATABASE']['database_path'] = args.source
+        log.info(f"Using database file at {args.source}")
+
+    # only the database files are needed: db_init would also set up the database writer and start a new shard
+    db = {'file': conf['DATABASE'].get('database_path')}
+
+    for shard in db_func.list_shards(db):
+        shard_db = {'file': shard}
+        size_before = os.path.getsize(shard)
+
+        n_converted = db_func.migrate_spectra(shard_db, spectrum_format=args.format, batch_size=args.batch_size)
+        log.info(f"{n_converted} spectra in {os.path.basename(shard)} converted to {args.format} format")
+
+        if n_converted > 0:
+            # reclaim the space freed by the conversion
+            conn, cur = db_func.connect_db(shard_db)
+            log.info("Compacting database file")
+            cur.execute("VACUUM")
+            conn.close()
+
+        log.info(f"Database size {size_before / 1024**2:.1f} Mb -> {os.path.getsize(shard) / 1024**2:.1f} Mb")
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for a Parse server, to test and benchmark data export without a live remote store
+
+Implements the part of the Parse REST API used by functions/export_functions.py and check_functions.py:
+- POST <mount>/classes/<class>            create an object
+- PUT <mount>/classes/<class>/<objectId>  update an object (404 if it does not exist)
+- GET <mount>/classes/<class>             query objects, with where (equality only), order, limit, keys and count,
+                                          given as query parameters or as a json request body (as check_functions does)
+- POST <mount>/batch                      several of the above in one request
+- GET <mount>/health
+Objects are kept in memory. Request bodies may be gzip-compressed (Content-Encoding: gzip).
+
+To simulate a poor connection, requests can be delayed (latency), limited to a shared bandwidth, answered with an error
+(error rate), or left without a response (timeout rate). GET <mount>/_stats reports requests, bytes and objects received.
+
+Point parse_url in config-local.ini at it to use it with test_export.py or test_remote.py, e.g.
+  python3 parse_standin_server.py --port 1337 --latency 0.6 --bandwidth 32000
+  parse_url = http://localhost:1337/parse/classes/sorad
+"""
+
+import sys
+import json
+import gzip
+import time
+import uuid
+import random
+import logging
+import argparse
+import datetime
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger('standin')
+
+
+def parse_args():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', required=False, type=int, default=1337,
+                        help="port to listen on")
+    parser.add_argument('--host', required=False, type=str, default='127.0.0.1',
+                        help="address to listen on")
+    parser.add_argument('--mount', required=False, type=str, default='/parse',
+                        help="mount path of the Parse API")
+    parser.add_argument('--latency', required=False, type=float, default=0.0,
+                        help="delay in seconds added to every request")
+    parser.add_argument('--bandwidth', required=False, type=float, default=None,
+                        help="bandwidth in bytes per second shared by all requests (request bodies)")
+    parser.add_argument('--error_rate', required=False, type=float, default=0.0,
+                        help="fraction of requests answered with 503 Service Unavailable")
+    parser.add_argument('--record_error_rate', required=False, type=float, default=0.0,
+                        help="fraction of requests in a batch that are rejected")
+    parser.add_argument('--timeout_rate', required=False, type=float, default=0.0,
+                        help="fraction of requests that get no response (connection is closed after --hang seconds)")
+    parser.add_argument('--hang', required=False, type=float, default=30.0,
+                        help="time in seconds before a request selected by --timeout_rate is dropped")
+    parser.add_argument('--seed', required=False, type=int, default=None,
+                        help="random seed for errors and timeouts")
+    parser.add_argument('-d', '--debug', required=False, action='store_true',
+                        help="set log level to debug")
+    return parser.parse_args()
+
+
+class ParseStore(object):
+    """In-memory objects by class, and link simulation settings shared by all request handlers"""
+    def __init__(self, mount='/parse', latency=0.0, bandwidth=None, error_rate=0.0, record_error_rate=0.0,
+                 timeout_rate=0.0, hang=30.0, seed=None):
+        self.mount = mount.rstrip('/')
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.record_error_rate = record_error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.link_free = time.monotonic()  # time at which the simulated link has sent all data received so far
+        self.classes = {}
+        self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_decoded': 0, 'objects_created': 0, 'objects_updated': 0,
+                      'errors': 0, 'timeouts': 0, 'rejected': 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def draw(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def transfer(self, n_bytes):
+        """Wait as long as sending n_bytes over the shared link would take, after any data still being sent"""
+        if not self.bandwidth:
+            return
+        with self.lock:
+            start = max(time.monotonic(), self.link_free)
+            self.link_free = start + n_bytes / self.bandwidth
+            wait = self.link_free - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    @staticmethod
+    def now():
+        return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def create(self, class_name, body):
+        """Create an object, returns status code and response"""
+        obj = dict(body)
+        obj['objectId'] = uuid.uuid4().hex[:10]
+        obj['createdAt'] = obj['updatedAt'] = self.now()
+        with self.lock:
+            self.classes.setdefault(class_name, {})[obj['objectId']] = obj
+            self.stats['objects_created'] += 1
+        return 201, {'objectId': obj['objectId'], 'createdAt': obj['createdAt']}
+
+    def update(self, class_name, object_id, body):
+        """Update an object, returns status code and response"""
+        with self.lock:
+            obj = self.classes.get(class_name, {}).get(object_id)
+            if obj is None:
+                return 404, {'code': 101, 'error': 'Object not found.'}
+            obj.update(body)
+            obj['updatedAt'] = self.now()
+            self.stats['objects_updated'] += 1
+            return 200, {'updatedAt': obj['updatedAt']}
+
+    def query(self, class_name, params):
+        """Query objects with where (equality only), order, limit, keys and count. Returns status code and response"""
+        where = params.get('where', {})
+        if isinstance(where, str):
+            where = json.loads(where)
+        with self.lock:
+            results = [obj for obj in self.classes.get(class_name, {}).values()
+                       if all(obj.get(key) == value for key, value in where.items())]
+        for field in reversed([f for f in str(params.get('order', '')).split(',') if f]):
+            key = field.lstrip('-')
+            results.sort(key=lambda obj: (obj.get(key) is None, obj.get(key)), reverse=field.startswith('-'))
+        response = {}
+        if int(params.get('count', 0)):
+            response['count'] = len(results)
+        limit = int(params.get('limit', 100))
+        results = results[:limit]
+        if params.get('keys'):
+            keys = str(params['keys']).split(',') + ['objectId', 'createdAt', 'updatedAt']
+            results = [{key: obj[key] for key in keys if key in obj} for obj in results]
+        response['results'] = results
+        return 200, response
+
+    def handle(self, method, path, body):
+        """Route a request (also used for the requests in a batch). Returns status code and response"""
+        if not path.startswith(self.mount + '/'):
+            return 404, {'code': 404, 'error': 'unknown path'}
+        parts = path[len(self.mount) + 1:].strip('/').split('/')
+        if (parts[0] == 'classes') and (len(parts) == 2) and (method == 'POST'):
+            return self.create(parts[1], body or {})
+        if (parts[0] == 'classes') and (len(parts) == 2) and (method == 'GET'):
+            return self.query(parts[1], body or {})
+        if (parts[0] == 'classes') and (len(parts) == 3) and (method == 'PUT'):
+            return self.update(parts[1], parts[2], body or {})
+        if (parts[0] == 'batch') and (method == 'POST'):
+            return 200, self.batch(body.get('requests', []))
+        if (parts[0] == 'health') and (method == 'GET'):
+            return 200, {'status': 'ok'}
+        if (parts[0] == '_stats') and (method == 'GET'):
+            with self.lock:
+                stats = dict(self.stats)
+                stats['objects'] = {name: len(objects) for name, objects in self.classes.items()}
+            return 200, stats
+        return 404, {'code': 404, 'error': 'unknown path'}
+
+    def batch(self, requests):
+        """Results of the requests in a batch, in order"""
+        results = []
+        for request in requests:
+            if self.draw(self.record_error_rate):
+                self.count('rejected')
+                results.append({'error': {'code': 142, 'error': 'rejected by stand-in server'}})
+                continue
+            status, response = self.handle(request.get('method', 'GET'), request.get('path', ''), request.get('body'))
+            results.append({'success': response} if status < 300 else {'error': response})
+        return results
+
+
+class ParseHandler(BaseHTTPRequestHandler):
+    """Request handler, server.store is the ParseStore"""
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+
+    def read_body(self):
+        n_bytes = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(n_bytes) if n_bytes > 0 else b''
+        store = self.server.store
+        store.count('requests')
+        store.count('bytes_received', n_bytes + len(str(self.headers)))
+        store.transfer(n_bytes + len(str(self.headers)))
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            data = gzip.decompress(data)
+        store.count('bytes_decoded', len(data))
+        return json.loads(data) if len(data) > 0 else None
+
+    def respond(self, status, response):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self):
+        store = self.server.store
+        try:
+            body = self.read_body()
+        except (ValueError, OSError) as err:
+            self.respond(400, {'code': 107, 'error': f'invalid request body: {err}'})
+            return
+        url = urllib.parse.urlsplit(self.path)
+        if (self.command == 'GET') and url.query:
+            body = dict(body or {})
+            body.update({key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()})
+
+        if not url.path.endswith(('/health', '/_stats')):
+            time.sleep(store.latency)
+            if store.draw(store.timeout_rate):
+                store.count('timeouts')
+                time.sleep(store.hang)
+                self.close_connection = True
+                return
+            if store.draw(store.error_rate):
+                store.count('errors')
+                self.respond(503, {'code': 1, 'error': 'service unavailable (stand-in server error rate)'})
+                return
+        status, response = store.handle(self.command, url.path, body)
+        log.debug(f"{self.command} {url.path} -> {status}")
+        self.respond(status, response)
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def make_server(host='127.0.0.1', port=1337, **settings):
+    """Create a stand-in server (not started) with link simulation settings as in ParseStore"""
+    server = ThreadingHTTPServer((host, port), ParseHandler)
+    server.daemon_threads = True
+    server.store = ParseStore(**settings)
+    return server
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # start logging to stdout
+    log = logging.getLogger()
+    handler = logging.StreamHandler(sys.stdout)
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+        handler.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+        handler.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s| %(levelname)s | %(name)s | %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+    server = make_server(args.host, args.port, mount=args.mount, latency=args.latency, bandwidth=args.bandwidth,
+                         error_rate=args.error_rate, record_error_rate=args.record_error_rate,
+                         timeout_rate=args.timeout_rate, hang=args.hang, seed=args.seed)
+    log.info(f"Parse stand-in server listening at http://{args.host}:{server.server_address[1]}{args.mount}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generate a database with synthetic So-Rad data, e.g. to benchmark database functions (see benchmark_database.py)
+
+Samples are generated at a fixed interval along a slowly moving track:
+- with the sun high enough, full samples of 3 sensors (Ed, Lt, Ls) with 255-pixel spectra
+- with the sun lower, Ed-only samples
+- at night, position-only records (no spectra)
+Older samples are marked as uploaded. The database can be created in the current layout or in one of the
+legacy layouts found on older systems, which are upgraded by db_functions.create_tables as they would be in use.
+
+Example: python3 synthetic_database.py -o /tmp/sorad_synthetic.db --years 2 --format uint16
+"""
+
+import os
+import sys
+import uuid
+import logging
+import argparse
+import datetime
+import inspect
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
+import functions.db_functions as db_func
+
+log = logging.getLogger('synthetic')
+
+SENSOR_IDS = ['SAM_8329', 'SAM_8330', 'SAM_8331']  # Ed, Lt, Ls
+N_PIXELS = 255
+
+# column layouts found on So-Rad systems, as created before create_tables was extended
+LEGACY_LAYOUTS = {
+    # database format > June 2021, before sample_uuid was stored
+    'legacy_2021': """CREATE TABLE sorad_metadata
+            (id_ integer PRIMARY KEY AUTOINCREMENT NOT NULL,
+            pc_time datetime, gps_time datetime, gps_fix integer,
+            gps_lat float, gps_long float, gps_speed float,
+            platform_bearing float,
+            sun_azimuth float, sun_elevation float,
+            rel_view_az float,
+            motor_temp float, driver_temp float,
+            pi_cpu_temp float,
+            tilt_avg float, tilt_std float,
+            bearing_accuracy float, sorad_version float,
+            batt_v float, inside_temp float, inside_rel_hum float, n_rad_obs integer,
+            export_success bool, export_attempts integer)""",
+    # database format < June 2021, with two gps receivers
+    'legacy_2020': """CREATE TABLE sorad_metadata
+            (id_ integer PRIMARY KEY AUTOINCREMENT NOT NULL,
+            pc_time datetime,
+            gps1_time datetime, gps1_fix integer, gps1_lat float, gps1_long float, gps1_speed float,
+            gps2_time datetime, gps2_fix integer, gps2_lat float, gps2_long float, gps2_speed float,
+            platform_bearing float,
+            sun_azimuth float, sun_elevation float,
+            rel_view_az float,
+            motor_temp float, driver_temp float,
+            pi_cpu_temp float,
+            tilt_avg float, tilt_std float,
+            bearing_accuracy float, sorad_version float,
+            batt_v float, inside_temp float, inside_rel_hum float, n_rad_obs integer,
+            sos_inserted bool, sos_insertion_attempts integer)""",
+}
+LEGACY_RADIOMETRY = """CREATE TABLE sorad_radiometry
+            (metadata_id integer NOT NULL,
+            sensor_id text, inttime integer,
+            measurement text,
+            FOREIGN KEY(metadata_id) REFERENCES sorad_metadata(id_))"""
+
+
+def parse_args():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', required=True, type=str,
+                        help="path of the database file to create")
+    parser.add_argument('-y', '--years', required=False, type=float, default=1.0,
+                        help="number of years of data to generate")
+    parser.add_argument('--start', required=False, type=str, default='20220101T000000',
+                        help="time of the first sample (YYYYMMDDTHHmmss, UTC)")
+    parser.add_argument('-i', '--interval', required=False, type=float, default=30.0,
+                        help="seconds between samples")
+    parser.add_argument('--layout', required=False, type=str, default='current',
+                        choices=['current'] + list(LEGACY_LAYOUTS.keys()),
+                        help="database column layout")
+    parser.add_argument('-f', '--format', required=False, type=str, default='text',
+                        choices=list(db_func.SPECTRUM_FORMATS.keys()),
+                        help="storage format for spectra (current layout only)")
+    parser.add_argument('--pending_days', required=False, type=float, default=7.0,
+                        help="samples in this many days at the end of the dataset are not marked as uploaded")
+    parser.add_argument('--lat', required=False, type=float, default=50.3,
+                        help="latitude at the start of the track")
+    parser.add_argument('--lon', required=False, type=float, default=-4.2,
+                        help="longitude at the start of the track")
+    parser.add_argument('--seed', required=False, type=int, default=1,
+                        help="random seed")
+    parser.add_argument('-d', '--debug', required=False, action='store_true',
+                        help="set log level to debug")
+
+    args = parser.parse_args()
+    if os.path.exists(args.output):
+        raise IOError("Database file already exists at {0}".format(args.output))
+    if (args.layout != 'current') and (args.format != 'text'):
+        raise ValueError("Legacy layouts only store spectra in text format")
+    return args
+
+
+def solar_elevation(lat, lon, times):
+    """Approximate solar elevation (degrees) for arrays of positions and datetime64 times. Good enough for synthetic data"""
+    day_of_year = (times - times.astype('datetime64[Y]')).astype('timedelta64[D]').astype(float) + 1
+    hours = (times - times.astype('datetime64[D]')).astype('timedelta64[s]').astype(float) / 3600.0
+    declination = np.radians(-23.44) * np.cos(2 * np.pi / 365 * (day_of_year + 10))
+    hour_angle = np.radians(15 * (hours + lon / 15.0 - 12))
+    lat = np.radians(lat)
+    sin_el = np.sin(lat) * np.sin(declination) + np.cos(lat) * np.cos(declination) * np.cos(hour_angle)
+    return np.degrees(np.arcsin(sin_el))
+
+
+def synthetic_spectra(rng, elevation, n):
+    """n sets of Ed, Lt, Ls spectra in counts, scaled by solar elevation. Returns uint16 array (n, 3, N_PIXELS)"""
+    pixels = np.arange(N_PIXELS)
+    shape = np.exp(-0.5 * ((pixels - 110) / 55.0) ** 2)  # sensor response over the spectral range
+    levels = np.array([40000.0, 4000.0, 9000.0])          # relative signal of Ed, Lt, Ls
+    scale = np.sin(np.radians(np.clip(elevation, 1, 90)))[:, None, None] * rng.uniform(0.7, 1.0, (n, 3, 1))
+    spectra = 500 + levels[None, :, None] * shape[None, None, :] * scale
+    spectra += rng.normal(0, 20, spectra.shape)
+    return np.clip(spectra, 0, 65535).astype(np.uint16)
+
+
+def day_of_samples(rng, day_start, interval, track, pending_after):
+    """Generate metadata rows and spectra for one day. Returns a list of (meta dict, [(sensor_id, inttime, spectrum)])"""
+    n = int(86400 / interval)
+    times = np.datetime64(day_start) + (np.arange(n) * interval * 1e6).astype('timedelta64[us]')
+    times += rng.integers(0, 1000000, n).astype('timedelta64[us]')  # sub-second jitter, as from datetime.now()
+
+    # slow random walk along a track
+    lat = track['lat'] + np.cumsum(rng.normal(0, 1e-4, n))
+    lon = track['lon'] + np.cumsum(rng.normal(0, 1e-4, n))
+    track['lat'], track['lon'] = lat[-1], lon[-1]
+    elevation = solar_elevation(lat, lon, times)
+    azimuth = (180 + 15 * ((times - times.astype('datetime64[D]')).astype('timedelta64[s]').astype(float) / 3600.0 - 12)) % 360
+    bearing = (track['bearing'] + np.cumsum(rng.normal(0, 0.5, n))) % 360
+    track['bearing'] = bearing[-1]
+
+    full = elevation > 30
+    ed_only = (elevation > 10) & (~full) & (np.arange(n) % 2 == 0)
+    gps_only = (~full) & (~ed_only) & (np.arange(n) % max(1, int(60 / interval)) == 0)
+    spectra = synthetic_spectra(rng, elevation, n)
+
+    samples = []
+    for i in np.flatnonzero(full | ed_only | gps_only):
+        pc_time = times[i].astype(datetime.datetime)
+        if full[i]:
+            spec = [(SENSOR_IDS[j], int(rng.choice([128, 256, 512, 1024])), spectra[i, j]) for j in range(3)]
+        elif ed_only[i]:
+            spec = [(SENSOR_IDS[0], int(rng.choice([64, 128, 256])), spectra[i, 0])]
+        else:
+            spec = []
+        uploaded = (len(spec) > 0) and (pc_time < pending_after)
+        meta = {'sample_uuid': str(uuid.UUID(bytes=rng.bytes(16), version=1)),
+                'pc_time': pc_time, 'gps_time': pc_time - datetime.timedelta(milliseconds=400), 'gps_fix': 3,
+                'gps_lat': float(lat[i]), 'gps_long': float(lon[i]), 'gps_speed': float(abs(rng.normal(3, 1))),
+                'platform_bearing': float(bearing[i]),
+                'sun_azimuth': float(azimuth[i]), 'sun_elevation': float(elevation[i]),
+                'rel_view_az': float(rng.uniform(90, 180)),
+                'motor_temp': float(rng.normal(30, 2)), 'driver_temp': float(rng.normal(35, 2)),
+                'pi_cpu_temp': float(rng.normal(50, 5)),
+                'tilt_avg': float(abs(rng.normal(2, 1))), 'tilt_std': float(abs(rng.normal(0.5, 0.2))),
+                'bearing_accuracy': float(abs(rng.normal(0.5, 0.2))), 'sorad_version': 2024.01,
+                'batt_v': float(rng.normal(12.8, 0.2)), 'inside_temp': float(rng.normal(25, 2)),
+                'inside_rel_hum': float(rng.normal(40, 5)),
+                'n_rad_obs': len(spec) if len(spec) > 0 else None,
+                'export_success': 1 if uploaded else None,
+                'export_attempts': 1 if uploaded else None}
+        samples.append((meta, spec))
+    return samples
+
+
+def to_layout(meta, layout):
+    """Rename and complete metadata fields for a legacy layout"""
+    if layout == 'current':
+        return meta
+    meta = dict(meta)
+    del meta['sample_uuid']
+    if layout == 'legacy_2020':
+        for key in ['time', 'fix', 'lat', 'long', 'speed']:
+            meta[f'gps1_{key}'] = meta[f'gps_{key}']
+            meta[f'gps2_{key}'] = meta.pop(f'gps_{key}')
+        meta['sos_inserted'] = meta.pop('export_success')
+        meta['sos_insertion_attempts'] = meta.pop('export_attempts')
+    return meta
+
+
+def generate(path, start, years, interval=30.0, layout='current', spectrum_format='text',
+             pending_days=7.0, lat=50.3, lon=-4.2, seed=1):
+    """Create a synthetic database at path. Returns the number of samples written"""
+    rng = np.random.default_rng(seed)
+    db_dict = {'file': path, 'spectrum_format': spectrum_format}
+    if layout != 'current':
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn, cur = db_func.connect_db(db_dict)
+        cur.execute(LEGACY_LAYOUTS[layout])
+        cur.execute(LEGACY_RADIOMETRY)
+        conn.commit()
+        conn.close()
+    # creates the current layout, or upgrades a legacy layout as the So-Rad software would
+    db_func.create_tables(db_dict)
+
+    conn, cur = db_func.connect_db(db_dict)
+    meta_columns = [c for c in db_func.column_names(conn, cur, table="sorad_metadata") if c != 'id_']
+    sql_meta = "INSERT INTO sorad_metadata({0}) VALUES ({1})".format(",".join(meta_columns), ",".join("?" * len(meta_columns)))
+    sql_rad = "INSERT INTO sorad_radiometry(metadata_id, sensor_id, inttime, measurement, spectrum_format) VALUES (?,?,?,?,?)"
+
+    end = start + datetime.timedelta(days=365.25 * years)
+    pending_after = end - datetime.timedelta(days=pending_days)
+    track = {'lat': lat, 'lon': lon, 'bearing': 90.0}
+    n_samples = 0
+    day = start
+    while day < end:
+        samples = day_of_samples(rng, day, interval, track, pending_after)
+        rad_rows = []
+        for meta, spec in samples:
+            if meta['pc_time'] >= end:
+                break
+            meta = to_layout(meta, layout)
+            cur.execute(sql_meta, [meta.get(c) for c in meta_columns])
+            sample_id = cur.lastrowid
+            for sensor_id, inttime, spectrum in spec:
+                measurement, fmt = db_func.encode_spectrum(spectrum if spectrum_format == 'uint16' else spectrum.tolist(), spectrum_format)
+                rad_rows.append((sample_id, sensor_id, inttime, measurement, fmt if layout == 'current' else None))
+            n_samples += 1
+        cur.executemany(sql_rad, rad_rows)
+        conn.commit()
+        log.debug(f"{day:%Y-%m-%d}: {len(samples)} samples")
+        if day.day == 1:
+            log.info(f"Generated data up to {day:%Y-%m-%d}, {n_samples} samples, {os.path.getsize(path) / 1024**2:.0f} Mb")
+        day += datetime.timedelta(days=1)
+
+    conn.close()
+    return n_samples
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # start logging to stdout
+    log = logging.getLogger()
+    handler = logging.StreamHandler(sys.stdout)
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+        handler.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+        handler.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s| %(levelname)s | %(name)s | %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+    start = datetime.datetime.strptime(args.start, "%Y%m%dT%H%M%S")
+    n_samples = generate(args.output, start, args.years, args.interval, args.layout, args.format,
+                         args.pending_days, args.lat, args.lon, args.seed)
+    log.info(f"Written {n_samples} samples to {args.output} ({os.path.getsize(args.output) / 1024**2:.1f} Mb)")
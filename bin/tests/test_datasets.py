@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the hdf and csv datasets appended to as samples are stored (append_to_datasets in functions/download_functions.py).
+Uses a small synthetic database in a temporary folder (see synthetic_database.py), no configuration or redis is needed.
+
+Run with pytest, or directly: python3 test_datasets.py
+"""
+import os
+import sys
+import glob
+import json
+import inspect
+import datetime
+import tempfile
+import functools
+import h5py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
+import functions.download_functions as df
+from synthetic_database import generate
+
+START = datetime.datetime(2022, 6, 10)
+
+
+def dataset_uuids(storage_path):
+    """SAMPLE_UUIDs in the hdf datasets, and sample uuids in the csv datasets (which have a line per sensor)"""
+    hdf_uuids, csv_uuids = [], []
+    for filename in sorted(glob.glob(os.path.join(storage_path, '*.hdf'))):
+        with h5py.File(filename, 'r') as f:
+            hdf_uuids += [u.decode() if isinstance(u, bytes) else u for u in f['sorad']['SAMPLE_UUID'][()]]
+    for filename in sorted(glob.glob(os.path.join(storage_path, '*.csv'))):
+        with open(filename) as f:
+            header = f.readline().split(',')
+            ix = header.index('sample_uuid')
+            csv_uuids += [line.split(',')[ix] for line in f][::3]
+    return hdf_uuids, csv_uuids
+
+
+def test_failed_update_continues_without_duplicates():
+    """Samples appended before an update fails are recorded in the state file, and not appended again by the next update"""
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, 'sorad_database.db')
+        storage_path = os.path.join(directory, 'datasets')
+        os.makedirs(storage_path)
+        state_file = os.path.join(storage_path, df.DATASETS_STATE_FILE)
+        generate(database_path, START, 2 / 365.25, interval=120.0)
+
+        iter_new_records, parse_records = df.iter_new_records, df.parse_records
+        calls = []
+
+        def failing_parse_records(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 3:
+                raise ValueError("simulated failure")
+            return parse_records(*args, **kwargs)
+
+        df.iter_new_records = functools.partial(iter_new_records, block_size=300)
+        df.parse_records = failing_parse_records
+        try:
+            try:
+                df.append_to_datasets(storage_path, database_path, 'p1', 'u1', 0, state_file=state_file)
+                raise AssertionError("update did not fail")
+            except ValueError:
+                pass
+            with open(state_file) as sf:
+                partial_id = json.load(sf)['last_id']
+            hdf_uuids, csv_uuids = dataset_uuids(storage_path)
+            assert partial_id > 0 and len(hdf_uuids) == 200 and hdf_uuids == csv_uuids, (partial_id, len(hdf_uuids))
+
+            df.parse_records = parse_records
+            last_id = df.append_to_datasets(storage_path, database_path, 'p1', 'u1', partial_id, state_file=state_file)
+        finally:
+            df.iter_new_records, df.parse_records = iter_new_records, parse_records
+
+        with open(state_file) as sf:
+            assert json.load(sf)['last_id'] == last_id
+        hdf_uuids, csv_uuids = dataset_uuids(storage_path)
+        complete = [r for records in iter_new_records({'file': database_path}, 0) for r in records]
+        assert len(hdf_uuids) == len(set(hdf_uuids)) == len(complete) // 3
+        assert hdf_uuids == csv_uuids
+
+
+def test_failed_write_leaves_datasets_unchanged():
+    """Files are appended to through copies, which are dropped when writing a block fails"""
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, 'sorad_database.db')
+        storage_path = os.path.join(directory, 'datasets')
+        os.makedirs(storage_path)
+        state_file = os.path.join(storage_path, df.DATASETS_STATE_FILE)
+        generate(database_path, START, 1 / 365.25, interval=120.0)
+
+        df.append_to_datasets(storage_path, database_path, 'p1', 'u1', 0, state_file=state_file)
+
+        with open(state_file) as sf:
+            state = sf.read()
+        contents = {}
+        for filename in glob.glob(os.path.join(storage_path, '*')):
+            with open(filename, 'rb') as f:
+                contents[filename] = f.read()
+
+        write = df.StreamingCSVWriter.write
+
+        def failing_write(self, data, n_records):
+            write(self, data[:len(data) // 2], n_records)
+            raise OSError("simulated failure")
+
+        df.StreamingCSVWriter.write = failing_write
+        try:
+            try:
+                df.append_to_datasets(storage_path, database_path, 'p1', 'u1', 0, state_file=state_file)
+                raise AssertionError("update did not fail")
+            except OSError:
+                pass
+        finally:
+            df.StreamingCSVWriter.write = write
+
+        with open(state_file) as sf:
+            assert sf.read() == state
+        assert sorted(glob.glob(os.path.join(storage_path, '*'))) == sorted(contents)
+        for filename, content in contents.items():
+            with open(filename, 'rb') as f:
+                assert f.read() == content, filename
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"{name}: ok")
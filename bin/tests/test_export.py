@@ -48,6 +48,10 @@ def parse_args():
                         help="Specify a specific software version to use.")
     parser.add_argument('-t', '--terse', required=False, action='store_true',
                         help="Suppress verbose outputs")
+    parser.add_argument('-a', '--audit', required=False, action='store_true',
+                        help="Recount total/pending/uploaded samples with a full table scan and correct the incremental counters")
+    parser.add_argument('-r', '--requeue', required=False, action='store_true',
+                        help="Retry samples of which the upload failed too often to be retried automatically")
 
 
     args = parser.parse_args()
@@ -93,6 +97,24 @@ if __name__ == '__main__':
     conn, cur = db_func.connect_db(db)
     db_func.database_info(conn, cur)
 
+    if args.audit:
+        for shard in db_func.list_shards(db):
+            shard_conn, shard_cur = db_func.connect_db({'file': shard})
+            n_total, n_pending, n_uploaded = db_func.recount_export_stats(shard_conn, shard_cur)
+            shard_conn.close()
+            log.info(f"Audit {os.path.basename(shard)}: {n_total} samples, {n_pending} pending upload, {n_uploaded} uploaded")
+
+    for shard in db_func.list_shards(db):
+        shard_conn, shard_cur = db_func.connect_db({'file': shard})
+        db_func.create_export_state(shard_conn, shard_cur)
+        if args.requeue:
+            log.info(f"{db_func.requeue_dead_exports(shard_conn, shard_cur)} samples in {os.path.basename(shard)} requeued for upload")
+        n_retry, n_dead = db_func.export_retry_counts(shard_conn, shard_cur)
+        shard_conn.commit()
+        shard_conn.close()
+        if n_retry + n_dead > 0:
+            log.info(f"{os.path.basename(shard)}: {n_retry} samples waiting for another upload attempt, {n_dead} no longer retried")
+
     n_total, n_not_inserted, all_not_inserted = exp.identify_new_local_records(db, limit=0)
     log.info(f"{n_not_inserted} records pending upload")
     conn.close()
@@ -121,5 +143,5 @@ if __name__ == '__main__':
                                                               update_local=True)
         log.info(f"{successes} records uploaded")
     else:
-        export_result, status_code = exp.update_status_parse_server(export_conf, db)
+        export_result, status_code, object_id = exp.update_status_parse_server(export_conf, db)
         log.info(f"status upload success: {export_result}")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the journal that keeps records the database could not accept (functions/journal_functions.py).
+Uses a temporary folder only, no configuration or database is needed.
+
+Run with pytest, or directly: python3 test_journal.py
+"""
+import os
+import sys
+import inspect
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
+import functions.journal_functions as journal
+
+
+def make_records(n, first=0):
+    return [{'sample_uuid': f"uuid-{i}", 'values': {'n': i}} for i in range(first, first + n)]
+
+
+def test_round_trip():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sorad_database.journal')
+        records = make_records(5)
+        journal.append_records(path, records[:2])
+        journal.append_records(path, records[2:])
+        assert journal.read_records(path) == records
+
+
+def test_torn_frame_ignored():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sorad_database.journal')
+        records = make_records(3)
+        journal.append_records(path, records)
+        with open(path, 'ab') as jf:
+            jf.write(b'\x10\x00\x00\x00torn')
+        assert journal.read_records(path) == records
+
+
+def test_write_records_ignores_stale_tmp():
+    """A temporary file left by an interrupted write_records must not end up in front of the new records"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sorad_database.journal.replay')
+        records = make_records(2)
+
+        # torn frame
+        with open(path + '.tmp', 'wb') as jf:
+            jf.write(b'\xff\x00\x00\x00\x00\x00\x00\x00torn')
+        journal.write_records(path, records)
+        assert journal.read_records(path) == records
+
+        # complete records of an earlier replay
+        journal.append_records(path + '.tmp', make_records(3, first=10))
+        journal.write_records(path, records)
+        assert journal.read_records(path) == records
+        assert not os.path.exists(path + '.tmp')
+
+
+def test_write_records_removes_empty_journal():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sorad_database.journal.replay')
+        journal.write_records(path, make_records(2))
+        journal.write_records(path, [])
+        assert not os.path.exists(path)
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"{name}: ok")
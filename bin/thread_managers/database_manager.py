@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Manager class to own all writes of new samples to the local database
+
+The main program loop hands over records to an in-memory queue and carries on measuring.
+A single long-lived connection takes records from the queue and commits them in small transactions.
+If the database is locked (e.g. by the export manager or a dataset generation job) the transaction
+is rolled back and the records are appended to the journal (functions/journal_functions.py) instead,
+so no sample is dropped and the queue does not build up. The journal is replayed into the database
+with a backoff until the lock clears, and at startup if anything was left over. Records that are still
+queued when the manager is stopped are flushed before the thread exits.
+
+Without the writer thread, samples are committed directly by the main loop (db_functions.commit_db), which also
+keeps them in the journal if the database is locked. A JournalReplayer then merges them back in the background.
+
+Plymouth Marine Laboratory
+License: see README.md
+"""
+import logging
+import threading
+import queue
+import time
+import datetime
+import sqlite3
+import functions.redis_functions as rf
+import functions.db_functions as db_func
+import functions.journal_functions as journal
+
+# initiate logging
+log = logging.getLogger('dbwriter')
+# initiate redis connection
+redis_client = rf.init()
+
+
+class DatabaseWriter(object):
+    """
+    Database writer: commit queued records to the local database in batched transactions
+    """
+    def __init__(self, db_dict):
+        """
+        Initialise this class from the database dictionary prepared in initialisation.py
+        : db_dict contains the [DATABASE] configuration, including writer_batch_size and writer_max_wait_sec
+        """
+        self.db_dict = db_dict
+        self.batch_size = db_dict['writer_batch_size']
+        self.max_wait = db_dict['writer_max_wait_sec']
+        self.queue = queue.Queue()
+
+        self.updated = None  # typically a datetime to indicate last time the class instance values were updated
+        self.thread = None
+        self.started = False
+        self.stop_monitor = False
+        self.sleep_interval = 0.2
+        self.retry_interval_max = 30.0
+
+        self.conn = None
+        self.cur = None
+        self.connected_file = None
+
+        # records are diverted to the journal while the database is unavailable
+        self.journal = journal.journal_path(db_func.base_path(db_dict))
+        self.spilling = False
+        self.replay_attempt = 0
+        self.next_replay = None
+        # records that could not be written to the database nor the journal, retried with a backoff
+        self.held = []
+        self.spill_attempt = 0
+        self.next_spill = None
+
+        # statistics
+        self.n_committed = 0
+        self.n_retries = 0
+        self.n_spilled = 0
+        self.last_commit_latency = None  # seconds, for the last transaction
+        self.max_commit_latency = None   # seconds, since start
+        self.last_sample_id = None
+
+    def __repr__(self):
+        return f"Database writer: {self.queue_depth()} queued, {self.n_committed} committed, {self.n_spilled} spilled to journal, {self.n_retries} retries"
+
+    def queue_depth(self):
+        """Number of records waiting to be written"""
+        return self.queue.qsize()
+
+    def put(self, values, trigger_id, spectra_data, software_version=0):
+        """Queue a new sample for writing. Returns the sample_uuid assigned to the record"""
+        record = db_func.make_record(values, trigger_id, spectra_data, software_version)
+        db_func.store_spectra(self.db_dict, record)
+        self.queue.put(record)
+        return record['sample_uuid']
+
+    def start(self):
+        """
+        Starts writing thread.
+        """
+        if not self.started:
+            self.started = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+            log.info("Started Database writer")
+        else:
+            log.warn("Could not start Database writer")
+
+    def stop(self):
+        """
+        Stop the writing thread once all queued records have been written
+        """
+        log.info(f"Stopping Database writer ({self.queue_depth()} records queued)")
+        self.stop_monitor = True
+        try:
+            self.thread.join(self.retry_interval_max + 10*self.sleep_interval)
+            log.info("Database writer running = {0}".format(self.thread.is_alive()))
+        except AttributeError:
+            pass
+        self.started = False
+
+    def __del__(self):
+        self.stop()
+
+    def connect(self):
+        """(Re)open the long-lived connection used by this thread"""
+        self.disconnect()
+        self.connected_file = db_func.current_shard(self.db_dict)
+        self.conn, self.cur = db_func.connect_db(self.db_dict)
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn, self.cur = None, None
+
+    def collect_batch(self):
+        """Wait for records and return up to batch_size of them, waiting at most max_wait after the first record arrived"""
+        try:
+            batch = [self.queue.get(timeout=self.sleep_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while (len(batch) < self.batch_size) and (not self.stop_monitor):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # don't hold back anything already waiting
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def check_connection(self):
+        """Connect on first use, or when a new shard period has started"""
+        if (self.conn is None) or (db_func.current_shard(self.db_dict) != self.connected_file):
+            self.connect()
+
+    def write_batch(self, batch):
+        """Commit a batch of records, or spill them to the journal if the database does not accept them.
+        Returns the new sample ids, or None if the records were spilled"""
+        # records held back earlier go first
+        batch = self.held + batch
+        self.held = []
+        if self.spilling:
+            # keep records in order: older records are waiting in the journal
+            self.spill(batch)
+            return None
+
+        t0 = time.perf_counter()
+        try:
+            self.check_connection()
+            sample_ids = db_func.commit_records(self.db_dict, batch, self.conn, self.cur)
+            self.last_commit_latency = time.perf_counter() - t0
+            if (self.max_commit_latency is None) or (self.last_commit_latency > self.max_commit_latency):
+                self.max_commit_latency = self.last_commit_latency
+            self.n_committed += len(batch)
+            self.last_sample_id = sample_ids[-1]
+            return sample_ids
+
+        except sqlite3.OperationalError as err:
+            # typically 'database is locked'. Keep the connection and replay later
+            log.warning(f"Database busy, {len(batch)} record(s) moved to journal: {err}")
+        except Exception as err:
+            log.error(f"Error writing {len(batch)} record(s) to database, moved to journal: {err}")
+            self.disconnect()
+
+        if self.spill(batch):
+            self.spilling = True
+            self.replay_attempt = 0
+            self.next_replay = time.perf_counter() + self.sleep_interval
+        return None
+
+    def spill(self, batch):
+        """Append records to the journal. If even that fails, hold them back and try again (database first) with a
+        backoff, without holding up the thread. Returns True if the records were written to the journal"""
+        if (self.next_spill is not None) and (time.perf_counter() < self.next_spill):
+            self.held = batch
+            return False
+        try:
+            journal.append_records(self.journal, batch)
+            self.n_spilled += len(batch)
+            self.spill_attempt = 0
+            self.next_spill = None
+            return True
+        except Exception as err:
+            log.error(f"Could not write {len(batch)} record(s) to journal, held back (attempt {self.spill_attempt+1}): {err}")
+            self.held = batch
+            self.spill_attempt += 1
+            self.next_spill = time.perf_counter() + min(self.sleep_interval * 2**self.spill_attempt, self.retry_interval_max)
+            return False
+
+    def replay(self):
+        """Merge spilled records back into the database, backing off while it remains unavailable"""
+        try:
+            self.check_connection()
+            n_replayed = db_func.replay_journal(self.db_dict, self.conn, self.cur, batch_size=self.batch_size)
+            if n_replayed > 0:
+                log.info(f"{n_replayed} record(s) replayed from journal")
+            self.n_committed += n_replayed
+            self.replay_attempt = 0
+            self.spilling = journal.pending_records(self.journal)
+        except sqlite3.OperationalError as err:
+            log.warning(f"Database busy, journal replay postponed (attempt {self.replay_attempt+1}): {err}")
+            self.replay_attempt += 1
+            self.n_retries += 1
+        except Exception as err:
+            log.error(f"Error replaying journal (attempt {self.replay_attempt+1}): {err}")
+            self.disconnect()
+            self.replay_attempt += 1
+            self.n_retries += 1
+        self.next_replay = time.perf_counter() + min(self.sleep_interval * 2**self.replay_attempt, self.retry_interval_max)
+
+    def update_redis(self):
+        """Publish queue depth and commit latency"""
+        rf.store(redis_client, 'db_queue_depth', self.queue_depth(), expires=30)
+        rf.store(redis_client, 'db_journal_spilled', self.n_spilled, expires=30)
+        if self.last_commit_latency is not None:
+            rf.store(redis_client, 'db_commit_latency_ms', round(1000 * self.last_commit_latency, 1), expires=30)
+
+    def run(self):
+        """
+        Main loop of the thread.
+        Write queued records until stopped and the queue is empty.
+        """
+        log.info("Starting Database writer thread")
+        if journal.pending_records(self.journal):
+            # left over from an earlier run
+            log.info(f"Found records in journal {self.journal}")
+            self.spilling = True
+            self.next_replay = time.perf_counter()
+
+        while not (self.stop_monitor and self.queue.empty()):
+            if self.spilling and (time.perf_counter() >= self.next_replay):
+                self.replay()
+            batch = self.collect_batch()
+            if (len(batch) > 0) or ((len(self.held) > 0) and (time.perf_counter() >= self.next_spill)):
+                sample_ids = self.write_batch(batch)
+                if sample_ids is not None:
+                    log.debug(f"{len(sample_ids)} record(s) committed in {1000*self.last_commit_latency:.1f} ms, last id {sample_ids[-1]}")
+                self.updated = datetime.datetime.now()
+                try:
+                    self.update_redis()
+                except Exception as err:
+                    log.debug(f"Could not update redis: {err}")
+
+        if len(self.held) > 0:
+            # last attempt, without waiting for the backoff
+            self.next_spill = None
+            self.write_batch([])
+            if len(self.held) > 0:
+                log.error(f"{len(self.held)} record(s) could not be written to the database nor the journal and are lost")
+        if self.spilling:
+            # last attempt, anything left is replayed at the next start
+            self.replay()
+        self.disconnect()
+        log.info(f"Database writer finished, {self.n_committed} records committed, {self.n_spilled} spilled to journal")
+
+
+class JournalReplayer(object):
+    """
+    Journal replayer: merge records kept in the journal back into the database, for use without the database writer
+    """
+    def __init__(self, db_dict):
+        """
+        Initialise this class from the database dictionary prepared in initialisation.py
+        """
+        self.db_dict = db_dict
+        self.journal = journal.journal_path(db_func.base_path(db_dict))
+
+        self.thread = None
+        self.started = False
+        self.stop_monitor = False
+        self.sleep_interval = 1.0
+        self.check_interval = 10.0  # seconds between checks for new records in the journal
+        self.retry_interval_max = 300.0
+        self.replay_attempt = 0
+        self.next_replay = None
+        self.n_replayed = 0
+
+    def __repr__(self):
+        return f"Journal replayer: {self.n_replayed} records replayed"
+
+    def start(self):
+        """
+        Starts replaying thread.
+        """
+        if not self.started:
+            self.started = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+            log.info("Started Journal replayer")
+        else:
+            log.warn("Could not start Journal replayer")
+
+    def stop(self):
+        """
+        Stop the replaying thread
+        """
+        log.info("Stopping Journal replayer")
+        self.stop_monitor = True
+        try:
+            self.thread.join(10*self.sleep_interval)
+            log.info("Journal replayer running = {0}".format(self.thread.is_alive()))
+        except AttributeError:
+            pass
+        self.started = False
+
+    def __del__(self):
+        self.stop()
+
+    def replay(self):
+        """Merge journaled records back into the database, backing off while it remains unavailable"""
+        try:
+            n_replayed = db_func.replay_journal(self.db_dict)
+            if n_replayed > 0:
+                log.info(f"{n_replayed} record(s) replayed from journal")
+            self.n_replayed += n_replayed
+            self.replay_attempt = 0
+            self.next_replay = time.perf_counter() + self.check_interval
+        except Exception as err:
+            log.warning(f"Journal replay postponed (attempt {self.replay_attempt+1}): {err}")
+            self.replay_attempt += 1
+            self.next_replay = time.perf_counter() + min(self.check_interval * 2**(self.replay_attempt-1), self.retry_interval_max)
+
+    def run(self):
+        """
+        Main loop of the thread.
+        Replay the journal whenever records are found in it, including any left over from an earlier run.
+        """
+        log.info("Starting Journal replayer thread")
+        self.next_replay = time.perf_counter()
+        while not self.stop_monitor:
+            if (time.perf_counter() >= self.next_replay) and journal.pending_records(self.journal):
+                self.replay()
+            time.sleep(self.sleep_interval)
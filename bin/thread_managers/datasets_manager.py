@@ -25,6 +25,8 @@ log = logging.getLogger('datasets')
 # link to or create redis queue 'sorad_q'
 sorad_q = Queue('sorad_q', connection=Redis())
 
+DATASETS_JOB_ID = 'sorad_datasets_update'  # at most one dataset update is queued or running at a time
+
 class DatasetsManager(object):
     """
     Parseserver export manager: upload to remote server and automate generation of downloadable HDFs
@@ -43,6 +45,10 @@ class DatasetsManager(object):
         self.platform_uuid = datasets_dict['platform_uuid']
         self.max_storage = datasets_dict['max_storage_gb']
         self.storage_protocol = datasets_dict['storage_protocol']
+        self.compress_csv = datasets_dict.get('compress_csv', False)
+        self.dataset_period = datasets_dict.get('dataset_period', 'day')
+        self.dataset_formats = datasets_dict.get('dataset_formats', df.DATASET_FORMATS)
+        self.dataset_interval_mins = datasets_dict.get('dataset_interval_mins', 15)
 
         self.stored_gb = None
         self.last_storage_check = None
@@ -54,10 +60,9 @@ class DatasetsManager(object):
         self.started = False
         self.stop_monitor = False
         self.sleep_interval = 1.0  # minimum interval between cycles
-        self.hdf_creation_interval_mins = 60
 
-        # on initialisation set the last hdf creation time to the top of the current hour
-        self.last_hdf_requested = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        # datasets per period are appended to by a job in the redis queue, from the last sample added to them
+        self.last_dataset_update = None
 
     def update_values(self):
         """
@@ -96,6 +101,20 @@ class DatasetsManager(object):
     def __del__(self):
         self.stop()
 
+    def update_datasets(self):
+        """
+        Queue a job appending samples stored since the last update to the datasets of their period (see
+        download_functions.update_datasets), unless the previous one is still waiting or running.
+        Files are read and written by the rq worker, not by the sampling process.
+        """
+        job = sorad_q.fetch_job(DATASETS_JOB_ID)
+        if (job is not None) and (job.get_status() in ['queued', 'started', 'deferred', 'scheduled']):
+            log.debug(f"Dataset update still {job.get_status()}, not queued again")
+            return
+        sorad_q.enqueue(df.update_datasets, self.storage_path, self.database_path, self.platform_id, self.platform_uuid,
+                        period=self.dataset_period, formats=self.dataset_formats, compress=self.compress_csv,
+                        job_id=DATASETS_JOB_ID, job_timeout=3400)
+
     def check_storage(self):
         '''
         Check storage volume
@@ -118,9 +137,8 @@ class DatasetsManager(object):
         Currently we use a rolling archive: remove a number of files as needed to bring stored volume back below threshold, oldest files first.
         '''
         if self.storage_protocol == 'rolling_archive':
-            filelist_csv = glob.glob(os.path.join(self.storage_path, '*.csv'))
-            filelist_hdf = glob.glob(os.path.join(self.storage_path, '*.hdf'))
-            filelist = np.array(filelist_csv + filelist_hdf)
+            filelist = np.array([f for mask in df.CSV_MASKS + df.HDF_MASKS
+                                 for f in glob.glob(os.path.join(self.storage_path, mask))])
             filedates = np.array([os.stat(f).st_mtime for f in filelist])
             filesizes = np.array([os.stat(f).st_size for f in filelist])
             filesizes_sorted = filesizes[np.argsort(filedates)]
@@ -150,20 +168,14 @@ class DatasetsManager(object):
 
         while not self.stop_monitor:
 
-            # hdf generation
-            if datetime.datetime.now() > (self.last_hdf_requested + datetime.timedelta(minutes=60)):
+            # append new samples to the datasets per period
+            if (self.dataset_period != 'none') and ((self.last_dataset_update is None) or \
+                (datetime.datetime.now() > (self.last_dataset_update + datetime.timedelta(minutes=self.dataset_interval_mins)))):
                 try:
-                    hdf_start_time = self.last_hdf_requested
-                    hdf_end_time = self.last_hdf_requested.replace(minute=59, second=59, microsecond=999999)
-                    log.info(f"Requesting HDF dataset from {hdf_start_time.isoformat()} to {hdf_end_time.isoformat()}")
-                    job = sorad_q.enqueue(df.hdf_from_web_request, self.storage_path, self.database_path,
-                                                                   hdf_start_time, hdf_end_time,
-                                                                   self.platform_id, self.platform_uuid,
-                                                                   job_timeout=3400)
-                    self.last_hdf_requested = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
-                    log.info(job)
+                    self.update_datasets()
                 except Exception as err:
                     log.exception(err)
+                self.last_dataset_update = datetime.datetime.now()
 
 
             # check and adjust stored datasets volume periodically
@@ -13,8 +13,12 @@ import time
 import numpy as np
 import datetime
 import functions.redis_functions as rf
-from functions.export_functions import run_export, update_status_parse_server, identify_new_local_records
+from functions.export_functions import run_export_pipeline, update_status_parse_server, identify_new_local_records, count_uploadable_records, \
+    UploadPool
 from functions.check_functions import check_internet, check_remote_data_store
+import functions.http_functions as http
+from functions.link_functions import AdaptiveLink
+import functions.budget_functions as bf
 import functions.download_functions as df
 from redis import Redis
 
@@ -46,10 +50,27 @@ class ParseExportManager(object):
         self.upload_interval = int(export_dict['data_upload_interval_sec'])
         self.status_update_interval = int(export_dict['status_update_interval_sec'])
         self.connection_retry_interval = 300
+        self.concurrency = export_dict.get('export_concurrency', 1)  # number of uploads in flight at the same time
+        self.uploaded_this_cycle = 0
+        self.link = AdaptiveLink(export_dict) if export_dict.get('adaptive_export', False) else None  # adapts uploads to the link quality
+        self.upload_pool = None  # upload threads, kept while the thread runs so that connections are reused between cycles
+        self.budget = bf.UploadBudget(export_dict)  # data allowance for uploads, see budget_functions.py
+        self.cheap_link = None  # reason a cheap link is available, if any
+        self.status_object_id = self.cached_status_object_id()  # objectId of the status record on the remote server
+        self.realtime_window = datetime.timedelta(seconds=export_dict.get('export_realtime_window_sec', 3600))
+        self.backfill_age = datetime.timedelta(seconds=export_dict.get('export_backfill_age_sec', 7*86400))
+        if self.budget.limited:
+            try:
+                # continue counting from before a restart
+                budget_state, _, _ = rf.retrieve(redis_client, 'upload_budget', freshness=None)
+                self.budget.restore(budget_state)
+            except Exception as err:
+                log.warning(f"Upload budget state not restored: {err}")
 
         self.n_total = None
         self.n_not_inserted = None
         self.all_not_inserted = None
+        self.n_uploadable = None  # pending samples due for an upload attempt
 
         # prime all timers
         self.last_db_check = datetime.datetime.now() - datetime.timedelta(seconds=self.upload_interval)
@@ -65,6 +86,73 @@ class ParseExportManager(object):
         self.updated = datetime.datetime.now()
         return
 
+    def report_progress(self, n_uploaded, n_failed):
+        """Publish upload progress, called after the results of each upload are written to the database"""
+        self.uploaded_this_cycle += n_uploaded
+        if n_uploaded > 0:
+            rf.store(redis_client, 'upload_status', f'{self.uploaded_this_cycle}_records_uploaded', expires=30)
+        if self.link is not None:
+            rf.store(redis_client, 'link_quality', self.link.as_dict(), expires=600)
+
+    def cached_status_object_id(self):
+        """objectId of the remote status record saved in redis by an earlier run, if it was for the same server and platform"""
+        try:
+            cached, _, _ = rf.retrieve(redis_client, 'status_object_id', freshness=None)
+        except Exception as err:
+            log.warning(f"Status record objectId not read from redis: {err}")
+            return None
+        if (cached is None) or (cached.get('parse_url') != self.export_dict['parse_url']) or \
+                (cached.get('platform_id') != self.export_dict['platform_id']):
+            return None
+        return cached.get('objectId')
+
+    def check_cheap_link(self):
+        """Check whether a cheap link is available (see budget_functions.cheap_link) and log changes"""
+        position = None
+        if len(self.export_dict.get('export_cheap_link_geofences', [])) > 0:
+            gps, _, _ = rf.retrieve(redis_client, 'gps_manager', freshness=60)
+            if (gps is not None) and (gps.get('lat') is not None) and (gps.get('lon') is not None):
+                position = (gps['lat'], gps['lon'])
+        cheap_link = bf.cheap_link(self.export_dict, position)
+        if cheap_link != self.cheap_link:
+            log.info(f"Cheap link available: {cheap_link}" if cheap_link else "No cheap link available, uploads are metered")
+        self.cheap_link = cheap_link
+        rf.store(redis_client, 'cheap_link', cheap_link, expires=600)
+        return cheap_link
+
+    def spend(self, tier, traffic_start):
+        """Count traffic since traffic_start (http_functions.traffic) against the upload budget, unless on a cheap link"""
+        if self.budget.limited and not self.cheap_link:
+            self.budget.spend(tier, http.traffic() - traffic_start)
+            rf.store(redis_client, 'upload_budget', self.budget.as_dict(), expires=86400)
+
+    def upload_tier(self, tier, since=None):
+        """Upload pending samples recorded since a time (all if None), within the budget of the tier. Returns export result and records uploaded"""
+        remaining = None if self.cheap_link else self.budget.remaining(tier)
+        if remaining == 0:
+            log.debug(f"Upload budget for {tier} data used up for this {self.budget.period}")
+            rf.store(redis_client, 'upload_status', f'{tier}_budget_used', expires=30)
+            return None, 0
+        traffic_start = http.traffic()
+
+        def should_stop():
+            if self.stop_monitor:
+                return True
+            if remaining is None:
+                return False
+            # leave room for the uploads still in flight and the next one, at the average size of uploads so far
+            n_uploads = http.request_count('upload') + http.request_count('batch_upload')
+            upload_size = (http.traffic('upload') + http.traffic('batch_upload')) / n_uploads if n_uploads > 0 else 0
+            in_flight = (self.concurrency if self.link is None else self.link.concurrency) + 1
+            return http.traffic() - traffic_start + upload_size * in_flight >= remaining
+
+        export_result, successes = run_export_pipeline(self.export_dict, self.db_dict, limit=None, concurrency=self.concurrency,
+                                                       fail_limit=3, should_stop=should_stop, on_commit=self.report_progress,
+                                                       link=self.link, since=since, pool=self.upload_pool)
+        self.spend(tier, traffic_start)
+        log.debug(f"{tier}: {successes} sensor records uploaded, {http.traffic() - traffic_start} bytes")
+        return export_result, successes
+
     def __repr__(self):
         return f"Export Manager x: {x:0.2f} y: {y:0.2f} z: {z:0.2f}"
 
@@ -106,6 +194,7 @@ class ParseExportManager(object):
         """
         log.info("Starting Export manager thread")
         export_result = None
+        self.upload_pool = UploadPool(max(self.concurrency if self.link is None else self.link.concurrency_max, 1))
 
         while not self.stop_monitor:
 
@@ -113,6 +202,7 @@ class ParseExportManager(object):
             if self.last_db_check + datetime.timedelta(seconds=self.upload_interval) < datetime.datetime.now():
                 # check local db
                 self.n_total, self.n_not_inserted, self.all_not_inserted = identify_new_local_records(self.db_dict, limit=0)
+                self.n_uploadable = count_uploadable_records(self.db_dict)
                 self.last_db_check = datetime.datetime.now()
 
                 if self.n_not_inserted > 0:
@@ -140,18 +230,30 @@ class ParseExportManager(object):
 
             # system status upload
             if self.last_status_update + datetime.timedelta(seconds=self.status_update_interval) < datetime.datetime.now():
-                if check_remote_data_store(self.export_dict)[0]:
+                traffic_start = http.traffic()
+                if self.budget.limited and not self.check_cheap_link() and not self.budget.available('realtime'):
+                    log.debug(f"Upload budget used up for this {self.budget.period}, status update skipped")
+                    rf.store(redis_client, 'upload_status', 'realtime_budget_used', expires=30)
+                    self.last_status_update = datetime.datetime.now()
+                elif check_remote_data_store(self.export_dict)[0]:
                     self.last_connectivity_check_result = True
                     self.last_connectivity_check_time = datetime.datetime.now()
-                    export_result, resultcode = update_status_parse_server(self.export_dict, self.db_dict)
+                    export_result, resultcode, object_id = update_status_parse_server(self.export_dict, self.db_dict, self.status_object_id)
+                    if object_id != self.status_object_id:
+                        # remember the status record, so the next update does not need to look it up
+                        self.status_object_id = object_id
+                        rf.store(redis_client, 'status_object_id', {'objectId': object_id, 'parse_url': self.export_dict['parse_url'],
+                                                                    'platform_id': self.export_dict['platform_id']}, expires=86400)
                     sucorfail = {True: 'succeeded', False:'failed'}[export_result]
                     log.info(f"Instrument status update on remote server {sucorfail}")
                     if export_result:
                         rf.store(redis_client, 'upload_status', 'remote_status_updated', expires=30)
                     self.last_status_update = datetime.datetime.now()
+                    self.spend('realtime', traffic_start)
                 else:
                     log.info(f"No connection to remote server to update instrument status. Retry in 300s")
                     rf.store(redis_client, 'upload_status', 'no_connection_to_server', expires=30)
+                    self.spend('realtime', traffic_start)
                     self.last_connectivity_check_result = False
                     self.last_connectivity_check_time = datetime.datetime.now()
                     time.sleep(self.sleep_interval)
@@ -161,23 +263,33 @@ class ParseExportManager(object):
             #    continue
 
             # data upload, unless an export/update just failed
-            if (self.n_not_inserted > 0) and \
+            # samples that are no longer retried, or waiting for their next attempt, do not start an upload
+            if (self.n_uploadable > 0) and \
                   (export_result in [True, None]) and \
                   (self.last_data_export + datetime.timedelta(seconds=self.upload_interval) < datetime.datetime.now()):
 
                 if check_remote_data_store(self.export_dict)[0]:
                     self.last_connectivity_check_result = True
                     self.last_connectivity_check_time = datetime.datetime.now()
-                    while (self.n_not_inserted > 0) and (export_result) and (not self.stop_monitor):
-                        # upload data until no more samples remain or an upload fails.
-                        log.debug("Uploading latest 10 samples ({n_not_inserted} pending)")
-                        export_result, resultcode, successes = run_export(self.export_dict, self.db_dict, limit=10, test_run=False, fail_limit=3)
-                        log.info(f"{successes} sensor records uploaded. Request completed: {export_result}")
-                        if export_result:
-                            rf.store(redis_client, 'upload_status', f'{successes}_records_uploaded', expires=30)
-                        self.n_total, self.n_not_inserted, self.all_not_inserted = identify_new_local_records(self.db_dict, limit=0)
-                        rf.store(redis_client, 'samples_pending_upload', self.n_not_inserted, expires=30)
-                        time.sleep(0.05)
+                    # upload data, newest first, until no more samples remain, uploads keep failing or the budget is used up.
+                    # Recent samples go first within the share of the budget reserved for them, older samples are only
+                    # uploaded on a cheap link (if one can be detected).
+                    log.debug(f"Uploading {self.n_not_inserted} pending samples, {self.concurrency} uploads at a time")
+                    self.uploaded_this_cycle = 0
+                    self.check_cheap_link()
+                    now = datetime.datetime.now()
+                    tiers = []
+                    if self.budget.limited and not self.cheap_link:
+                        tiers.append(('realtime', now - self.realtime_window))
+                    backfill = self.cheap_link or not bf.cheap_link_configured(self.export_dict)
+                    tiers.append(('backlog', None if backfill else now - self.backfill_age))
+                    results = [self.upload_tier(tier, since) for tier, since in tiers]
+                    successes = sum(n for _, n in results)
+                    export_result = False if False in [r for r, _ in results] else (True if True in [r for r, _ in results] else None)
+                    log.info(f"{successes} sensor records uploaded. Requests completed: {export_result}")
+                    self.n_total, self.n_not_inserted, self.all_not_inserted = identify_new_local_records(self.db_dict, limit=0)
+                    self.n_uploadable = count_uploadable_records(self.db_dict)
+                    rf.store(redis_client, 'samples_pending_upload', self.n_not_inserted, expires=30)
                     self.last_data_export = datetime.datetime.now()
                 else:
                     log.debug(f"No connection to remote server. Retry in 300s")
@@ -192,3 +304,7 @@ class ParseExportManager(object):
             # sleep for a standard period, ideally close to the refresh frequency
             time.sleep(self.sleep_interval)
             continue
+
+        # close connections kept alive for uploads from this thread and the upload threads
+        http.close_sessions()
+        self.upload_pool.close()
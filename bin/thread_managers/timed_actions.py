@@ -14,6 +14,7 @@ import time
 import numpy as np
 import datetime
 from functions import timed_functions as tf
+from functions import archive_functions as af
 
 log = logging.getLogger('maintenance')
 
@@ -22,11 +23,12 @@ class MaintenanceManager(object):
     """
     docstring for XYZ Manager class
     """
-    def __init__(self, config_dict):
+    def __init__(self, config_dict, db_dict=None):
         """
         Initialise this class from a dictionary reflecting a section of the config file.
         : config_dict is a specific section [MISC] of the config file from which settings can be read here:
               self. example_setting = config_dict.getint('example_setting')
+        : db_dict is the database dictionary prepared in initialisation.py, needed for archiving
         """
         self.updated = None  # typically a datetime to indicate last time the class instance values were updated
         self.thread = None
@@ -38,6 +40,14 @@ class MaintenanceManager(object):
         self.last_timesync_requested = datetime.datetime.now() - datetime.timedelta(minutes=1)  # primed, 1 min delay
         self.timesync_interval_mins = 60  # every 60 minutes
 
+        # archive uploaded records from the database
+        self.db_dict = db_dict
+        self.use_archive = config_dict.getboolean('use_archive', fallback=False) and (db_dict is not None) and db_dict['used']
+        self.archive_retention_days = config_dict.getfloat('archive_retention_days', fallback=90)
+        self.archive_interval_hours = config_dict.getfloat('archive_interval_hours', fallback=24)
+        self.archive_batch_size = config_dict.getint('archive_batch_size', fallback=500)
+        self.last_archive_run = datetime.datetime.now() - datetime.timedelta(hours=self.archive_interval_hours) + datetime.timedelta(minutes=10)  # primed, 10 min delay
+
     def update_values(self):
         """
         update_values
@@ -85,6 +95,15 @@ class MaintenanceManager(object):
                 self.last_timesync_requested = datetime.datetime.now()
                 self.update_values()
 
+            if self.use_archive and (datetime.datetime.now() > (self.last_archive_run + datetime.timedelta(hours=self.archive_interval_hours))):
+                try:
+                    af.archive_uploaded(self.db_dict, self.archive_retention_days, self.archive_batch_size,
+                                        should_stop=lambda: self.stop_monitor)
+                except Exception as err:
+                    log.warning(f"Archiving failed: {err}")
+                self.last_archive_run = datetime.datetime.now()
+                self.update_values()
+
             # sleep for a standard period, ideally close to the refresh frequency
             time.sleep(self.sleep_interval)
             continue
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read-only database access for the web service.
+
+Each web server thread keeps its own read-only (mode=ro) connection per database file, so page requests
+never take a write lock and sqlite can reuse its prepared statements. Recent rows are read with keyset queries
+on id_, and cached until a newer sample is written.
+"""
+import os
+import time
+import sqlite3
+import threading
+from functions import db_functions as db_func
+
+local = threading.local()  # connections of the current thread, by database file
+cache_lock = threading.Lock()
+latest_rows_cache = {}  # (database path, n) -> (latest id_, rows)
+shard_cache = {}        # database path -> (time read, list of shards)
+SHARD_CACHE_SECONDS = 60
+
+SQL_LATEST_ID = "SELECT max(id_) FROM sorad_metadata"
+SQL_ROWS_BEFORE = "SELECT * FROM sorad_metadata WHERE id_ <= ? ORDER BY id_ DESC LIMIT ?"
+SQL_EXPORT_COUNTS = "SELECT n_total, n_pending, n_uploaded FROM sorad_export_stats WHERE id_ = 1"
+
+
+def get_connection(path):
+    """Read-only connection to the database file at path, reused within the current thread.
+    A new connection is opened if the file has been replaced (e.g. renamed and a new database started)"""
+    if not hasattr(local, 'connections'):
+        local.connections = {}
+    inode = os.stat(path).st_ino
+    conn, conn_inode = local.connections.get(path, (None, None))
+    if (conn is not None) and (conn_inode != inode):
+        conn.close()
+        conn = None
+    if conn is None:
+        conn, _ = db_func.connect_db_readonly(path)
+        conn.row_factory = sqlite3.Row
+        local.connections[path] = (conn, inode)
+    return conn
+
+
+def list_shards(db_path):
+    """Database files to read from, oldest first. The catalog is read at most once a minute"""
+    with cache_lock:
+        read_time, shards = shard_cache.get(db_path, (0, None))
+    if (shards is None) or (time.monotonic() - read_time > SHARD_CACHE_SECONDS) or not all(os.path.exists(s) for s in shards):
+        shards = db_func.list_shards({'file': db_path})
+        with cache_lock:
+            shard_cache[db_path] = (time.monotonic(), shards)
+    return shards
+
+
+def latest_id(path):
+    """id_ of the latest record in a database file, None if it is empty"""
+    return get_connection(path).execute(SQL_LATEST_ID).fetchone()[0]
+
+
+def get_latest_rows(db_path, n=10):
+    """Return the last n rows of sorad_metadata (as sqlite3.Row), newest first, reading only the newest shard(s) if needed"""
+    if not os.path.exists(db_path):
+        return []
+    shards = list_shards(db_path)
+    if len(shards) == 0:
+        return []
+    newest = latest_id(shards[-1])
+    with cache_lock:
+        cached = latest_rows_cache.get((db_path, n))
+    if (cached is not None) and (cached[0] == newest) and (newest is not None):
+        return cached[1]
+
+    rows = []
+    for shard in reversed(shards):
+        before = latest_id(shard)
+        if before is None:
+            continue  # empty shard
+        rows += get_connection(shard).execute(SQL_ROWS_BEFORE, (before, int(n) - len(rows))).fetchall()
+        if len(rows) >= n:
+            break
+
+    with cache_lock:
+        latest_rows_cache[(db_path, n)] = (newest, rows)
+    return rows
+
+
+def get_export_counts(db_path):
+    """Return number of samples, samples pending upload and uploaded samples, as maintained in the database (summed over shards)"""
+    if not os.path.exists(db_path):
+        return None
+    totals = [0, 0, 0]
+    for shard in list_shards(db_path):
+        try:
+            counts = get_connection(shard).execute(SQL_EXPORT_COUNTS).fetchone()
+        except sqlite3.OperationalError:
+            counts = None
+        if counts is None:
+            return None
+        totals = [t + c for t, c in zip(totals, counts)]
+    return dict(zip(['n_total', 'n_pending', 'n_uploaded'], totals))
@@ -26,11 +26,16 @@ from rq import Queue
 # link to or create redis queue 'sorad_q'
 sorad_q = Queue('sorad_q', connection=Redis())
 
-def get_file_lists(conf, mask='*.csv'):
+# files that may be downloaded or deleted from the storage path
+DOWNLOAD_SUFFIXES = tuple(m.lstrip('*') for m in df.CSV_MASKS + df.HDF_MASKS)
+
+def get_file_lists(conf, mask=df.CSV_MASKS):
     """
     list csv or hdf data files that have already been prepared
+    mask: file name pattern or list of patterns
     """
-    filelist_read = glob.glob(os.path.join(conf['DOWNLOAD'].get('storage_path'), mask))
+    masks = [mask] if isinstance(mask, str) else mask
+    filelist_read = [f for m in masks for f in glob.glob(os.path.join(conf['DOWNLOAD'].get('storage_path'), m))]
     # get image store size
     total_bytes = 0
     filesizes = []
@@ -65,6 +70,11 @@ def queue_info(queue):
     nfinished = queue.finished_job_registry.count
     nfailed =   queue.failed_job_registry.count
     result = f"Current and recent jobs: {nqueueing} queueing, {nstarted} started, {nfinished} finished, {nfailed} failed."
+    # progress of started jobs, as reported by download_functions.report_progress
+    for job_id in queue.started_job_registry.get_job_ids():
+        job = queue.fetch_job(job_id)
+        if (job is not None) and ('progress' in job.meta):
+            result += f" Job {job_id}: {job.meta['progress']:.0f}% complete."
     return result
 
 
@@ -90,8 +100,8 @@ def download_main(common, conf):
 
         print(0)
         try:
-            csv_filelist, csv_filesizes, csv_filetimes, csv_filemods = get_file_lists(conf, mask='*.csv')
-            hdf_filelist, hdf_filesizes, hdf_filetimes, hdf_filemods = get_file_lists(conf, mask='*.hdf')
+            csv_filelist, csv_filesizes, csv_filetimes, csv_filemods = get_file_lists(conf, mask=df.CSV_MASKS)
+            hdf_filelist, hdf_filesizes, hdf_filetimes, hdf_filemods = get_file_lists(conf, mask=df.HDF_MASKS)
             filesizes = list(csv_filesizes) + list(hdf_filesizes)
             dataset_vals['stored_gb'] = f"{sum(filesizes) / 1024**3:.2f}"
         except Exception as err:
@@ -119,7 +129,9 @@ def download_main(common, conf):
                     dataset_vals['make_csv_start_current'] = datetime.datetime.strftime(csv_start, '%Y-%m-%dT%H:%M')
                     dataset_vals['make_csv_end_current']   = datetime.datetime.strftime(csv_end, '%Y-%m-%dT%H:%M')
                     job = sorad_q.enqueue(df.csv_from_web_request, storage_path, database_path,
-                                          csv_start, csv_end, common['platform_id'], common['platform_uuid'], job_timeout=3400)
+                                          csv_start, csv_end, common['platform_id'], common['platform_uuid'],
+                                          compress=conf['DOWNLOAD'].getboolean('compress_csv', fallback=False),
+                                          processes=conf['DOWNLOAD'].getint('download_processes', fallback=0) or None, job_timeout=3400)
                     flash(f"Job {job.id} was added to the processing queue")
 
                 except Exception as err:
@@ -135,7 +147,8 @@ def download_main(common, conf):
                     dataset_vals['make_csv_start_current'] = datetime.datetime.strftime(csv_start, '%Y-%m-%dT%H:%M')
                     dataset_vals['make_csv_end_current']   = datetime.datetime.strftime(csv_end, '%Y-%m-%dT%H:%M')
                     job = sorad_q.enqueue(df.hdf_from_web_request, storage_path, database_path,
-                                          csv_start, csv_end, common['platform_id'], common['platform_uuid'], job_timeout=3400)
+                                          csv_start, csv_end, common['platform_id'], common['platform_uuid'],
+                                          processes=conf['DOWNLOAD'].getint('download_processes', fallback=0) or None, job_timeout=3400)
                     flash(f"Job {job.id} was added to the processing queue")
 
                 except Exception as err:
@@ -145,7 +158,7 @@ def download_main(common, conf):
                 for f in csv_filelist:
                     if os.path.exists(f):
                         os.remove(f)
-                csv_filelist, csv_filesizes, csv_filetimes, csv_filemods = get_file_lists(conf, mask='*.csv')
+                csv_filelist, csv_filesizes, csv_filetimes, csv_filemods = get_file_lists(conf, mask=df.CSV_MASKS)
                 filesizes = list(csv_filesizes) + list(hdf_filesizes)
                 dataset_vals['stored_gb'] = f"{sum(filesizes) / 1024**3:.2f}"
 
@@ -153,7 +166,7 @@ def download_main(common, conf):
                 for f in hdf_filelist:
                     if os.path.exists(f):
                         os.remove(f)
-                hdf_filelist, hdf_filesizes, hdf_filetimes, hdf_filemods = get_file_lists(conf, mask='*.hdf')
+                hdf_filelist, hdf_filesizes, hdf_filetimes, hdf_filemods = get_file_lists(conf, mask=df.HDF_MASKS)
                 filesizes = list(csv_filesizes) + list(hdf_filesizes)
                 dataset_vals['stored_gb'] = f"{sum(filesizes) / 1024**3:.2f}"
 
@@ -162,27 +175,28 @@ def download_main(common, conf):
                     if 'download_' in key:
                         fileselected = '_'.join(key.split('_')[1:])
                         print(f"File download request: {fileselected}")
-                        if os.path.basename(fileselected)[-3:] in ['csv', 'hdf']:
+                        if os.path.basename(fileselected).endswith(DOWNLOAD_SUFFIXES):
                             rootpath = conf['DOWNLOAD']['storage_path']
                         else:
                             print(f"Unknown download request for {fileselected}")
                             break
                         filepath = os.path.join(rootpath, fileselected)
                         if os.path.exists(filepath):
-                            return send_file(filepath, as_attachment=True, mimetype='csv')
+                            mimetype = 'application/gzip' if filepath.endswith('.gz') else 'csv'
+                            return send_file(filepath, as_attachment=True, mimetype=mimetype)
                         else:
                             break
 
                     if 'delete_' in key:
                         fileselected = '_'.join(key.split('_')[1:])
                         print(f"File delete request: {fileselected}")
-                        if os.path.basename(fileselected)[-3:] in ['csv', 'hdf']:
+                        if os.path.basename(fileselected).endswith(DOWNLOAD_SUFFIXES):
                             rootpath = conf['DOWNLOAD']['storage_path']
                         filepath = os.path.join(rootpath, fileselected)
                         if os.path.exists(filepath):
                             os.remove(filepath)
-                            csv_filelist, csv_filesizes, csv_filetimes, csv_filemods = get_file_lists(conf, mask='*.csv')
-                            hdf_filelist, hdf_filesizes, hdf_filetimes, hdf_filemods = get_file_lists(conf, mask='*.hdf')
+                            csv_filelist, csv_filesizes, csv_filetimes, csv_filemods = get_file_lists(conf, mask=df.CSV_MASKS)
+                            hdf_filelist, hdf_filesizes, hdf_filetimes, hdf_filemods = get_file_lists(conf, mask=df.HDF_MASKS)
                             filesizes = list(csv_filesizes) + list(hdf_filesizes)
                             dataset_vals['stored_gb'] = f"{sum(filesizes) / 1024**3:.2f}"
                         else:
@@ -9,7 +9,6 @@ from flask import Flask, render_template, abort, \
                   jsonify, send_file
 from markupsafe import Markup
 from jinja2 import TemplateNotFound
-import sqlite3
 import configparser
 import sys
 import os
@@ -34,6 +33,7 @@ import camera_functions
 import inspect
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
 from main_app import __version__ as sorad_sw_version
+import database_functions
 
 # TODO: check safe_join
 
@@ -178,17 +178,10 @@ def load_user(id):
 
 def get_from_db(db_path, n=10):
     """return last n rows from database"""
-    if not os.path.exists(db_path):
+    rows = database_functions.get_latest_rows(db_path, n)
+    if len(rows) == 0:
         return None
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor=conn.cursor()
-    cursor.execute(f"SELECT * FROM sorad_metadata ORDER BY id_ DESC LIMIT {int(n)}")
-    results = cursor.fetchall()
-    if len(results) == 0:
-        return None
-    conn.close()
-    return results
+    return rows
 
 
 # pass math functions to jinja2
@@ -560,7 +553,8 @@ def database():
         dbrows = get_from_db(db_path, 10)
         if dbrows is not None and len(dbrows) > 0:
             dbtable = [dict(dbrow) for dbrow in dbrows]
-            return render_template('database.html', dbtable=dbtable, common=common)
+            export_counts = database_functions.get_export_counts(db_path)
+            return render_template('database.html', dbtable=dbtable, export_counts=export_counts, common=common)
         else:
             flash("Database file not found or database empty.")
             return render_template('layout.html', message = '', common=common)